@@ -23,12 +23,13 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License.
 """
+import hashlib
 import os
 import pathlib
 
 import numpy as np
 import torch
-from scipy import linalg
+from PIL import Image
 from torch.nn.functional import adaptive_avg_pool2d
 
 from . import metric_utils as utils
@@ -39,7 +40,9 @@ def calculate_frechet_distance(mu1, sigma1, mu2, sigma2, eps=1e-6):
     The Frechet distance between two multivariate Gaussians X_1 ~ N(mu_1, C_1)
     and X_2 ~ N(mu_2, C_2) is
             d^2 = ||mu_1 - mu_2||^2 + Tr(C_1 + C_2 - 2*sqrt(C_1*C_2)).
-    Stable version by Dougal J. Sutherland.
+    The trace of sqrt(C_1*C_2) is computed from the eigenvalues of the
+    symmetric matrix sqrt(C_1) C_2 sqrt(C_1), which has the same spectrum, so
+    only symmetric eigendecompositions are needed (instead of scipy's sqrtm).
     Params:
     -- mu1   : Numpy array containing the activations of a layer of the
                inception net (like returned by the function 'get_predictions')
@@ -49,6 +52,8 @@ def calculate_frechet_distance(mu1, sigma1, mu2, sigma2, eps=1e-6):
     -- sigma1: The covariance matrix over activations for generated samples.
     -- sigma2: The covariance matrix over activations, precalculated on an
                representative data set.
+    -- eps   : Eigenvalues are clipped at -eps before taking square roots
+               (larger negative eigenvalues raise an error).
     Returns:
     --   : The Frechet Distance.
     """
@@ -66,30 +71,85 @@ def calculate_frechet_distance(mu1, sigma1, mu2, sigma2, eps=1e-6):
 
     diff = mu1 - mu2
 
-    # Product might be almost singular
-    covmean, _ = linalg.sqrtm(sigma1.dot(sigma2), disp=False)
-    if not np.isfinite(covmean).all():
-        msg = ('fid calculation produces singular product; '
-               'adding %s to diagonal of cov estimates') % eps
-        print(msg)
-        offset = np.eye(sigma1.shape[0]) * eps
-        covmean = linalg.sqrtm((sigma1 + offset).dot(sigma2 + offset))
-
-    # Numerical error might give slight imaginary component
-    if np.iscomplexobj(covmean):
-        if not np.allclose(np.diagonal(covmean).imag, 0, atol=1e-3):
-            m = np.max(np.abs(covmean.imag))
-            raise ValueError('Imaginary component {}'.format(m))
-        covmean = covmean.real
-
-    tr_covmean = np.trace(covmean)
+    # Covariances are PSD up to rounding
+    eigenvalues, eigenvectors = np.linalg.eigh(sigma1)
+    sqrt_sigma1 = (eigenvectors * np.sqrt(np.clip(eigenvalues, 0, None))) \
+        @ eigenvectors.T
+    product = sqrt_sigma1 @ sigma2 @ sqrt_sigma1
+    eigenvalues = np.linalg.eigvalsh((product + product.T) / 2)
+    scale = max(np.abs(eigenvalues).max(), 1.)
+    if eigenvalues.min() < -eps * scale:
+        raise ValueError('Covariance product has negative eigenvalue {}'
+                         .format(eigenvalues.min()))
+    tr_covmean = np.sqrt(np.clip(eigenvalues, 0, None)).sum()
 
     return (diff.dot(diff) + np.trace(sigma1) +
             np.trace(sigma2) - 2 * tr_covmean)
 
 
+def _default_device():
+    return 'cuda' if torch.cuda.is_available() else 'cpu'
+
+
+def _load_images(files):
+    """Loads image files into a (N, 3, H, W) float array in [0, 1]."""
+    images = np.stack([np.asarray(Image.open(str(f)).convert('RGB'))
+                       for f in files]).astype(np.float32)
+    return images.transpose((0, 3, 1, 2)) / 255.
+
+
+def compute_activations(images, model, dims):
+    """Pool_3 (or the block for dims) features of a batch of images in [0, 1].
+    Params:
+    -- images : Tensor of images (N, 3, H, W), already on the model's device
+    -- model  : Instance of inception model
+    -- dims   : Dimensionality of features returned by Inception
+    Returns:
+    -- Tensor of features (N, dims)
+    """
+    with torch.no_grad():
+        pred = model(images)[0]
+    # If model output is not scalar, apply global spatial average pooling.
+    # This happens if you choose a dimensionality not equal 2048.
+    if pred.size(2) != 1 or pred.size(3) != 1:
+        pred = adaptive_avg_pool2d(pred, output_size=(1, 1))
+    return pred.view(pred.size(0), dims)
+
+
+def iterate_activations(files, model, batch_size=50, dims=2048, device=None):
+    """Yields the features (batch_size, dims) of the images in files batch by
+    batch, so they never have to fit in memory."""
+    if device is None:
+        device = _default_device()
+    model.eval()
+    for start in range(0, len(files), batch_size):
+        images = _load_images(files[start:start + batch_size])
+        batch = torch.from_numpy(images).to(device)
+        yield compute_activations(batch, model, dims)
+
+
+def get_activations(files, model, batch_size=50, dims=2048, device=None):
+    """Features of all images in files as a (N, dims) numpy array."""
+    return np.concatenate([act.cpu().numpy() for act in
+                           iterate_activations(files, model, batch_size, dims,
+                                               device)])
+
+
+def accumulate_statistics(activations, stats=None):
+    """Adds batches of features (numpy or torch) to a streaming estimate of
+    their mean and covariance (float64).
+    Returns:
+    -- utils.StreamingCovariance of all batches
+    """
+    if stats is None:
+        stats = utils.StreamingCovariance()
+    for batch in activations:
+        stats.update(batch)
+    return stats
+
+
 def calculate_activation_statistics(files, model, batch_size,
-                                    dims):
+                                    dims, device=None):
     """Calculation of the statistics used by the FID.
     Params:
     -- files       : List of image files paths
@@ -98,52 +158,107 @@ def calculate_activation_statistics(files, model, batch_size,
                      batch size batch_size. A reasonable batch size
                      depends on the hardware.
     -- dims        : Dimensionality of features returned by Inception
-    -- cuda        : If set to True, use GPU
-    -- verbose     : If set to True and parameter out_step is given, the
-                     number of calculated batches is reported.
+    -- device      : Device of the model (defaults to cuda if available)
     Returns:
     -- mu    : The mean over samples of the activations of the pool_3 layer of
                the inception model.
     -- sigma : The covariance matrix of the activations of the pool_3 layer of
                the inception model.
     """
-    act = get_activations(files, model, batch_size, dims)
-    mu = np.mean(act, axis=0)
-    sigma = np.cov(act, rowvar=False)
-    return mu, sigma
+    stats = accumulate_statistics(iterate_activations(files, model, batch_size,
+                                                      dims, device))
+    return stats.mean, stats.covariance()
+
+
+class ReferenceStatistics(object):
+    """On-disk cache of the FID statistics of reference sets, keyed by the
+    dataset, split and feature dimension, so the reference activations are
+    only computed once. Entries stored with a fingerprint of the data are
+    recomputed when the fingerprint changes."""
+
+    def __init__(self, root):
+        self.root = pathlib.Path(root)
+
+    def path(self, dataset, split, dims):
+        return self.root / '{}_{}_{}.npz'.format(dataset, split, dims)
 
+    def get(self, dataset, split, dims, compute=None, fingerprint=None):
+        """Loads the (mu, sigma) of a reference set, or computes them with
+        compute() and stores them if they are missing or stale."""
+        path = self.path(dataset, split, dims)
+        if path.is_file():
+            with np.load(str(path)) as f:
+                if fingerprint is None or ('fingerprint' in f and
+                                           str(f['fingerprint']) == fingerprint):
+                    return f['mu'][:], f['sigma'][:]
+        if compute is None:
+            raise KeyError('No FID statistics for {} ({}, dims={}) in {}'
+                           .format(dataset, split, dims, self.root))
+        mu, sigma = compute()
+        self.root.mkdir(parents=True, exist_ok=True)
+        extra = {} if fingerprint is None else {'fingerprint': fingerprint}
+        np.savez(str(path), mu=mu, sigma=sigma, **extra)
+        return mu, sigma
 
-def _compute_statistics_of_path(path, model, batch_size, dims):
+
+def _directory_key(path):
+    """Cache key of an image directory: its name and a hash of its resolved
+    path (directories with the same name are different datasets)."""
+    path = pathlib.Path(path).resolve()
+    return '{}-{}'.format(path.name,
+                          hashlib.md5(str(path).encode()).hexdigest()[:12])
+
+
+def _fingerprint(files):
+    """Hash of the names, sizes and modification times of files."""
+    digest = hashlib.md5()
+    for f in files:
+        stat = os.stat(str(f))
+        digest.update('{}:{}:{}\n'.format(pathlib.Path(f).name, stat.st_size,
+                                          stat.st_mtime_ns).encode())
+    return digest.hexdigest()
+
+
+def _compute_statistics_of_path(path, model, batch_size, dims, device=None,
+                                cache=None, split='all'):
     if path.endswith('.npz'):
         f = np.load(path)
         m, s = f['mu'][:], f['sigma'][:]
         f.close()
-    else:
-        path = pathlib.Path(path)
-        files = list(path.glob('*.jpg')) + list(path.glob('*.png'))
-        m, s = calculate_activation_statistics(files, model, batch_size,
-                                               dims, cuda)
+        return m, s
+
+    path = pathlib.Path(path)
+    files = sorted(list(path.glob('*.jpg')) + list(path.glob('*.png')))
+
+    def compute():
+        return calculate_activation_statistics(files, model, batch_size,
+                                               dims, device)
 
-    return m, s
+    if cache is None:
+        return compute()
+    return cache.get(_directory_key(path), split, dims, compute,
+                     fingerprint=_fingerprint(files))
 
 
-def calculate_fid_score(paths, batch_size = 50, dims = 2048):
-    """Calculates the FID of two paths"""
+def calculate_fid_score(paths, batch_size = 50, dims = 2048, cache_dir=None,
+                        splits=('all', 'all')):
+    """Calculates the FID of two paths (the statistics of image directories
+    are cached in cache_dir, if provided, keyed by their path and the name of
+    their split in splits)"""
     for p in paths:
         if not os.path.exists(p):
             raise RuntimeError('Invalid path: %s' % p)
 
     block_idx = utils.InceptionV3.BLOCK_INDEX_BY_DIM[dims]
 
-    model = utils.InceptionV3([block_idx])
-    if torch.cuda.is_available():
-        model.cuda()
+    device = _default_device()
+    model = utils.InceptionV3([block_idx]).to(device)
+    cache = None if cache_dir is None else ReferenceStatistics(cache_dir)
 
     m1, s1 = _compute_statistics_of_path(paths[0], model, batch_size,
-                                         dims)
+                                         dims, device, cache, splits[0])
     m2, s2 = _compute_statistics_of_path(paths[1], model, batch_size,
-                                         dims)
+                                         dims, device, cache, splits[1])
     fid_value = calculate_frechet_distance(m1, s1, m2, s2)
 
     return fid_value
-    
\ No newline at end of file
@@ -6,5 +6,6 @@ from .structure_modules import AdaIN, Affine_AdaIN, _find_dims
 from .ladder import LadderEncoder, InferenceRung, GenerativeRung
 from .responses import sample_full_interventions, response_mat, compute_response, factor_reponses
 from . import evaluate
+from . import benchmark
 from . import metrics
 from . import datasets
\ No newline at end of file
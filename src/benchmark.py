@@ -0,0 +1,282 @@
+import sys, os
+import time
+import json
+import platform
+import subprocess
+import tracemalloc
+from pathlib import Path
+
+try:
+	import resource
+except ImportError: # windows
+	resource = None
+
+import numpy as np
+import scipy.stats
+import sklearn
+
+import omnifig as fig
+
+from .metrics import metric_beta_vae, metric_factor_vae, mig, dci, irs, sap, \
+	modularity_explicitness, unsupervised_metrics, fairness, metric_utils
+
+
+class Synthetic_Data:
+	'''
+	Cheap ground truth data (with the disentanglement_lib interface) for benchmarking the metrics: the observations
+	are a fixed random nonlinear mixture of the (normalized) factors.
+	'''
+	def __init__(self, factor_sizes=(3, 6, 40, 32, 32), obs_dim=64, seed=0):
+		self.factor_sizes = list(factor_sizes)
+		self.obs_dim = obs_dim
+		rng = np.random.RandomState(seed)
+		self.W = rng.randn(len(self.factor_sizes), obs_dim) / np.sqrt(len(self.factor_sizes))
+		self.b = rng.randn(obs_dim)
+
+	@property
+	def num_factors(self):
+		return len(self.factor_sizes)
+
+	@property
+	def factors_num_values(self):
+		return self.factor_sizes
+
+	@property
+	def observation_shape(self):
+		return [self.obs_dim]
+
+	def sample_factors(self, num, random_state):
+		return np.stack([random_state.randint(size, size=num) for size in self.factor_sizes], axis=1)
+
+	def sample_observations_from_factors(self, factors, random_state):
+		factors = (factors + 0.5) / np.array(self.factor_sizes) - 0.5
+		return np.tanh(factors @ self.W + self.b).astype(np.float32)
+
+	def sample(self, num, random_state):
+		factors = self.sample_factors(num, random_state)
+		return factors, self.sample_observations_from_factors(factors, random_state)
+
+	def sample_observations(self, num, random_state):
+		return self.sample(num, random_state)[1]
+
+
+class Random_Representation:
+	'''Representation function given by a fixed random linear map or MLP (with tanh nonlinearities), on the CPU.'''
+	def __init__(self, obs_dim, code_dim, hidden=(), seed=0):
+		rng = np.random.RandomState(seed)
+		dims = [obs_dim, *hidden, code_dim]
+		self.layers = [(rng.randn(din, dout).astype(np.float32) / np.sqrt(din), rng.randn(dout).astype(np.float32))
+		               for din, dout in zip(dims[:-1], dims[1:])]
+
+	def __call__(self, observations):
+		x = np.asarray(observations, dtype=np.float32)
+		for i, (W, b) in enumerate(self.layers):
+			x = x @ W + b
+			if i < len(self.layers) - 1:
+				x = np.tanh(x)
+		return x
+
+
+def _bench_unsupervised(data, rep_fn, rng, num, batch_size):
+	return unsupervised_metrics.unsupervised_metrics(data, rep_fn, rng, num, batch_size)
+
+def _bench_mig(data, rep_fn, rng, num, batch_size):
+	return mig.compute_mig(data, rep_fn, rng, num, batch_size)
+
+def _bench_dci(data, rep_fn, rng, num, batch_size):
+	return dci.compute_dci(data, rep_fn, rng, num, num // 2, batch_size)
+
+def _bench_sap(data, rep_fn, rng, num, batch_size):
+	return sap.compute_sap(data, rep_fn, rng, num, num // 2, False, batch_size)
+
+def _bench_irs(data, rep_fn, rng, num, batch_size):
+	return irs.compute_irs(data, rep_fn, rng, num, batch_size)
+
+def _bench_modularity(data, rep_fn, rng, num, batch_size):
+	return modularity_explicitness.compute_modularity_explicitness(data, rep_fn, rng, num, num // 2, batch_size)
+
+def _bench_fairness(data, rep_fn, rng, num, batch_size):
+	return fairness.compute_fairness(data, rep_fn, rng, num, max(1, num // 100), batch_size)
+
+def _bench_factor_vae(data, rep_fn, rng, num, batch_size): # each vote encodes a batch
+	votes = max(1, num // batch_size)
+	return metric_factor_vae.compute_factor_vae(data, rep_fn, rng, batch_size, votes, max(1, votes // 2), num)
+
+def _bench_beta_vae(data, rep_fn, rng, num, batch_size): # each point encodes 2 batches
+	points = max(1, num // (2 * batch_size))
+	return metric_beta_vae.compute_beta_vae_sklearn(data, rep_fn, rng, batch_size, points, max(1, points // 2))
+
+
+BENCHMARKS = {
+	'unsupervised': _bench_unsupervised,
+	'mig': _bench_mig,
+	'dci': _bench_dci,
+	'sap': _bench_sap,
+	'irs': _bench_irs,
+	'modularity-explicitness': _bench_modularity,
+	'fairness': _bench_fairness,
+	'factor-vae': _bench_factor_vae,
+	'beta-vae': _bench_beta_vae,
+}
+
+
+def _max_rss():
+	'''Peak resident memory of the process so far in bytes (None if unknown).'''
+	if resource is None:
+		return None
+	rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def benchmark_metric(fn, data, rep_fn, num, batch_size=64, repeats=3, seed=0, trace_memory=True):
+	'''
+	Times `fn` (see `BENCHMARKS`) on `num` samples. The timing runs are not traced, the peak memory allocated
+	while computing the metric is measured in one separate run with `tracemalloc`.
+	'''
+	wall, cpu = [], []
+	for _ in range(repeats):
+		rng = np.random.RandomState(seed)
+		start, start_cpu = time.perf_counter(), time.process_time()
+		scores = fn(data, rep_fn, rng, num, batch_size)
+		wall.append(time.perf_counter() - start)
+		cpu.append(time.process_time() - start_cpu)
+
+	peak = None
+	if trace_memory:
+		tracemalloc.start()
+		fn(data, rep_fn, np.random.RandomState(seed), num, batch_size)
+		peak = tracemalloc.get_traced_memory()[1]
+		tracemalloc.stop()
+
+	best = min(wall)
+	return {
+		'wall': best, 'wall_mean': float(np.mean(wall)), 'cpu': min(cpu),
+		'throughput': num / best if best > 0 else None,
+		'peak_memory': peak, 'max_rss': _max_rss(),
+		'scores': {key: float(val) for key, val in scores.items() if np.isscalar(val)},
+	}
+
+
+def compare_dci_backends(data, rep_fn, num, backends, batch_size=64, seed=0, n_jobs=1):
+	'''
+	Times the DCI importance `backends` on the same codes and compares the scores (absolute difference) and the
+	importance matrix (Spearman correlation) to the default GBT backend.
+	'''
+	rng = np.random.RandomState(seed)
+	mus_train, ys_train = metric_utils.generate_batch_factor_code(data, rep_fn, num, rng, batch_size)
+	mus_test, ys_test = metric_utils.generate_batch_factor_code(data, rep_fn, num // 2, rng, batch_size)
+
+	results = {}
+	for backend in ['gbt', *[b for b in backends if b != 'gbt']]:
+		np.random.seed(seed)
+		start = time.perf_counter()
+		scores = dci._compute_dci(mus_train, ys_train, mus_test, ys_test, backend=backend, n_jobs=n_jobs)
+		result = {'wall': time.perf_counter() - start}
+		result.update({key: float(val) for key, val in scores.items() if np.isscalar(val)})
+
+		reference = results.get('gbt', result)
+		result['diff'] = {key: abs(result[key] - reference[key]) for key in reference
+		                  if key not in {'wall', 'diff', 'importance_correlation'}}
+		importance = scores['importance_matrix']
+		if backend == 'gbt':
+			gbt_importance = importance
+		result['importance_correlation'] = float(scipy.stats.spearmanr(importance.ravel(),
+		                                                                gbt_importance.ravel())[0])
+		results[backend] = result
+	return results
+
+
+def _environment():
+	try:
+		commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+		                        cwd=Path(__file__).parent).stdout.strip() or None
+	except OSError:
+		commit = None
+	return {
+		'commit': commit, 'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+		'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count(),
+		'numpy': np.__version__, 'sklearn': sklearn.__version__,
+	}
+
+
+def compare_reports(report, baseline):
+	'''Prints the relative speed of all benchmarks in `report` which are also in `baseline` (> 1 is faster).'''
+	old = {(r['metric'], r['num'], r['code_dim']): r for r in baseline['results']}
+	for r in report['results']:
+		key = (r['metric'], r['num'], r['code_dim'])
+		if key in old:
+			print(f'  {r["metric"]:>24} N={r["num"]:<7} D={r["code_dim"]:<4} '
+			      f'speedup: {old[key]["wall"] / r["wall"]:.2f}x')
+
+
+@fig.Script('benchmark-metrics', 'Measure the speed and memory of the disentanglement metrics on synthetic data')
+def run_benchmarks(A):
+	'''
+	Runs each metric for every combination of the number of samples (`nums`) and representation dimensions
+	(`code-dims`) on `Synthetic_Data` (CPU only) and saves a JSON report (to `out`), optionally compared
+	to the report of a previous commit (`compare`).
+	'''
+
+	metrics = A.pull('bench-metrics', list(BENCHMARKS))
+	nums = A.pull('nums', [1000, 10000])
+	code_dims = A.pull('code-dims', [10, 32])
+
+	factor_sizes = A.pull('factor-sizes', [3, 6, 40, 32, 32])
+	obs_dim = A.pull('obs-dim', 64)
+	hidden = A.pull('hidden', []) # empty for a linear representation function
+
+	batch_size = A.pull('batch_size', 64)
+	repeats = A.pull('repeats', 3)
+	seed = A.pull('seed', 0)
+	trace_memory = A.pull('trace-memory', True)
+	dci_backends = A.pull('dci-backends', []) # compared to the default GBT importance
+	n_jobs = A.pull('n_jobs', 1)
+
+	out = A.pull('out', 'benchmark.json')
+	compare = A.pull('compare', None)
+
+	os.environ['CUDA_VISIBLE_DEVICES'] = '' # metrics (and representations) stay on the cpu
+
+	data = Synthetic_Data(factor_sizes, obs_dim=obs_dim, seed=seed)
+
+	results = []
+	dci_agreement = []
+	for code_dim in code_dims:
+		rep_fn = Random_Representation(obs_dim, code_dim, hidden=hidden, seed=seed)
+		for num in nums:
+			if len(dci_backends):
+				comparison = compare_dci_backends(data, rep_fn, num, dci_backends, batch_size=batch_size,
+				                                  seed=seed, n_jobs=n_jobs)
+				dci_agreement.append({'num': num, 'code_dim': code_dim, 'backends': comparison})
+				for backend, result in comparison.items():
+					print(f'{"dci/" + backend:>24} N={num:<7} D={code_dim:<4} {result["wall"]:.3f}s '
+					      f'(max score diff: {max(result["diff"].values()):.3f}, '
+					      f'importance corr: {result["importance_correlation"]:.3f})')
+
+			for name in metrics:
+				result = benchmark_metric(BENCHMARKS[name], data, rep_fn, num, batch_size=batch_size,
+				                          repeats=repeats, seed=seed, trace_memory=trace_memory)
+				result.update({'metric': name, 'num': num, 'code_dim': code_dim})
+				results.append(result)
+
+				peak = '' if result['peak_memory'] is None else f' peak: {result["peak_memory"] / 2**20:.1f} MB'
+				print(f'{name:>24} N={num:<7} D={code_dim:<4} {result["wall"]:.3f}s '
+				      f'({result["throughput"]:.0f} samples/s){peak}')
+
+	report = {'environment': _environment(),
+	          'config': {'factor_sizes': factor_sizes, 'obs_dim': obs_dim, 'hidden': hidden,
+	                     'batch_size': batch_size, 'repeats': repeats, 'seed': seed},
+	          'results': results, 'dci_agreement': dci_agreement}
+
+	if out is not None:
+		with open(out, 'w') as f:
+			json.dump(report, f, indent=2)
+		print(f'Saved report to {out}')
+
+	if compare is not None:
+		with open(compare, 'r') as f:
+			baseline = json.load(f)
+		print(f'Compared to {compare}:')
+		compare_reports(report, baseline)
+
+	return report
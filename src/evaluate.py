@@ -1,8 +1,15 @@
 import sys, os
+import zlib
+import hashlib
+from statistics import NormalDist
 from pathlib import Path
+from contextlib import contextmanager
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, Future, as_completed
+from threadpoolctl import threadpool_limits
 from tqdm import tqdm
 
-from omnibelt import unspecified_argument
+from omnibelt import unspecified_argument, load_yaml, save_yaml
 import omnifig as fig
 
 import matplotlib.pyplot as plt
@@ -19,7 +26,210 @@ from omnilearn.data import InterventionSamplerBase
 
 from .responses import sample_full_interventions, response_mat, factor_reponses
 from .metrics import metric_beta_vae, metric_factor_vae, mig, dci, irs, sap, \
-	modularity_explicitness, unsupervised_metrics, fairness
+	modularity_explicitness, unsupervised_metrics, fairness, metric_utils, torch_kernels, bootstrap
+
+
+class Representation_Cache:
+	'''
+	Keeps the encoded samples `(mus, ys)` of a run, so that all metrics which only need an iid sample of codes and
+	factors share a single pass through the encoder instead of each sampling and encoding their own.
+
+	Samples are keyed by (model, dataset, seed, N, split), so metrics evaluated with the same settings on the same run
+	get exactly the same codes.
+	
+	If a `root` directory is provided, the samples are also stored there as `.npy` files together with a manifest.
+	Entries of the manifest are named after the dataset (see `get_dataset_ident`), split, N and seed, and an entry is
+	only reused if all its `meta` info (eg. the checkpoint hash) and the latent dimension of the model match, in which
+	case the codes are memory-mapped instead of running the encoder again.
+	'''
+	
+	def __init__(self, root=None, meta=None):
+		self._codes = {}
+		self.root = None if root is None else Path(root)
+		self.meta = {} if meta is None else meta
+		self._manifest = None
+		self.batch = None
+	
+	def __len__(self):
+		return len(self._codes)
+	
+	def __contains__(self, key):
+		return key in self._codes
+	
+	def clear(self):
+		self._codes.clear()
+	
+	@staticmethod
+	def get_key(model, dataset, seed, num, split='train'):
+		return id(model), id(dataset), seed, num, split
+	
+	@staticmethod
+	def get_dataset_ident(dataset):
+		'''Identifies the dataset of stored codes by its type, location (`root`) and mode, if it has them.'''
+		ident = [dataset.__class__.__name__]
+		for attr in ['root', 'mode']:
+			value = getattr(dataset, attr, None)
+			if value is not None:
+				ident.append(str(value))
+		return ':'.join(ident)
+	
+	def has_codes(self, evaluator, num, split='train', model=None):
+		'''Checks if the codes are available without running the encoder (loading them from `root` if possible).'''
+		if model is None:
+			model = evaluator.model
+		key = self.get_key(model, evaluator.dataset, evaluator.seed, num, split)
+		if key not in self._codes and self.root is not None:
+			codes = self._load_codes(evaluator, num, split, model)
+			if codes is not None:
+				self._codes[key] = codes
+		return key in self._codes
+	
+	def set_codes(self, evaluator, num, split, codes, model=None):
+		if model is None:
+			model = evaluator.model
+		if self.root is not None:
+			codes = self._store_codes(evaluator, num, split, codes, model)
+		self._codes[self.get_key(model, evaluator.dataset, evaluator.seed, num, split)] = codes
+	
+	def get_codes(self, evaluator, num, split='train'):
+		if not self.has_codes(evaluator, num, split):
+			if self.batch is not None:
+				self.batch.generate_codes(evaluator, num, split=split)
+			else:
+				self.set_codes(evaluator, num, split, evaluator.generate_codes(num, split=split))
+		return self._codes[self.get_key(evaluator.model, evaluator.dataset, evaluator.seed, num, split)]
+	
+	def get_manifest(self):
+		if self._manifest is None:
+			path = self.root / 'manifest.yaml'
+			self._manifest = load_yaml(str(path)) if path.is_file() else {}
+		return self._manifest
+	
+	def _get_entry_info(self, evaluator, num, split, model):
+		dataset = self.get_dataset_ident(evaluator.dataset)
+		info = self.meta.copy()
+		info.update({'dataset': dataset, 'latent_dim': getattr(model, 'latent_dim', None),
+		             'seed': evaluator.seed, 'num': num, 'split': split})
+		return f'{split}_{num}_{evaluator.seed}_{hashlib.md5(dataset.encode()).hexdigest()[:8]}', info
+	
+	def _load_codes(self, evaluator, num, split, model):
+		name, info = self._get_entry_info(evaluator, num, split, model)
+		entry = self.get_manifest().get(name)
+		if entry is None or any(entry.get(k) != v for k, v in info.items()):
+			return None
+		paths = self.root / entry['codes'], self.root / entry['factors']
+		if not all(path.is_file() for path in paths):
+			return None
+		return tuple(np.load(str(path), mmap_mode='r') for path in paths)
+	
+	def _store_codes(self, evaluator, num, split, codes, model):
+		name, info = self._get_entry_info(evaluator, num, split, model)
+		self.root.mkdir(parents=True, exist_ok=True)
+		
+		info['codes'], info['factors'] = f'{name}_codes.npy', f'{name}_factors.npy'
+		for fname, data in zip([info['codes'], info['factors']], codes):
+			np.save(str(self.root / fname), data)
+		
+		manifest = self.get_manifest()
+		manifest[name] = info
+		save_yaml(manifest, str(self.root / 'manifest.yaml'))
+		return self._load_codes(evaluator, num, split, model)
+	
+
+class Model_Batch:
+	'''
+	Group of models (each with its own `Representation_Cache`) that are evaluated on the same dataset. Whenever one
+	of the caches is missing a sample, every batch of observations is drawn and transferred to the device once and
+	then encoded by all models in the group which are missing that sample.
+	'''
+	
+	def __init__(self):
+		self.members = []
+	
+	def __len__(self):
+		return len(self.members)
+	
+	def add(self, model, cache):
+		cache.batch = self
+		self.members.append((model, cache))
+	
+	def generate_codes(self, evaluator, num, split='train'):
+		todo = [(model, cache) for model, cache in self.members
+		        if not cache.has_codes(evaluator, num, split, model=model)]
+		if not len(todo):
+			return
+		codes = evaluator.generate_codes(num, split=split, models=[model for model, _ in todo])
+		for (model, cache), code in zip(todo, codes):
+			cache.set_codes(evaluator, num, split, code, model=model)
+
+
+class Adaptive_Sample:
+	'''
+	Codes of an evaluator in adaptive mode (see `Disentanglement_Evaluator._compute_adaptive`). A request for `num`
+	codes of a split gets the first `fraction * num` codes of the pool of that split. The pool is only extended (by a
+	newly drawn sample) when the fraction grows, so no observation is encoded twice.
+	
+	If `resample` is set to a function of `(split, num)` returning indices, the codes are indexed with them instead
+	(eg. to compute bootstrap or jackknife estimates).
+	'''
+	
+	def __init__(self, evaluator, fraction=1.):
+		self.evaluator = evaluator
+		self.fraction = fraction
+		self.resample = None
+		self.pools = {}
+	
+	def get_codes(self, num, split='train'):
+		num = max(2, int(np.ceil(num * self.fraction)))
+		chunks, pool = self.pools.get(split, (0, None))
+		have = 0 if pool is None else pool[0].shape[1]
+		if have < num: # every extension is sampled with its own seed
+			codes = self.evaluator.generate_codes(num - have, split=split if chunks == 0 else f'{split}-{chunks}',
+			                                      to_numpy=not self.evaluator.use_torch)
+			if pool is not None:
+				codes = [torch.cat([old, new], 1) if isinstance(old, torch.Tensor) else np.concatenate([old, new], 1)
+				         for old, new in zip(pool, codes)]
+			pool = tuple(codes)
+			self.pools[split] = chunks + 1, pool
+		
+		if self.resample is None:
+			return tuple(x[:, :num] for x in pool)
+		idx = self.resample(split, num)
+		return tuple(x[:, torch.as_tensor(idx, device=x.device) if isinstance(x, torch.Tensor) else idx]
+		             for x in pool)
+
+
+class Fit_Job:
+	'''
+	Fitting stage of a metric given the sampled codes, which can run in a separate process. The global numpy seed is
+	set before fitting, so the output does not depend on where (or after which other metrics) the job runs.
+	
+	`samples` lists the positions of the arguments of each independent sample (eg. `[(0, 1), (2, 3)]` for the codes
+	and factors of the training and test set), which are resampled for the bootstrap intervals.
+	'''
+	def __init__(self, fn, *args, seed=None, samples=None, **kwargs):
+		self.fn = fn
+		self.args = args
+		self.kwargs = kwargs
+		self.seed = seed
+		self.samples = samples
+		self.timer = None # phases timed while preparing the job (see `Disentanglement_Evaluator.prepare`)
+		self.bootstrap = 0 # number of resamples for the confidence intervals of the scores
+		self.confidence = 0.95
+	
+	def __call__(self):
+		if self.seed is not None:
+			np.random.seed(self.seed)
+		with metric_utils.timed_phase('score', self.timer):
+			out = self.fn(*self.args, **self.kwargs)
+			if self.bootstrap and self.samples is not None and isinstance(out, dict):
+				with metric_utils.timed_phase('bootstrap', self.timer):
+					summary = bootstrap.bootstrap_scores(self.fn, self.args, self.kwargs, self.samples, self.bootstrap,
+					                                     np.random.RandomState(self.seed), self.confidence)
+				out.update({f'{score}_bootstrap': stats for score, stats in summary.items()})
+		if self.timer is not None and isinstance(out, dict):
+			out['timing'] = self.timer.summary()
+		return out
 
 
 class Disentanglement_Evaluator(Evaluator, util.Seed, util.Switchable, util.Deviced):
@@ -36,7 +246,12 @@ class Disentanglement_Evaluator(Evaluator, util.Seed, util.Switchable, util.Devi
 	# 	'unsupervised': eval_unsupervised,
 	# }
 	
-	def __init__(self, A, model=unspecified_argument, dataset=unspecified_argument, metrics=None, **kwargs):
+	supports_torch = False # metric can be computed from codes on any device (see `metrics.torch_kernels`)
+	supports_resampling = False # metric is computed from sampled codes by `_prepare` (for `adaptive` and `bootstrap`)
+	
+	def __init__(self, A, model=unspecified_argument, dataset=unspecified_argument, metrics=None,
+	             prefetch=None, prefetch_workers=None, timing=None, backend=None, adaptive=None, bootstrap=None,
+	             **kwargs):
 		
 		if model is unspecified_argument:
 			model = A.pull('model', None, ref=True)
@@ -44,6 +259,32 @@ class Disentanglement_Evaluator(Evaluator, util.Seed, util.Switchable, util.Devi
 		if dataset is unspecified_argument:
 			dataset = A.pull('dataset', None, ref=True)
 		
+		if prefetch is None:
+			prefetch = A.pull('prefetch', 0) # number of batches to prepare ahead of the encoder
+		
+		if prefetch_workers is None:
+			prefetch_workers = A.pull('prefetch-workers', 1)
+		
+		if timing is None:
+			timing = A.pull('phase-timing', True) # record time and memory of sampling, encoding, fitting and scoring
+		
+		if backend is None:
+			backend = A.pull('backend', 'numpy') # or 'torch' to compute the metric kernels where the codes are
+		
+		if adaptive is None:
+			adaptive = A.pull('adaptive', False) # grow the samples until the score is precise enough
+		adaptive_start = A.pull('adaptive-start', 0.1) # fraction of the sample sizes used first
+		adaptive_growth = A.pull('adaptive-growth', 2.)
+		adaptive_tol = A.pull('adaptive-tol', 0.02) # max width of the confidence interval of the score
+		adaptive_interval = A.pull('adaptive-interval', 'jackknife') # or 'bootstrap'
+		adaptive_resamples = A.pull('adaptive-resamples', 10) # jackknife groups or bootstrap resamples
+		adaptive_confidence = A.pull('adaptive-confidence', 0.95)
+		adaptive_score = A.pull('adaptive-score', None) # defaults to the first score of the metric
+		
+		if bootstrap is None:
+			bootstrap = A.pull('bootstrap', 0) # resamples of the codes for confidence intervals of the scores
+		bootstrap_confidence = A.pull('bootstrap-confidence', 0.95)
+		
 		# if metrics is None:
 		# 	metrics = A.pull('metrics', 'all')
 		# if metrics == 'all':
@@ -53,6 +294,38 @@ class Disentanglement_Evaluator(Evaluator, util.Seed, util.Switchable, util.Devi
 		
 		self.set_model(model)
 		self.set_dataset(dataset)
+		self.cache = None
+		
+		self.prefetch = prefetch
+		self.prefetch_workers = prefetch_workers
+		self.timing = timing
+		self.backend = backend
+		
+		if adaptive and not self.supports_resampling:
+			print(f'WARNING: {self.get_name()} does not support adaptive sample sizes, so the full samples are used '
+			      f'(and no interval is reported)')
+			adaptive = False
+		
+		self.adaptive = adaptive
+		self.adaptive_start = adaptive_start
+		self.adaptive_growth = adaptive_growth
+		self.adaptive_tol = adaptive_tol
+		self.adaptive_interval = adaptive_interval
+		self.adaptive_resamples = adaptive_resamples
+		self.adaptive_confidence = adaptive_confidence
+		self.adaptive_score = adaptive_score
+		self._adaptive_sample = None
+		
+		if bootstrap and not self.supports_resampling:
+			print(f'WARNING: {self.get_name()} does not support bootstrap intervals, so none are reported')
+			bootstrap = 0
+		
+		self.bootstrap = bootstrap
+		self.bootstrap_confidence = bootstrap_confidence
+	
+	@property
+	def use_torch(self):
+		return self.backend == 'torch' and self.supports_torch
 	
 	def get_name(self):
 		return self.__class__.__name__
@@ -64,7 +337,96 @@ class Disentanglement_Evaluator(Evaluator, util.Seed, util.Switchable, util.Devi
 		# assert self.dataset is not None
 		self.model.switch_to('eval')
 		util.set_seed(self.seed)
-		return super().compute(info=info)
+		timer = metric_utils.PhaseTimer() if self.timing else None
+		with metric_utils.timed_phase('score', timer):
+			scores, results = super().compute(info=info)
+		if timer is not None:
+			results['timing'] = timer.summary()
+		return scores, results
+	
+	def prepare(self, info=None):
+		'''
+		Samples and encodes everything the metric needs, returning the `Fit_Job` to compute the metric from the codes
+		(to be passed into `collect`), or None if the metric can't be split (then use `compute`).
+		'''
+		assert self.model is not None
+		if self.use_torch or self.adaptive: # the metric is computed in place (see `compute`)
+			return None
+		self.model.switch_to('eval')
+		util.set_seed(self.seed)
+		timer = metric_utils.PhaseTimer() if self.timing else None
+		with metric_utils.timed_phase('score', timer):
+			job = self._prepare(info)
+		if job is not None:
+			job.timer = timer
+			job.bootstrap, job.confidence = self.bootstrap, self.bootstrap_confidence
+		return job
+	
+	def collect(self, out):
+		'''Splits the output of the `Fit_Job` into scores and results (same as `compute`).'''
+		if isinstance(out, dict):
+			scores = {score:out.get(score, None) for score in self.get_scores()}
+			results = {result:data for result, data in out.items() if result not in scores}
+			out = scores, results
+		return out
+	
+	def _prepare(self, info=None):
+		return None
+	
+	def _compute(self, info=None):
+		if self.adaptive:
+			return self._compute_adaptive(info)
+		job = self._prepare(info)
+		job.bootstrap, job.confidence = self.bootstrap, self.bootstrap_confidence
+		return job()
+	
+	def _compute_adaptive(self, info=None):
+		'''
+		Computes the metric on a growing fraction of the sample sizes (starting at `adaptive_start`, and multiplied by
+		`adaptive_growth` each round), reusing the codes of previous rounds, until the width of the confidence
+		interval of the headline score (`adaptive_score`) is at most `adaptive_tol` or the full sample sizes are used.
+		The interval and the fraction that was used are added to the results.
+		'''
+		score = self.get_scores()[0] if self.adaptive_score is None else self.adaptive_score
+		sample = Adaptive_Sample(self, fraction=min(1., self.adaptive_start))
+		self._adaptive_sample = sample
+		try:
+			while True:
+				sample.resample = None
+				out = self._prepare(info)()
+				estimates = []
+				for resample in self._resamplers():
+					sample.resample = resample
+					estimates.append(self._prepare(info)()[score])
+				low, high = self._confidence_interval(out[score], estimates)
+				if high - low <= self.adaptive_tol or sample.fraction >= 1.:
+					break
+				sample.fraction = min(1., sample.fraction * self.adaptive_growth)
+		finally:
+			self._adaptive_sample = None
+		
+		out[f'{score}_interval'] = [low, high]
+		out['adaptive_fraction'] = sample.fraction
+		return out
+	
+	def _resamplers(self):
+		'''Index functions `(split, num) -> indices` of all jackknife groups or bootstrap resamples.'''
+		groups = self.adaptive_resamples
+		if self.adaptive_interval == 'jackknife': # delete-a-group jackknife
+			return [lambda split, num, g=g: np.flatnonzero(np.arange(num) % groups != g) for g in range(groups)]
+		return [lambda split, num, b=b: np.random.RandomState([self._split_seed(split), b]).randint(num, size=num)
+		        for b in range(groups)]
+	
+	def _confidence_interval(self, score, estimates):
+		estimates = np.asarray(estimates, dtype=np.float64)
+		if self.adaptive_interval == 'jackknife':
+			num = len(estimates)
+			stderr = np.sqrt((num - 1) / num * np.sum((estimates - estimates.mean()) ** 2))
+			half = NormalDist().inv_cdf((1 + self.adaptive_confidence) / 2) * stderr
+			return float(score - half), float(score + half)
+		tail = (1 - self.adaptive_confidence) / 2 * 100
+		low, high = np.percentile(estimates, [tail, 100 - tail])
+		return float(low), float(high)
 	
 	def set_model(self, model=None):
 		self.model = model
@@ -72,16 +434,82 @@ class Disentanglement_Evaluator(Evaluator, util.Seed, util.Switchable, util.Devi
 	def set_dataset(self, dataset=None):
 		self.dataset = dataset
 	
-	def _representation_function(self, images):
-		with torch.no_grad():
-			output = self.model.encode(images.to(self.get_device()))
-		if isinstance(output, distrib.Normal):
-			output = output.loc
-		return output.detach().cpu().numpy()
+	def set_cache(self, cache=None):
+		self.cache = cache
+	
+	def _split_seed(self, split='train'):
+		if split == 'train':
+			return self.seed
+		return (self.seed + zlib.adler32(split.encode())) % 2**32 # deterministically change seed for other splits
+	
+	@contextmanager
+	def ground_truth_data(self):
+		'''Provides the dataset to the metrics, prefetching upcoming batches in the background if enabled.'''
+		if not self.prefetch:
+			yield metric_utils.TimedGroundTruthData(self.dataset) if self.timing else self.dataset
+			return
+		with metric_utils.PrefetchGroundTruthData(self.dataset, queue_size=self.prefetch,
+		                                          num_workers=self.prefetch_workers,
+		                                          device=self.get_device()) as dataset:
+			yield metric_utils.TimedGroundTruthData(dataset) if self.timing else dataset
+	
+	def generate_codes(self, num, split='train', models=None, to_numpy=True):
+		'''
+		Samples `num` observations and encodes them with the model, or if `models` is provided, encodes the same
+		observations with each of the `models`, returning a list with the codes and factors of each one.
+		Unless `to_numpy`, the codes of the model are kept as tensors on its device.
+		'''
+		util.set_seed(self._split_seed(split))
+		
+		if models is None:
+			rep_fn = self._representation_function if to_numpy else \
+				lambda images: self._representation_function(images, to_numpy=False)
+		else:
+			dims = []
+			def rep_fn(images):
+				images = images.to(self.get_device())
+				codes = [self._representation_function(images, model=model) for model in models]
+				if not len(dims):
+					dims.extend(code.shape[1] for code in codes)
+				return np.concatenate(codes, 1)
+		
+		with self.ground_truth_data() as dataset:
+			mus, ys = metric_utils.generate_batch_factor_code(dataset, rep_fn, num, np.random, self.batch_size,
+			                                                  to_numpy=to_numpy or models is not None)
+		
+		if models is None:
+			return mus, ys
+		splits = np.cumsum([0] + dims)
+		return [(mus[start:stop], ys) for start, stop in zip(splits[:-1], splits[1:])]
+	
+	def sample_codes(self, num, split='train'):
+		'''Returns the codes `(num_codes, num)` and factors `(num_factors, num)` of an iid sample of the dataset.'''
+		if self._adaptive_sample is not None:
+			return self._adaptive_sample.get_codes(num, split=split)
+		if self.cache is None:
+			return self.generate_codes(num, split=split, to_numpy=not self.use_torch)
+		codes = self.cache.get_codes(self, num, split=split)
+		if self.use_torch:
+			codes = tuple(torch.as_tensor(np.array(x), device=self.get_device()) for x in codes)
+		return codes
+	
+	def _representation_function(self, images, model=None, to_numpy=True):
+		if model is None:
+			model = self.model
+		with metric_utils.timed_phase('encode'), torch.no_grad():
+			output = model.encode(images.to(self.get_device()))
+			if isinstance(output, distrib.Normal):
+				output = output.loc
+			if not to_numpy:
+				return output.detach()
+			return output.detach().cpu().numpy()
 
 @fig.Component('metric/unsupervised')
 class UnsupervisedMetrics(Disentanglement_Evaluator):
-	def __init__(self, A, num_train=None, batch_size=None, **kwargs):
+	supports_torch = True
+	supports_resampling = True
+	
+	def __init__(self, A, num_train=None, batch_size=None, discretizer=None, num_covariance=None, **kwargs):
 		
 		if num_train is None:
 			num_train = A.pull('num_train', 10000)
@@ -89,14 +517,36 @@ class UnsupervisedMetrics(Disentanglement_Evaluator):
 		if batch_size is None:
 			batch_size = A.pull('batch_size', 64)
 		
+		if discretizer is None:
+			discretizer = A.pull('discretizer', 'histogram') # or 'quantile'
+		
+		if num_covariance is None:
+			num_covariance = A.pull('num_covariance', None) # streamed samples for the gaussian scores
+		
 		super().__init__(A, **kwargs)
 		
 		self.num_train = num_train
 		self.batch_size = batch_size
-		
-	def _compute(self, info=None):
-		return unsupervised_metrics.unsupervised_metrics(self.dataset, self._representation_function,
-		                                                 np.random, self.num_train, self.batch_size)
+		self.discretizer = discretizer
+		self.num_covariance = num_covariance
+		
+		if self.adaptive and num_covariance is not None \
+				and (self.adaptive_score is None or self.adaptive_score.startswith('gaussian')):
+			print(f'WARNING: the gaussian scores of {self.get_name()} use the streamed covariance, which does not depend '
+			      f'on the sample size, so the adaptive sample size is chosen by the mutual_info_score instead')
+			self.adaptive_score = 'mutual_info_score'
+		
+	def _prepare(self, info=None):
+		mus_train, _ = self.sample_codes(self.num_train)
+		cov_mus = None
+		if self.num_covariance is not None:
+			util.set_seed(self._split_seed('covariance'))
+			with self.ground_truth_data() as dataset:
+				cov_mus = metric_utils.streaming_covariance(dataset, self._representation_function,
+				                                            self.num_covariance, np.random,
+				                                            self.batch_size).covariance()
+		return Fit_Job(unsupervised_metrics._compute_unsupervised_metrics, mus_train,
+		               discretizer=self.discretizer, cov_mus=cov_mus, seed=self.seed, samples=[(0,)])
 		
 	def get_scores(self):
 		return ['gaussian_total_correlation', 'gaussian_wasserstein_correlation',
@@ -107,7 +557,11 @@ class UnsupervisedMetrics(Disentanglement_Evaluator):
 
 @fig.Component('metric/modularity-explicitness')
 class ModularityExplicitness(Disentanglement_Evaluator):
-	def __init__(self, A, num_train=None, num_test=None, batch_size=None, **kwargs):
+	supports_torch = True
+	supports_resampling = True
+	
+	def __init__(self, A, num_train=None, num_test=None, batch_size=None, discretizer=None, n_jobs=None,
+	             **kwargs):
 		
 		if num_train is None:
 			num_train = A.pull('num_train', 10000)
@@ -118,22 +572,36 @@ class ModularityExplicitness(Disentanglement_Evaluator):
 		if batch_size is None:
 			batch_size = A.pull('batch_size', 64)
 		
+		if discretizer is None:
+			discretizer = A.pull('discretizer', 'histogram') # or 'quantile'
+		
+		if n_jobs is None:
+			n_jobs = A.pull('n_jobs', 1) # explicitness classifiers fitted in parallel
+		
 		super().__init__(A, **kwargs)
 		
 		self.num_train = num_train
 		self.num_test = num_test
 		self.batch_size = batch_size
+		self.discretizer = discretizer
+		self.n_jobs = n_jobs
 	
-	def _compute(self, info=None):
-		return modularity_explicitness.compute_modularity_explicitness(self.dataset, self._representation_function,
-		                                                 np.random, self.num_train, self.num_test, self.batch_size)
+	def _prepare(self, info=None):
+		mus_train, ys_train = self.sample_codes(self.num_train)
+		mus_test, ys_test = self.sample_codes(self.num_test, split='test')
+		return Fit_Job(modularity_explicitness._compute_modularity_explicitness,
+		               mus_train, ys_train, mus_test, ys_test, discretizer=self.discretizer, n_jobs=self.n_jobs,
+		               seed=self.seed, samples=[(0, 1), (2, 3)])
 	
 	def get_scores(self):
 		return ['modularity_score', 'explicitness_score_train', 'explicitness_score_test']
 
 @fig.Component('metric/sap')
 class SAP(Disentanglement_Evaluator):
-	def __init__(self, A, num_train=None, num_test=None, batch_size=None, continuous_factors=None, **kwargs):
+	supports_resampling = True
+	
+	def __init__(self, A, num_train=None, num_test=None, batch_size=None, continuous_factors=None,
+	             classifier=None, **kwargs):
 		
 		if num_train is None:
 			num_train = A.pull('num_train', 10000)
@@ -144,19 +612,25 @@ class SAP(Disentanglement_Evaluator):
 		if batch_size is None:
 			batch_size = A.pull('batch_size', 64)
 		
-		if continuous_factors:
+		if continuous_factors is None:
 			continuous_factors = A.pull('continuous_factors', False)
 		
+		if classifier is None:
+			classifier = A.pull('classifier', 'threshold') # or 'svm' for the (much slower) linear SVMs
+		
 		super().__init__(A, **kwargs)
 		
 		self.num_train = num_train
 		self.num_test = num_test
 		self.batch_size = batch_size
 		self.continuous_factors = continuous_factors
+		self.classifier = classifier
 	
-	def _compute(self, info=None):
-		return sap.compute_sap(self.dataset, self._representation_function, np.random,
-		                       self.num_train, self.num_test, self.continuous_factors, self.batch_size)
+	def _prepare(self, info=None):
+		mus, ys = self.sample_codes(self.num_train)
+		mus_test, ys_test = self.sample_codes(self.num_test, split='test')
+		return Fit_Job(sap._compute_sap, mus, ys, mus_test, ys_test, self.continuous_factors,
+		               classifier=self.classifier, seed=self.seed, samples=[(0, 1), (2, 3)])
 	
 	def get_scores(self):
 		return ['SAP_score']
@@ -166,6 +640,9 @@ class SAP(Disentanglement_Evaluator):
 
 @fig.Component('metric/irs')
 class IRS(Disentanglement_Evaluator):
+	supports_torch = True
+	supports_resampling = True
+	
 	def __init__(self, A, num_train=None, batch_size=None, diff_quantile=None, **kwargs):
 		
 		if num_train is None:
@@ -183,9 +660,9 @@ class IRS(Disentanglement_Evaluator):
 		self.batch_size = batch_size
 		self.diff_quantile = diff_quantile
 	
-	def _compute(self, info=None):
-		return irs.compute_irs(self.dataset, self._representation_function, np.random,
-		                       self.num_train, self.batch_size, self.diff_quantile)
+	def _prepare(self, info=None):
+		mus, ys = self.sample_codes(self.num_train)
+		return Fit_Job(irs._compute_irs, mus, ys, self.diff_quantile, seed=self.seed, samples=[(0, 1)])
 	
 	def get_scores(self):
 		return ['avg_score', 'num_active_dims', ]
@@ -195,7 +672,9 @@ class IRS(Disentanglement_Evaluator):
 
 @fig.Component('metric/dci')
 class DCI(Disentanglement_Evaluator):
-	def __init__(self, A, num_train=None, num_test=None, batch_size=None, **kwargs):
+	supports_resampling = True
+	
+	def __init__(self, A, num_train=None, num_test=None, batch_size=None, importance=None, n_jobs=None, **kwargs):
 		
 		if num_train is None:
 			num_train = A.pull('num_train', 10000)
@@ -206,15 +685,25 @@ class DCI(Disentanglement_Evaluator):
 		if batch_size is None:
 			batch_size = A.pull('batch_size', 64)
 		
+		if importance is None:
+			importance = A.pull('importance', 'gbt') # see dci.IMPORTANCE_BACKENDS
+		
+		if n_jobs is None:
+			n_jobs = A.pull('n_jobs', 1) # factors fitted in parallel
+		
 		super().__init__(A, **kwargs)
 		
 		self.num_train = num_train
 		self.num_test = num_test
 		self.batch_size = batch_size
+		self.importance = importance # not `backend`, which selects the metric kernels
+		self.n_jobs = n_jobs
 	
-	def _compute(self, info=None):
-		return dci.compute_dci(self.dataset, self._representation_function, np.random,
-		                       self.num_train, self.num_test, self.batch_size)
+	def _prepare(self, info=None):
+		mus_train, ys_train = self.sample_codes(self.num_train)
+		mus_test, ys_test = self.sample_codes(self.num_test, split='test')
+		return Fit_Job(dci._compute_dci, mus_train, ys_train, mus_test, ys_test,
+		               backend=self.importance, n_jobs=self.n_jobs, seed=self.seed, samples=[(0, 1), (2, 3)])
 	
 	def get_scores(self):
 		return ['informativeness_train', 'informativeness_test', 'disentanglement', 'completeness']
@@ -224,7 +713,10 @@ class DCI(Disentanglement_Evaluator):
 
 @fig.Component('metric/mig')
 class MIG(Disentanglement_Evaluator):
-	def __init__(self, A, num_train=None, batch_size=None, **kwargs):
+	supports_torch = True
+	supports_resampling = True
+	
+	def __init__(self, A, num_train=None, batch_size=None, discretizer=None, **kwargs):
 		
 		if num_train is None:
 			num_train = A.pull('num_train', 10000)
@@ -232,14 +724,19 @@ class MIG(Disentanglement_Evaluator):
 		if batch_size is None:
 			batch_size = A.pull('batch_size', 64)
 		
+		if discretizer is None:
+			discretizer = A.pull('discretizer', 'histogram') # or 'quantile'
+		
 		super().__init__(A, **kwargs)
 		
 		self.num_train = num_train
 		self.batch_size = batch_size
+		self.discretizer = discretizer
 	
-	def _compute(self, info=None):
-		return mig.compute_mig(self.dataset, self._representation_function, np.random,
-		                       self.num_train, self.batch_size)
+	def _prepare(self, info=None):
+		mus_train, ys_train = self.sample_codes(self.num_train)
+		return Fit_Job(mig._compute_mig, mus_train, ys_train, discretizer=self.discretizer, seed=self.seed,
+		               samples=[(0, 1)])
 	
 	def get_scores(self):
 		return ['discrete_mig']
@@ -271,8 +768,9 @@ class FactorVAE(Disentanglement_Evaluator):
 		self.batch_size = batch_size
 	
 	def _compute(self, info=None):
-		return metric_factor_vae.compute_factor_vae(self.dataset, self._representation_function, np.random,
-		                       self.batch_size, self.num_train, self.num_test, self.num_variance_estimate)
+		with self.ground_truth_data() as dataset:
+			return metric_factor_vae.compute_factor_vae(dataset, self._representation_function, np.random,
+			                       self.batch_size, self.num_train, self.num_test, self.num_variance_estimate)
 	
 	def get_scores(self):
 		return ['train_accuracy', 'eval_accuracy', 'num_active_dims']
@@ -297,8 +795,9 @@ class BetaVAE(Disentanglement_Evaluator):
 		self.batch_size = batch_size
 	
 	def _compute(self, info=None):
-		return metric_beta_vae.compute_beta_vae_sklearn(self.dataset, self._representation_function, np.random,
-		                       self.num_train, self.num_test, self.batch_size)
+		with self.ground_truth_data() as dataset:
+			return metric_beta_vae.compute_beta_vae_sklearn(dataset, self._representation_function, np.random,
+			                       self.batch_size, self.num_train, self.num_test)
 	
 	def get_scores(self):
 		return ['train_accuracy', 'eval_accuracy']
@@ -323,8 +822,12 @@ class Fairness(Disentanglement_Evaluator):
 		self.batch_size = batch_size
 	
 	def _compute(self, info=None):
-		return fairness.compute_fairness(self.dataset, self._representation_function, np.random,
-		                       self.num_train, self.num_test_points_per_class, self.batch_size)
+		mus_train, ys_train = self.sample_codes(self.num_train)
+		# the codes may come from the cache without drawing anything, so the interventions get their own seed
+		util.set_seed(self._split_seed('interventions'))
+		with self.ground_truth_data() as dataset:
+			return fairness._compute_fairness(dataset, self._representation_function, np.random,
+			                                  mus_train, ys_train, self.num_test_points_per_class, self.batch_size)
 	
 	def get_scores(self):
 		return ['informativeness_train', 'informativeness_test', 'disentanglement', 'completeness']
@@ -407,7 +910,7 @@ class LatentResponses(Disentanglement_Evaluator):
 
 		scales = fullQ.std(0) if self.normalize else None
 		
-		C = np.cov(fullQ.cpu().t().numpy())
+		C = torch_kernels.covariance(fullQ.t()).cpu().numpy()
 		if self.figure_dir is not None:
 			util.plot_mat(C, val_fmt=2)
 			plt.tight_layout()
@@ -479,10 +982,43 @@ class LatentResponses(Disentanglement_Evaluator):
 	
 	
 	
+def _create_cache(A, run, mode):
+	root, meta = None, None
+	if A.pull('store-codes', False): # keep the codes of the run on disk, to be reused by later evaluations
+		ckpt = _checkpoint_hash(run)
+		if ckpt is not None:
+			root = run.get_path() / A.pull('codes-dir', 'codes')
+			meta = {'checkpoint': ckpt, 'mode': mode}
+	return Representation_Cache(root=root, meta=meta)
+
+
+def _checkpoint_hash(run):
+	'''Hash of the files in the checkpoint the model of the run was loaded from (None if unknown).'''
+	ckpt = run.get_config().pull('model._load-ckpt', None, silent=True)
+	if ckpt is None:
+		return None
+	ckpt = Path(ckpt)
+	paths = sorted(ckpt.glob('**/*')) if ckpt.is_dir() else [ckpt]
+	digest = hashlib.md5()
+	for path in paths:
+		if path.is_file():
+			digest.update(path.name.encode())
+			with path.open('rb') as f:
+				for chunk in iter(lambda: f.read(2**20), b''):
+					digest.update(chunk)
+	return digest.hexdigest()
+
+
 @fig.Script('eval-metrics', 'Compute disentanglement metrics of a trained model')
 def _eval_run(A, run=None, metrics=None, mode=None,
               force_run=None, force_save=None, log_stats=unspecified_argument,
-              save_ident=unspecified_argument, pbar=unspecified_argument):
+              save_ident=unspecified_argument, pbar=unspecified_argument, cache=unspecified_argument,
+              fit_pool=unspecified_argument, wait=True):
+	'''
+	Computes all metrics of the run. With a `fit_pool` the fitting stage of the metrics runs in the pool while the
+	following metrics are sampled, and if not `wait`, this returns a function to collect (and save) the results,
+	so the caller can already start with the next run.
+	'''
 	
 	if save_ident is unspecified_argument:
 		save_ident = A.pull('save-ident', None)
@@ -500,17 +1036,32 @@ def _eval_run(A, run=None, metrics=None, mode=None,
 		log_stats = A.pull('log-stats', None)
 	if log_stats is not None and not isinstance(log_stats, str):
 		log_stats = save_ident
+	log_timing = A.pull('log-timing', False)
 	
 	if pbar is unspecified_argument:
 		pbar = A.pull('pbar', None)
 	
+	if cache is unspecified_argument:
+		cache = A.pull('share-codes', True)
+	
+	own_pool = fit_pool is unspecified_argument
+	if own_pool:
+		fit_pool = _create_fit_pool(A)
+	
 	if run is None:
 		run = fig.run('load-run', A)
 	
 	if not force_run and (save_ident is None or run.has_results(save_ident)):
 		print(f'  skipping: {run.get_name()}')
+		if own_pool and fit_pool is not None:
+			fit_pool.shutdown()
 		return
 	
+	if cache is True:
+		cache = _create_cache(A, run, mode)
+	elif cache is False:
+		cache = None
+	
 	if metrics is None:
 		metrics = A.pull('metrics')
 		if '_list' in metrics:
@@ -520,8 +1071,7 @@ def _eval_run(A, run=None, metrics=None, mode=None,
 	model = run.get_model()
 	model.switch_to(mode)
 	
-	scores = {}
-	results = {}
+	outs = {}
 	
 	# if pbar is not None:
 	# 	todo = pbar(todo, total=len(metrics))
@@ -530,28 +1080,183 @@ def _eval_run(A, run=None, metrics=None, mode=None,
 		# 	todo.set_description(name)
 		print(name)
 		metric.set_model(model)
+		metric.set_cache(cache)
 		
-		score, result = metric.compute(run)
-		
-		scores[name] = score
-		results[name] = result
+		job = None if fit_pool is None else metric.prepare(run)
+		outs[name] = metric.compute(run) if job is None else fit_pool.submit(job)
 	
-	if save_ident is not None and (force_save or not run.has_results(save_ident)):
-		run.update_results(save_ident, {'scores': scores, 'results': results})
-	
-	if log_stats:
-		records = run.get_records()
-		records.switch_to(mode)
-		records.set_fmt(f'{mode}/' + '{}')
-		records.set_step(run.get_clock().get_time())
+	def collect():
+		scores = {}
+		results = {}
+		
+		for name, metric in metrics.items():
+			out = outs[name]
+			score, result = metric.collect(out.result()) if isinstance(out, Future) else out
+			
+			scores[name] = score
+			results[name] = result
+		
+		if own_pool and fit_pool is not None:
+			fit_pool.shutdown()
+		
+		if save_ident is not None and (force_save or not run.has_results(save_ident)):
+			run.update_results(save_ident, {'scores': scores, 'results': results})
 		
-		for metric, score in scores.items():
-			for name, val in score.items():
-				if val is not None:
-					records.log('scalar', f'{metric}-{name}', val)
+		if log_stats:
+			records = run.get_records()
+			records.switch_to(mode)
+			records.set_fmt(f'{mode}/' + '{}')
+			records.set_step(run.get_clock().get_time())
+			
+			for metric, score in scores.items():
+				for name, val in score.items():
+					if val is not None:
+						records.log('scalar', f'{metric}-{name}', val)
+			
+			if log_timing:
+				for metric, result in results.items():
+					timing = result.get('timing', {}) if isinstance(result, dict) else {}
+					for phase, stats in timing.items():
+						records.log('scalar', f'{metric}-time-{phase}', stats['wall'])
 		
+		return scores, results
 	
-	return scores, results
+	return collect() if wait else collect
+
+
+def _create_fit_pool(A):
+	'''Process pool to fit metrics while the device is encoding (None if `fit-workers` is 0).'''
+	num_workers = A.pull('fit-workers', 0)
+	if num_workers <= 0:
+		return None
+	ctx = mp.get_context('fork') if 'fork' in mp.get_all_start_methods() else None
+	# forked right away, so create the pool before the models, datasets or metrics touch CUDA or start threads
+	return _start_pool(ProcessPoolExecutor(num_workers, mp_context=ctx), num_workers)
+
+
+def _create_model_batch(A, runs):
+	'''Prepares the models of all `runs` to be evaluated, so they can share all samples of the dataset.'''
+	
+	save_ident = A.pull('save-ident', None)
+	mode = A.pull('mode', 'eval' if save_ident is None else save_ident)
+	force_run = A.pull('force-run', A.pull('force-save', False))
+	
+	batch = Model_Batch()
+	caches = []
+	for run in runs:
+		if not force_run and (save_ident is None or run.has_results(save_ident)):
+			caches.append(None) # will be skipped
+			continue
+		model = run.get_model()
+		model.switch_to(mode)
+		cache = _create_cache(A, run, mode)
+		batch.add(model, cache)
+		caches.append(cache)
+	return caches
+
+
+_worker_state = {} # inherited by the forked workers of eval-multiple-metrics
+
+
+def _pull_metrics(A):
+	metrics = A.pull('metrics', {})
+	if '_list' in metrics:
+		metrics.update({metric.get_name():metric for metric in metrics['_list']})
+		del metrics['_list']
+	return metrics
+
+
+def _start_pool(pool, num_workers):
+	'''Starts the worker processes of `pool` right away instead of at the first job.'''
+	for job in [pool.submit(int) for _ in range(num_workers)]:
+		job.result()
+	return pool
+
+
+def _init_eval_worker(counter, devices, num_threads):
+	with counter.get_lock():
+		idx = counter.value
+		counter.value += 1
+	
+	if num_threads is not None:
+		torch.set_num_threads(num_threads)
+		threadpool_limits(num_threads)
+	
+	if devices is not None and len(devices):
+		device = devices[idx % len(devices)]
+		if str(device).startswith('cuda'):
+			torch.cuda.set_device(device)
+
+
+def _eval_run_worker(name):
+	A = _worker_state['A']
+	with A.silenced(): # each worker creates its own dataset and metrics (after it was forked)
+		if _worker_state['dataset'] is unspecified_argument:
+			_worker_state['dataset'] = A.pull('dataset', None)
+		if _worker_state['metrics'] is unspecified_argument:
+			_worker_state['metrics'] = _pull_metrics(A)
+	metrics, dataset = _worker_state['metrics'], _worker_state['dataset']
+	
+	run = fig.quick_run('load-run', path=name, saveroot=_worker_state['saveroot'],
+	                    override=_worker_state['override'])
+	
+	if dataset is None:
+		for metric in metrics.values():
+			metric.set_dataset(run.get_dataset())
+	
+	with A.silenced():
+		out = _eval_run(A, run=run, metrics=metrics)
+	return run.get_name(), None if out is None else out[0]
+
+
+def _eval_runs_parallel(A, runs, saveroot, override, num_workers, dataset=unspecified_argument,
+                        metrics=unspecified_argument):
+	'''
+	Evaluates the runs in a pool of (forked) worker processes, each with its own device and thread budget.
+	
+	The workers are forked before any run, dataset or metric is loaded in this process (so no CUDA context or thread
+	pool is inherited), and unless they are provided, each worker creates the dataset and metrics itself.
+	'''
+	
+	devices = A.pull('worker-devices', None)
+	if devices is None and torch.cuda.is_available(): # does not initialize CUDA
+		devices = [f'cuda:{i}' for i in range(torch.cuda.device_count())]
+	num_threads = A.pull('worker-threads', max(1, os.cpu_count() // num_workers))
+	
+	save_ident = A.pull('save-ident', None)
+	force_run = A.pull('force-run', A.pull('force-save', False))
+	
+	_worker_state.update({'A': A, 'metrics': metrics, 'dataset': dataset,
+	                      'saveroot': str(saveroot), 'override': override})
+	
+	ctx = mp.get_context('fork')
+	pool = _start_pool(ProcessPoolExecutor(num_workers, mp_context=ctx, initializer=_init_eval_worker,
+	                                       initargs=(ctx.Value('i', 0), devices, num_threads)), num_workers)
+	
+	todo = []
+	with A.silenced():
+		for name in runs:
+			run = fig.quick_run('load-run', path=name, saveroot=str(saveroot), override=override)
+			if not force_run and (save_ident is None or run.has_results(save_ident)):
+				print(f'  skipping: {run.get_name()}')
+			else:
+				todo.append(name)
+	
+	scores = {}
+	print(f'Evaluating {len(todo)} runs with {num_workers} workers')
+	with pool:
+		jobs = {pool.submit(_eval_run_worker, name): name for name in todo}
+		for i, job in enumerate(as_completed(jobs)):
+			try:
+				name, score = job.result()
+			except Exception as e:
+				print(f'Failed: {jobs[job]} ({type(e).__name__}: {e})')
+			else:
+				print(f'Finished: {name} ({i + 1}/{len(todo)})')
+				scores[name] = score
+	
+	_worker_state.clear()
+	return scores
 
 
 @fig.Script('eval-multiple-metrics')
@@ -568,31 +1273,66 @@ def _eval_metrics(A, runs=None, dataset=unspecified_argument, metrics=unspecifie
 		run_name = A.pull('run-name')
 		runs = [run_name]
 	
+	if runs == 'all':
+		runs = list(saveroot.glob('*'))
+	
+	num_workers = A.pull('eval-workers', 0) # number of processes evaluating runs in parallel
+	if num_workers > 0 and 'fork' not in mp.get_all_start_methods():
+		print('WARNING: parallel evaluation requires forking processes, so runs are evaluated serially')
+		num_workers = 0
+	if num_workers > 0: # before the dataset and metrics are created
+		return _eval_runs_parallel(A, runs, saveroot, override, num_workers, dataset=dataset, metrics=metrics)
+	
+	fit_pool = _create_fit_pool(A)
+	
 	if dataset is unspecified_argument:
 		dataset = A.pull('dataset', None)
 	
 	if metrics is unspecified_argument:
-		metrics = A.pull('metrics', {})
-		if '_list' in metrics:
-			metrics.update({metric.get_name():metric for metric in metrics['_list']})
-			del metrics['_list']
-			
-	if runs == 'all':
-		runs = list(saveroot.glob('*'))
-		
+		metrics = _pull_metrics(A)
+	
+	model_batch = A.pull('model-batch', 1) # number of models that are encoding the same samples
+	if model_batch > 1 and (dataset is None or not A.pull('share-codes', True)):
+		print('WARNING: model-batch requires a shared dataset and share-codes, so models are evaluated one at a time')
+		model_batch = 1
+	
+	pending = None # with a fit pool, the results of the previous run are collected once the next run is sampled
+	
+	scores = {}
 	with A.silenced():
 	
-		for i, name in enumerate(runs):
-			
-			run = fig.quick_run('load-run', path=name, saveroot=str(saveroot), override=override)
+		for start in range(0, len(runs), model_batch):
 			
-			print(f'Running: {run.get_name()} ({i + 1}/{len(runs)})')
+			group = [fig.quick_run('load-run', path=name, saveroot=str(saveroot), override=override)
+			         for name in runs[start:start+model_batch]]
 			
-			if dataset is None:
-				for metric in metrics.values():
-					metric.set_dataset(run.get_dataset())
+			caches = [unspecified_argument] * len(group)
+			if model_batch > 1:
+				caches = _create_model_batch(A, group)
 			
-			_eval_run(A, run=run, metrics=metrics)
+			for i, (run, cache) in enumerate(zip(group, caches)):
+				
+				print(f'Running: {run.get_name()} ({start + i + 1}/{len(runs)})')
+				
+				if dataset is None:
+					for metric in metrics.values():
+						metric.set_dataset(run.get_dataset())
+				
+				if fit_pool is None: # collected right away, so no finished results are lost if a later run fails
+					out = _eval_run(A, run=run, metrics=metrics, cache=cache, fit_pool=None)
+					if out is not None:
+						scores[run.get_name()] = out[0]
+					continue
+				
+				collect = _eval_run(A, run=run, metrics=metrics, cache=cache, fit_pool=fit_pool, wait=False)
+				if pending is not None:
+					scores[pending[0]] = pending[1]()[0]
+				pending = None if collect is None else (run.get_name(), collect)
+		
+		if pending is not None:
+			scores[pending[0]] = pending[1]()[0]
+		if fit_pool is not None:
+			fit_pool.shutdown()
 			#
 			# path = root / name
 			#
@@ -606,3 +1346,5 @@ def _eval_metrics(A, runs=None, dataset=unspecified_argument, metrics=unspecifie
 			#
 			# 	print(f'Running: {run.get_name()} ({i+1}/{len(runs)})')
 			# 	_eval_run(A, run=run, metrics=metrics)
+	
+	return scores
@@ -6,6 +6,10 @@ import torch.nn as nn
 import torch.nn.functional as F
 import torch.distributions as distrib
 
+from pathlib import Path
+import tempfile
+import h5py as hf
+
 import numpy as np
 import matplotlib.pyplot as plt
 
@@ -29,6 +33,7 @@ from omnilearn import util
 from omnilearn.models.unsup import Autoencoder as SimpleAutoencoder, Generative_AE, Variational_Autoencoder, Wasserstein_Autoencoder
 from omnilearn import viz as viz_util
 from omnilearn.data.collectors import MissingFIDStatsError
+from omnilearn.eval.fid import apply_inception
 # from foundation import train as trn
 
 # if 'FOUNDATION_RUN_MODE' in os.environ and os.environ['FOUNDATION_RUN_MODE'] == 'jupyter':
@@ -36,6 +41,9 @@ from omnilearn.data.collectors import MissingFIDStatsError
 # else:
 from tqdm import tqdm
 
+from .metrics.metric_utils import StreamingCovariance
+from .metrics.kid import kernel_inception_distance
+
 # import encoders
 # import pointnets
 # from . import transfer, visualizations as viz_util
@@ -44,6 +52,65 @@ MY_PATH = os.path.dirname(os.path.abspath(__file__))
 
 
 
+def _fid_stats_path(dataset):
+	'''File of the FID reference stats of `dataset` (as used by `get_fid_stats`), None if it has no root.'''
+	root = getattr(dataset, 'root', None)
+	if root is None:
+		return None
+	ident = getattr(dataset, 'fid_ident', None)
+	return Path(root) / ('fid_stats.h5' if ident is None else f'{ident}_fid_stats.h5')
+
+
+def _fid_reference_mode(dataset, dim):
+	'''Split of the FID reference stats of `dataset`: the current mode if it has stats, otherwise train.'''
+	mode = dataset.get_mode()
+	path = _fid_stats_path(dataset)
+	if path is not None and path.is_file():
+		with hf.File(path, 'r') as f:
+			if f'{mode}_{dim}_mu' in f:
+				return mode
+	return 'train'
+
+
+def _kid_reference_path(dataset, mode, dim):
+	'''File of the KID reference features of `dataset` (next to the FID stats), None if it has no root.'''
+	path = _fid_stats_path(dataset)
+	if path is None:
+		return None
+	return path.with_name(path.name.replace('fid_stats.h5', f'kid_features_{mode}_{dim}.npy'))
+
+
+def _load_kid_reference(dataset, mode, dim, num):
+	'''First `num` stored reference features of the KID (None if fewer are stored).'''
+	path = _kid_reference_path(dataset, mode, dim)
+	if path is None or not path.is_file():
+		return None
+	features = np.load(str(path), mmap_mode='r')
+	if len(features) < num:
+		return None
+	return torch.from_numpy(np.array(features[:num]))
+
+
+def _store_kid_reference(dataset, mode, dim, features):
+	'''
+	Stores the reference features of the KID in their own file (the FID stats are never modified). The file is
+	written to a temporary file first and then replaced at once, so concurrent evaluations never see a partial file.
+	'''
+	path = _kid_reference_path(dataset, mode, dim)
+	if path is None:
+		return
+	tmp = None
+	try:
+		with tempfile.NamedTemporaryFile(dir=path.parent, prefix=f'.{path.name}.', delete=False) as f:
+			tmp = f.name
+			np.save(f, features.numpy())
+		os.replace(tmp, path)
+	except OSError as e:
+		print(f'Failed to store the KID reference features in {path}: {e}')
+		if tmp is not None and os.path.exists(tmp):
+			os.remove(tmp)
+
+
 # region Algorithms
 
 @fig.Component('ae')
@@ -57,12 +124,62 @@ class Autoencoder(SimpleAutoencoder):
 		if A.pull('force-viz', False):
 			self._viz_settings.add('force')
 
+	def _compute_fid_stats(self, fid, sources, out, features=None, num_features=None, references=None):
+		'''
+		Computes the inception statistics of all `sources` (name -> generate_fn) without stats in `out` in a single
+		pass: each round draws a batch from every source and the concatenated batch goes through the inception model
+		at once, while the mean and covariance of each source are accumulated separately.
+		
+		The features of the first `num_features` samples (all by default) of the sources in `features` (name -> list)
+		are also kept (on the cpu), e.g. for the KID. The `references` (name -> generate_fn, each also in `features`)
+		only contribute their features to the same pass, and no statistics.
+		'''
+		
+		if features is None:
+			features = {}
+		if references is None:
+			references = {}
+		pending = {name: generate_fn for name, generate_fn in sources.items()
+		           if f'{name}_fid_stats' not in out or name in features}
+		pending.update(references)
+		if not len(pending):
+			return out
+		
+		fid._load_inception()
+		stats = {name: StreamingCovariance() for name in pending
+		         if name not in references and f'{name}_fid_stats' not in out}
+		
+		print(f'Computing {", ".join(pending)} inception features')
+		
+		j = 0
+		while j < fid.n_samples:
+			N = min(fid.batch_size, fid.n_samples - j)
+			keep = N if num_features is None else min(N, num_features - j)
+			active = [name for name in pending if name in stats or (name in features and keep > 0)]
+			if not len(active):
+				break
+			samples = torch.cat([pending[name](N) for name in active])
+			pred = apply_inception(samples, fid.inception).view(len(samples), -1)
+			for name, feats in zip(active, pred.split(N)):
+				if name in stats:
+					stats[name].update(feats)
+				if name in features and keep > 0:
+					features[name].append(feats[:keep].float().cpu())
+			j += N
+		
+		for name, acc in stats.items():
+			out[f'{name}_fid_stats'] = acc.mean, acc.covariance()
+		for name, feats in features.items():
+			if isinstance(feats, list):
+				features[name] = torch.cat(feats) if len(feats) else None
+		return out
+	
 	def _compute_fid(self, fid, generate_fn, name, out):
 		
 		statkey = f'{name}_fid_stats'
 		
 		if statkey not in out:
-			out[statkey] = fid.compute_stats(generate_fn, name=name)
+			self._compute_fid_stats(fid, {name: generate_fn}, out)
 		stats = out[statkey]
 		
 		key = f'{name}_fid'
@@ -80,6 +197,30 @@ class Autoencoder(SimpleAutoencoder):
 		
 		dist = out[key]
 		return dist
+	
+	def _compute_kid(self, name, features, reference, out, **kwargs):
+		
+		key = f'{name}_kid'
+		
+		if key not in out:
+			dist, std = kernel_inception_distance(features, reference, **kwargs)
+			self.register_stats(key)
+			self.mete(key, dist)
+			out[key], out[f'{key}_std'] = dist, std
+			print(f'{name.capitalize()} KID: {dist:.4f} +/- {std:.4f}')
+		
+		return out[key]
+	
+	def _fid_sources(self, info, config):
+		'''Generators (name -> generate_fn) evaluated with the FID, extended by the generative modifiers.'''
+		sources = {}
+		if not config.pull('skip-rec-fid', False):
+			loader = info.get_loader(infinite=True)
+			def _rec_gen(N):
+				img = self._process_batch(loader.demand(N)).original
+				return self(img)
+			sources['rec'] = _rec_gen
+		return sources
 		
 	def _evaluate(self, info, config, out=None):
 		
@@ -97,15 +238,43 @@ class Autoencoder(SimpleAutoencoder):
 				print(e)
 			else:
 				fid.set_baseline_stats(base_stats)
-		
-		if not config.pull('skip-rec-fid', False) and fid is not None:
-			loader = info.get_loader(infinite=True)
-			def _rec_gen(N):
-				img = self._process_batch(loader.demand(N)).original
-				return self(img)
 			
-			self._compute_fid(fid, generate_fn=_rec_gen, name='rec', out=out)
+			sources = self._fid_sources(info, config)
+			
+			kid = config.pull('kid', False) # unbiased kernel distance (also from the shared inception pass)
+			features, references, reference, kid_samples = {}, {}, None, None
+			if kid:
+				kid_samples = min(config.pull('kid-samples', 10000), fid.n_samples) # features kept per source
+				kid_args = {'num_subsets': config.pull('kid-subsets', 100),
+				            'subset_size': config.pull('kid-subset-size', 1000),
+				            'block_size': config.pull('kid-block-size', 1024),
+				            'random_state': np.random.RandomState(config.pull('kid-seed', 0))}
+				
+				features = {name: [] for name in sources if f'{name}_kid' not in out}
+				
+				ref_mode = _fid_reference_mode(dataset, fid.dim) # same split as the FID reference stats
+				if len(features):
+					reference = _load_kid_reference(dataset, ref_mode, fid.dim, kid_samples)
+				if len(features) and reference is None: # the reference features are computed in the same pass
+					mode = dataset.get_mode()
+					ref_loader = dataset.get_loader(mode=ref_mode, infinite=True)
+					dataset.switch_to(mode)
+					def _ref_gen(N):
+						return self._process_batch(ref_loader.demand(N)).original
+					references['reference'] = _ref_gen
+					features['reference'] = []
+			
+			self._compute_fid_stats(fid, sources, out, features=features, num_features=kid_samples, # one shared pass
+			                        references=references)
+			for name, generate_fn in sources.items():
+				self._compute_fid(fid, generate_fn, name=name, out=out)
 			
+			if len(features):
+				if 'reference' in features:
+					reference = features.pop('reference')
+					_store_kid_reference(dataset, ref_mode, fid.dim, reference)
+				for name, feats in features.items():
+					self._compute_kid(name, feats, reference, out, **kid_args)
 		
 		return out
 
@@ -203,18 +372,11 @@ class Hybrid(Autoencoder, Generative_AE):
 		if viz_gen_hybrid:
 			self._viz_settings.add('gen-hybrid')
 	
-	def _evaluate(self, info, config, out=None):
-		
-		out = super()._evaluate(info, config, out=out)
-		
+	def _fid_sources(self, info, config):
+		sources = super()._fid_sources(info, config)
 		if not config.pull('skip-hyb-fid', False):
-		
-			fid = config.pull('fid', None, ref=True, silent=True)
-			if fid is not None:
-				self._compute_fid(fid, self.generate_hybrid,
-				                  name='hyb-grp' if self.hybridize_groups else 'hybrid', out=out)
-	
-		return out
+			sources['hyb-grp' if self.hybridize_groups else 'hybrid'] = self.generate_hybrid
+		return sources
 	
 	def _visualize(self, info, records):
 		settings = self._viz_settings
@@ -291,15 +453,10 @@ class Prior(Autoencoder, Generative_AE):
 		if viz_gen_prior:
 			self._viz_settings.add('gen-prior')
 	
-	def _evaluate(self, info, config, out=None):
-		
-		out = super()._evaluate(info, config, out=out)
-		
-		fid = config.pull('fid', None, ref=True, silent=True)
-		if fid is not None:
-			self._compute_fid(fid, self.generate_prior, name='prior', out=out)
-		
-		return out
+	def _fid_sources(self, info, config):
+		sources = super()._fid_sources(info, config)
+		sources['prior'] = self.generate_prior
+		return sources
 	
 	def _visualize(self, info, records):
 		settings = self._viz_settings
@@ -0,0 +1,225 @@
+"""Bootstrap confidence intervals of the metric scores.
+
+The scores are resampled from a single sample of codes (and factors) instead of
+rerunning the metric on new samples. All resamples are drawn at once as
+(num_resamples, num_points) index sets. The metrics based on the discrete
+mutual information (MIG, modularity, unsupervised) evaluate all resamples
+together, using the number of times each point was drawn as the weights of
+the joint histograms. The remaining metrics are recomputed on each resample.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import collections
+from . import metric_utils as utils
+from . import mig
+from . import modularity_explicitness
+from . import unsupervised_metrics
+import numpy as np
+import torch
+
+
+def bootstrap_indices(num_points, num_resamples, random_state):
+  """All resamples of num_points points, (num_resamples, num_points)."""
+  return random_state.randint(num_points, size=(num_resamples, num_points))
+
+
+def bootstrap_weights(indices, num_points):
+  """Number of times each point is drawn in each resample."""
+  num_resamples = len(indices)
+  offsets = (np.arange(num_resamples) * num_points)[:, np.newaxis]
+  counts = np.bincount((indices + offsets).ravel(),
+                       minlength=num_resamples * num_points)
+  return counts.reshape(num_resamples, num_points)
+
+
+def weighted_discrete_mutual_info(mus, ys, weights, chunk_size=2**24):
+  """Discrete mutual information of every resample at once.
+  Args:
+    mus: Discrete codes (num_codes, num_points).
+    ys: Discrete factors (num_factors, num_points).
+    weights: Weights of the points in each resample (num_resamples,
+      num_points), see `bootstrap_weights`.
+    chunk_size: Maximum number of entries (resamples x codes x points) per
+      block.
+  Returns:
+    Mutual information matrices (num_resamples, num_codes, num_factors).
+  """
+  num_codes, num_points = mus.shape
+  num_factors = ys.shape[0]
+  num_resamples = len(weights)
+  ys, num_ys = utils._label_encode(ys)
+  m = np.zeros([num_resamples, num_codes, num_factors])
+  block = max(1, chunk_size // max(num_resamples * num_points, 1))
+  for start in range(0, num_codes, block):
+    codes, num_mus = utils._label_encode(mus[start:start + block])
+    num = len(codes)
+    size = num_mus * num_ys
+    offsets = (np.arange(num_resamples * num) * size).reshape(
+        num_resamples, num, 1)
+    codes = codes * num_ys + offsets
+    block_weights = np.broadcast_to(weights[:, np.newaxis],
+                                    codes.shape).ravel()
+    for j in range(num_factors):
+      counts = np.bincount((codes + ys[j]).ravel(), weights=block_weights,
+                           minlength=num_resamples * num * size)
+      m[:, start:start + num, j] = utils._mutual_info_from_counts(
+          counts.reshape(num_resamples, num, num_mus, num_ys))
+  return m
+
+
+def weighted_discrete_entropy(ys, weights):
+  """Discrete entropy of each factor in every resample (num_resamples,
+  num_factors)."""
+  num_factors, num_points = ys.shape
+  num_resamples = len(weights)
+  ys, num_ys = utils._label_encode(ys)
+  offsets = (np.arange(num_resamples * num_factors) * num_ys).reshape(
+      num_resamples, num_factors, 1)
+  index = ys + offsets
+  counts = np.bincount(index.ravel(),
+                       weights=np.broadcast_to(weights[:, np.newaxis],
+                                               index.shape).ravel(),
+                       minlength=num_resamples * num_factors * num_ys)
+  counts = counts.reshape(num_resamples, num_factors, num_ys)
+  total = counts.sum(-1)
+  with np.errstate(divide="ignore", invalid="ignore"):
+    terms = np.where(counts > 0, counts * np.log(counts), 0.)
+  return np.clip(np.log(total) - terms.sum(-1) / total, 0., None)
+
+
+def weighted_covariance(x, weights):
+  """Unbiased covariance of the rows of x (num_codes, num_points) in every
+  resample (num_resamples, num_codes, num_codes)."""
+  num_points = x.shape[1]
+  centered = x - x.mean(1, keepdims=True)
+  means = weights @ centered.T / num_points
+  second = np.einsum("bn,dn,en->bde", weights, centered, centered,
+                     optimize=True)
+  return (second - num_points * means[:, :, np.newaxis]
+          * means[:, np.newaxis, :]) / (num_points - 1)
+
+
+def _bootstrap_mig(indices, mus_train, ys_train, discretizer="histogram"):
+  """Bootstrap estimates of `mig._compute_mig`."""
+  weights = bootstrap_weights(indices[0], mus_train.shape[1])
+  # The bins are fixed by the full sample.
+  discretized_mus = utils.make_discretizer(mus_train,
+                                           discretizer_fn=discretizer)
+  m = weighted_discrete_mutual_info(discretized_mus, ys_train, weights)
+  entropy = weighted_discrete_entropy(ys_train, weights)
+  sorted_m = np.sort(m, axis=1)
+  return {"discrete_mig": np.mean(
+      (sorted_m[:, -1, :] - sorted_m[:, -2, :]) / entropy, axis=-1)}
+
+
+def _bootstrap_unsupervised(indices, mus_train, discretizer="histogram",
+                            cov_mus=None):
+  """Bootstrap estimates of `unsupervised_metrics._compute_unsupervised_metrics`
+  (only the mutual information score if the covariance is given)."""
+  num_codes = mus_train.shape[0]
+  weights = bootstrap_weights(indices[0], mus_train.shape[1])
+  scores = {}
+  if cov_mus is None:
+    cov = weighted_covariance(mus_train.astype(np.float64), weights)
+    diag = np.diagonal(cov, axis1=1, axis2=2)
+    scores["gaussian_total_correlation"] = 0.5 * (
+        np.sum(np.log(diag), -1) - np.linalg.slogdet(cov)[1])
+    # Trace of sqrtm(cov * diag) from the eigenvalues of the similar
+    # symmetric matrix D^1/2 cov D^1/2.
+    scale = np.sqrt(diag)
+    eigenvalues = np.linalg.eigvalsh(cov * scale[:, :, np.newaxis]
+                                     * scale[:, np.newaxis, :])
+    trace = diag.sum(-1)
+    scores["gaussian_wasserstein_correlation"] = 2 * trace - 2 * np.sum(
+        np.sqrt(np.clip(eigenvalues, 0., None)), -1)
+    scores["gaussian_wasserstein_correlation_norm"] = (
+        scores["gaussian_wasserstein_correlation"] / trace)
+
+  mus_discrete = utils.make_discretizer(mus_train, discretizer_fn=discretizer)
+  m = weighted_discrete_mutual_info(mus_discrete, mus_discrete, weights)
+  m[:, np.arange(num_codes), np.arange(num_codes)] = 0
+  scores["mutual_info_score"] = m.sum((1, 2)) / (num_codes**2 - num_codes)
+  return scores
+
+
+def _bootstrap_modularity_explicitness(indices, mus_train, ys_train, mus_test,
+                                       ys_test, discretizer="histogram",
+                                       n_jobs=1):
+  """Bootstrap estimates of
+  `modularity_explicitness._compute_modularity_explicitness`, the modularity
+  is computed for all resamples at once."""
+  weights = bootstrap_weights(indices[0], mus_train.shape[1])
+  discretized_mus = utils.make_discretizer(mus_train,
+                                           discretizer_fn=discretizer)
+  m = weighted_discrete_mutual_info(discretized_mus, ys_train, weights)
+  scores = collections.defaultdict(list)
+  scores["modularity_score"] = modularity_explicitness.modularity(m)
+  test = indices[1] if len(indices) > 1 else indices[0]
+  for train_idx, test_idx in zip(indices[0], test):
+    mus, ys = mus_train[:, train_idx], ys_train[:, train_idx]
+    mus_norm, mean_mus, stddev_mus = utils.normalize_data(mus)
+    mus_test_norm, _, _ = utils.normalize_data(mus_test[:, test_idx], mean_mus,
+                                               stddev_mus)
+    explicitness = [modularity_explicitness.explicitness_per_factor(
+        mus_norm, ys[i], mus_test_norm, ys_test[i, test_idx])
+                    for i in range(ys.shape[0])]
+    train, test_scores = np.mean(explicitness, axis=0)
+    scores["explicitness_score_train"].append(train)
+    scores["explicitness_score_test"].append(test_scores)
+  return scores
+
+
+VECTORIZED = {
+  mig._compute_mig: _bootstrap_mig,
+  unsupervised_metrics._compute_unsupervised_metrics: _bootstrap_unsupervised,
+  modularity_explicitness._compute_modularity_explicitness:
+    _bootstrap_modularity_explicitness,
+}
+
+
+def bootstrap_scores(fn, args, kwargs, samples, num_resamples, random_state,
+                     confidence=0.95):
+  """Bootstrap distribution of every scalar score of fn(*args, **kwargs).
+  Args:
+    fn: Function computing the scores of a metric from samples of codes (e.g.
+      `mig._compute_mig`).
+    args: Positional arguments of fn, containing the samples.
+    kwargs: Keyword arguments of fn.
+    samples: Positions in args of the arrays (num_*, num_points) of each
+      independent sample, e.g. [(0, 1), (2, 3)] for the codes and factors of
+      the training and the test set. The arrays of a sample are resampled
+      with the same indices, different samples independently.
+    num_resamples: Number of bootstrap resamples.
+    random_state: Numpy random state used for randomness.
+    confidence: Coverage of the percentile intervals.
+  Returns:
+    Dictionary with the mean, standard deviation and percentile interval of
+      the resampled estimates of each score (keyed by the score).
+  """
+  indices = [bootstrap_indices(args[positions[0]].shape[1], num_resamples,
+                               random_state) for positions in samples]
+  vectorized = VECTORIZED.get(fn)
+  if vectorized is not None:
+    estimates = vectorized(indices, *[utils._to_numpy(arg) for arg in args],
+                           **kwargs)
+  else:
+    estimates = collections.defaultdict(list)
+    for b in range(num_resamples):
+      resampled = list(args)
+      for positions, idx in zip(samples, indices):
+        for i in positions:
+          resampled[i] = args[i][:, idx[b]]
+      for key, val in fn(*resampled, **kwargs).items():
+        if np.ndim(val) == 0:
+          estimates[key].append(float(val))
+
+  tail = (1 - confidence) / 2 * 100
+  summary = {}
+  for key, values in estimates.items():
+    values = np.asarray(values, dtype=np.float64)
+    low, high = np.nanpercentile(values, [tail, 100 - tail])
+    summary[key] = {"mean": float(np.nanmean(values)),
+                    "std": float(np.nanstd(values)),
+                    "interval": [float(low), float(high)]}
+  return summary
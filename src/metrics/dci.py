@@ -22,12 +22,19 @@ Representations" (https://openreview.net/forum?id=By-7dz-AZ).
 from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
+import functools
 from absl import logging
 from . import metric_utils as utils
 import numpy as np
 import scipy
 from six.moves import range
+from joblib import Parallel, delayed
 from sklearn.ensemble import GradientBoostingClassifier
+from sklearn.ensemble import HistGradientBoostingClassifier
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.inspection import permutation_importance
+from sklearn.linear_model import Lasso
+from sklearn.linear_model import SGDClassifier
 
 
 
@@ -64,11 +71,12 @@ def compute_dci(ground_truth_data, representation_function, random_state,
   return scores
 
 
-def _compute_dci(mus_train, ys_train, mus_test, ys_test):
+def _compute_dci(mus_train, ys_train, mus_test, ys_test, backend="gbt",
+                 n_jobs=1):
   """Computes score based on both training and testing codes and factors."""
   scores = {}
-  importance_matrix, train_err, test_err = compute_importance_gbt(
-      mus_train, ys_train, mus_test, ys_test)
+  importance_matrix, train_err, test_err = compute_importance(
+      mus_train, ys_train, mus_test, ys_test, backend=backend, n_jobs=n_jobs)
   assert importance_matrix.shape[0] == mus_train.shape[0]
   assert importance_matrix.shape[1] == ys_train.shape[0]
   scores["informativeness_train"] = train_err
@@ -83,19 +91,111 @@ def _compute_dci(mus_train, ys_train, mus_test, ys_test):
 
 def compute_importance_gbt(x_train, y_train, x_test, y_test):
   """Compute importance based on gradient boosted trees."""
+  return compute_importance(x_train, y_train, x_test, y_test, backend="gbt")
+
+
+def compute_importance(x_train, y_train, x_test, y_test, backend="gbt",
+                       n_jobs=1):
+  """Compute importance of each code for each factor with the given backend.
+
+  Args:
+    x_train: Codes (num_codes, num_train).
+    y_train: Factors (num_factors, num_train).
+    x_test: Codes (num_codes, num_test).
+    y_test: Factors (num_factors, num_test).
+    backend: Key of IMPORTANCE_BACKENDS.
+    n_jobs: Number of factors fitted in parallel (with joblib), for the random
+      forest the trees of each factor are fitted in parallel instead.
+
+  Returns:
+    Importance matrix (num_codes, num_factors), mean train and test accuracy.
+  """
+  fit_fn = IMPORTANCE_BACKENDS[backend]
+  if backend == "random-forest":
+    fit_fn, n_jobs = functools.partial(fit_fn, n_jobs=n_jobs), 1
   num_factors = y_train.shape[0]
-  num_codes = x_train.shape[0]
-  importance_matrix = np.zeros(shape=[num_codes, num_factors],
-                               dtype=np.float64)
-  train_loss = []
-  test_loss = []
-  for i in range(num_factors):
-    model = GradientBoostingClassifier()
-    model.fit(x_train.T, y_train[i, :])
-    importance_matrix[:, i] = np.abs(model.feature_importances_)
-    train_loss.append(np.mean(model.predict(x_train.T) == y_train[i, :]))
-    test_loss.append(np.mean(model.predict(x_test.T) == y_test[i, :]))
-  return importance_matrix, np.mean(train_loss), np.mean(test_loss)
+  # Seeds are drawn up front, so the result does not depend on n_jobs.
+  seeds = np.random.randint(2**31, size=num_factors)
+  with utils.timed_phase("fit"):
+    if n_jobs == 1:
+      out = [fit_fn(x_train.T, y_train[i, :], x_test.T, y_test[i, :], seeds[i])
+             for i in range(num_factors)]
+    else:
+      out = Parallel(n_jobs=n_jobs)(
+          delayed(fit_fn)(x_train.T, y_train[i, :], x_test.T, y_test[i, :],
+                          seeds[i]) for i in range(num_factors))
+  importance_matrix = np.stack([importance for importance, _, _ in out], 1)
+  train_loss = [train for _, train, _ in out]
+  test_loss = [test for _, _, test in out]
+  return importance_matrix.astype(np.float64), np.mean(train_loss), \
+    np.mean(test_loss)
+
+
+def _accuracies(model, x_train, y_train, x_test, y_test):
+  return np.mean(model.predict(x_train) == y_train), \
+    np.mean(model.predict(x_test) == y_test)
+
+
+def _importance_gbt(x_train, y_train, x_test, y_test, seed):
+  """Gradient boosted trees (impurity importance)."""
+  model = GradientBoostingClassifier(random_state=seed)
+  model.fit(x_train, y_train)
+  return (np.abs(model.feature_importances_),) + \
+    _accuracies(model, x_train, y_train, x_test, y_test)
+
+
+def _importance_hist_gbt(x_train, y_train, x_test, y_test, seed):
+  """Histogram-based gradient boosting (permutation importance on train)."""
+  model = HistGradientBoostingClassifier(random_state=seed)
+  model.fit(x_train, y_train)
+  importance = permutation_importance(model, x_train, y_train, n_repeats=5,
+                                      random_state=seed).importances_mean
+  return (np.clip(importance, 0., None),) + \
+    _accuracies(model, x_train, y_train, x_test, y_test)
+
+
+def _importance_random_forest(x_train, y_train, x_test, y_test, seed,
+                              n_jobs=1):
+  """Random forest (impurity importance), trees are fitted with n_jobs."""
+  model = RandomForestClassifier(n_estimators=100, min_samples_leaf=5,
+                                 n_jobs=n_jobs, random_state=seed)
+  model.fit(x_train, y_train)
+  return (np.abs(model.feature_importances_),) + \
+    _accuracies(model, x_train, y_train, x_test, y_test)
+
+
+def _importance_l1_logistic(x_train, y_train, x_test, y_test, seed):
+  """L1 regularized logistic regression (mean abs coefficient over classes)."""
+  mean, std = x_train.mean(0), x_train.std(0) + 1e-8
+  x_train, x_test = (x_train - mean) / std, (x_test - mean) / std
+  # one-vs-rest, with the regularization of C=0.1 (alpha = 1 / (C * n))
+  model = SGDClassifier(loss="log_loss", penalty="l1",
+                        alpha=10. / len(x_train), random_state=seed)
+  model.fit(x_train, y_train)
+  importance = np.abs(model.coef_).mean(0)
+  return (importance,) + _accuracies(model, x_train, y_train, x_test, y_test)
+
+
+def _importance_lasso(x_train, y_train, x_test, y_test, seed):
+  """Lasso regression of the factor (abs coefficient), predictions rounded."""
+  mean, std = x_train.mean(0), x_train.std(0) + 1e-8
+  x_train, x_test = (x_train - mean) / std, (x_test - mean) / std
+  model = Lasso(alpha=0.01, random_state=seed)
+  model.fit(x_train, y_train)
+  low, high = y_train.min(), y_train.max()
+  def accuracy(x, y):
+    return np.mean(np.clip(np.rint(model.predict(x)), low, high) == y)
+  return np.abs(model.coef_), accuracy(x_train, y_train), \
+    accuracy(x_test, y_test)
+
+
+IMPORTANCE_BACKENDS = {
+    "gbt": _importance_gbt,
+    "hist-gbt": _importance_hist_gbt,
+    "random-forest": _importance_random_forest,
+    "l1-logistic": _importance_l1_logistic,
+    "lasso": _importance_lasso,
+}
 
 
 def disentanglement_per_code(importance_matrix):
@@ -57,44 +57,51 @@ def compute_fairness(ground_truth_data,
   Returns:
     Dictionary with scores.
   """
-  factor_counts = ground_truth_data.factors_num_values
-  num_factors = len(factor_counts)
-
-  scores = {}
   # Training a predictive model.
   mus_train, ys_train = utils.generate_batch_factor_code(
       ground_truth_data, representation_function, num_train, random_state,
       batch_size)
+  return _compute_fairness(ground_truth_data, representation_function,
+                           random_state, mus_train, ys_train,
+                           num_test_points_per_class, batch_size)
+
+
+def _compute_fairness(ground_truth_data, representation_function,
+                      random_state, mus_train, ys_train,
+                      num_test_points_per_class, batch_size=16):
+  """Computes unfairness scores given the codes used to train the predictors."""
+  # the dataset may provide the number of values (and factors) as tensors
+  factor_counts = np.asarray(utils._to_numpy(  # pylint: disable=protected-access
+      ground_truth_data.factors_num_values), dtype=np.int64)
+  num_factors = len(factor_counts)
+
+  scores = {}
   predictor_model_fn = utils.gradient_boosting_classifier
 
   # For each factor train a single predictive model.
-  mean_fairness = np.zeros((num_factors, num_factors), dtype=np.float64)
-  max_fairness = np.zeros((num_factors, num_factors), dtype=np.float64)
+  models = []
   for i in range(num_factors):
     model = predictor_model_fn()
-    model.fit(np.transpose(mus_train), ys_train[i, :])
+    with utils.timed_phase("fit"):
+      model.fit(np.transpose(mus_train), ys_train[i, :])
+    models.append(model)
 
-    for j in range(num_factors):
+  mean_fairness = np.zeros((num_factors, num_factors), dtype=np.float64)
+  max_fairness = np.zeros((num_factors, num_factors), dtype=np.float64)
+  for j in range(num_factors):
+    # The intervened representations do not depend on the predicted factor,
+    # so they are computed once for all values c of the sensitive attribute.
+    representations, groups = _intervened_representations(
+        ground_truth_data, representation_function, random_state, j,
+        factor_counts[j], num_test_points_per_class, batch_size)
+    for i in range(num_factors):
       if i == j:
         continue
-      # Sample a random set of factors once.
-      original_factors = ground_truth_data.sample_factors(
-          num_test_points_per_class, random_state)
-      counts = np.zeros((factor_counts[i], factor_counts[j]), dtype=np.int64)
-      for c in range(factor_counts[j]):
-        # Intervene on the sensitive attribute.
-        intervened_factors = np.copy(original_factors)
-        intervened_factors[:, j] = c
-        # Obtain the batched observations.
-        observations = ground_truth_data.sample_observations_from_factors(
-            intervened_factors, random_state)
-        representations = utils.obtain_representation(observations,
-                                                      representation_function,
-                                                      batch_size)
-        # Get the predictions.
-        predictions = model.predict(np.transpose(representations))
-        # Update the counts.
-        counts[:, c] = np.bincount(predictions, minlength=factor_counts[i])
+      predictions = models[i].predict(representations).astype(np.int64)
+      # counts[p, c]: number of predictions p for the intervention value c.
+      counts = np.bincount(predictions * factor_counts[j] + groups,
+                           minlength=factor_counts[i] * factor_counts[j])
+      counts = counts.reshape(factor_counts[i], factor_counts[j])
       mean_fairness[i, j], max_fairness[i, j] = inter_group_fairness(counts)
 
   # Report the scores.
@@ -103,6 +110,31 @@ def compute_fairness(ground_truth_data,
   return scores
 
 
+def _intervened_representations(ground_truth_data, representation_function,
+                                random_state, sensitive_factor, num_values,
+                                num_points, batch_size=16):
+  """Encodes a random set of factors with every possible intervention on the
+  sensitive factor.
+  Returns:
+    representations: (num_values * num_points, num_codes) numpy array.
+    groups: Value of the sensitive factor for each representation.
+  """
+  # Sample a random set of factors once.
+  original_factors = np.asarray(utils._to_numpy(  # pylint: disable=protected-access
+      ground_truth_data.sample_factors(num_points, random_state)))
+  # Intervene on the sensitive attribute.
+  intervened_factors = np.tile(original_factors, (num_values, 1))
+  groups = np.repeat(np.arange(num_values), num_points)
+  intervened_factors[:, sensitive_factor] = groups
+  # Obtain the batched observations.
+  observations = ground_truth_data.sample_observations_from_factors(
+      intervened_factors, random_state)
+  representations = utils.obtain_representation(observations,
+                                                representation_function,
+                                                batch_size)
+  return np.transpose(representations), groups
+
+
 def compute_scores_dict(metric, prefix):
   """Computes scores for combinations of predictive and sensitive factors.
   Either average or take the maximum with respect to target and sensitive
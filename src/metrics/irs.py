@@ -24,7 +24,9 @@ from __future__ import division
 from __future__ import print_function
 from absl import logging
 from . import metric_utils as utils
+from . import torch_kernels
 import numpy as np
+import torch
 
 
 def compute_irs(ground_truth_data,
@@ -52,7 +54,11 @@ def compute_irs(ground_truth_data,
                                              representation_function, num_train,
                                              random_state, batch_size)
   assert mus.shape[1] == num_train
+  return _compute_irs(mus, ys, diff_quantile)
 
+
+def _compute_irs(mus, ys, diff_quantile=0.99):
+  """Computes score based on the codes and factors."""
   ys_discrete = utils.make_discretizer(ys)
   active_mus = _drop_constant_dims(mus)
 
@@ -62,12 +68,14 @@ def compute_irs(ground_truth_data,
     score_dict = scalable_disentanglement_score(ys_discrete.T, active_mus.T,
                                                diff_quantile)#["avg_score"]
 
-  score_dict["num_active_dims"] = np.sum(active_mus)
+  score_dict["num_active_dims"] = float(active_mus.sum())
   return score_dict
 
 
 def _drop_constant_dims(ys):
   """Returns a view of the matrix `ys` with dropped constant rows."""
+  if isinstance(ys, torch.Tensor):
+    return torch_kernels.drop_constant_dims(ys)
   ys = np.asarray(ys)
   if ys.ndim != 2:
     raise ValueError("Expecting a matrix.")
@@ -77,6 +85,32 @@ def _drop_constant_dims(ys):
   return ys[active_mask, :]
 
 
+def _group_max_diffs(factor, latents, diff_quantile=0.99):
+  """Quantile of the deviations from E[Z | g_i] within each group of constant g_i.
+
+  The samples are sorted by the factor once, so each group is a contiguous
+  slice, and all groups of the same size are reduced together.
+
+  Returns:
+    Array of shape (num distinct values, num latents), ordered by value.
+  """
+  order = np.argsort(factor, kind="stable")
+  _, starts, counts = np.unique(factor[order], return_index=True,
+                                return_counts=True)
+  latents = latents[order]
+  max_diffs = np.zeros([len(starts), latents.shape[1]])
+  for size in np.unique(counts):
+    selected = np.flatnonzero(counts == size)
+    # groups of shape (num groups, size, num latents)
+    groups = latents[starts[selected, np.newaxis] + np.arange(size)]
+    # Compute E[Z | g_i].
+    e_loc = np.mean(groups, axis=1, keepdims=True)
+    # Difference of each value within that group of constant g_i to its mean.
+    diffs = np.abs(groups - e_loc).transpose(0, 2, 1)  # reduce the last axis
+    max_diffs[selected] = np.percentile(diffs, q=diff_quantile*100, axis=-1)
+  return max_diffs
+
+
 def scalable_disentanglement_score(gen_factors, latents, diff_quantile=0.99):
   """Computes IRS scores of a dataset.
   Assumes no noise in X and crossed generative factors (i.e. one sample per
@@ -96,22 +130,21 @@ def scalable_disentanglement_score(gen_factors, latents, diff_quantile=0.99):
   num_lat = latents.shape[1]
 
   # Compute normalizer.
-  max_deviations = np.max(np.abs(latents - latents.mean(axis=0)), axis=0)
+  if isinstance(latents, torch.Tensor):
+    gen_factors = torch_kernels.as_tensor(gen_factors, like=latents)
+    max_deviations = utils._to_numpy(
+        (latents - latents.mean(0)).abs().amax(0))
+    group_max_diffs = torch_kernels.group_max_diffs
+  else:
+    max_deviations = np.max(np.abs(latents - latents.mean(axis=0)), axis=0)
+    group_max_diffs = _group_max_diffs
   cum_deviations = np.zeros([num_lat, num_gen])
   for i in range(num_gen):
-    unique_factors = np.unique(gen_factors[:, i], axis=0)
-    assert unique_factors.ndim == 1
-    num_distinct_factors = unique_factors.shape[0]
-    for k in range(num_distinct_factors):
-      # Compute E[Z | g_i].
-      match = gen_factors[:, i] == unique_factors[k]
-      e_loc = np.mean(latents[match, :], axis=0)
-
-      # Difference of each value within that group of constant g_i to its mean.
-      diffs = np.abs(latents[match, :] - e_loc)
-      max_diffs = np.percentile(diffs, q=diff_quantile*100, axis=0)
-      cum_deviations[:, i] += max_diffs
-    cum_deviations[:, i] /= num_distinct_factors
+    max_diffs = utils._to_numpy(
+        group_max_diffs(gen_factors[:, i], latents, diff_quantile))
+    for group_diffs in max_diffs:
+      cum_deviations[:, i] += group_diffs
+    cum_deviations[:, i] /= len(max_diffs)
   # Normalize value of each latent dimension with its maximal deviation.
   normalized_deviations = cum_deviations / max_deviations[:, np.newaxis]
   irs_matrix = 1.0 - normalized_deviations
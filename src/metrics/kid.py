@@ -0,0 +1,76 @@
+"""Kernel Inception Distance (Binkowski et al., 2018).
+
+The KID is the unbiased estimate of the squared MMD between two sets of
+(inception) features with the polynomial kernel k(x, y) = (x.y / d + 1)^3.
+Unlike the FID it is unbiased, so it can be compared across sample sizes. The
+kernel sums are accumulated over blocks of at most block_size x block_size
+entries, so the full Gram matrix is never formed.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import numpy as np
+import torch
+
+
+def polynomial_kernel(x, y, degree=3, coef0=1.):
+  """Polynomial kernel matrix (len(x), len(y)) with gamma = 1 / dim."""
+  return (x @ y.T / x.shape[1] + coef0).pow(degree)
+
+
+def _kernel_sum(x, y, block_size, symmetric=False):
+  """Sum of all entries of the kernel matrix of x and y, computed in blocks
+  (if symmetric, x is y and only the blocks above the diagonal are
+  evaluated)."""
+  total = 0.
+  for i in range(0, len(x), block_size):
+    xb = x[i:i + block_size]
+    start = i if symmetric else 0
+    for j in range(start, len(y), block_size):
+      block = polynomial_kernel(xb, y[j:j + block_size]).sum().item()
+      total += block if not symmetric or i == j else 2 * block
+  return total
+
+
+def mmd2_unbiased(x, y, block_size=1024):
+  """Unbiased estimate of the squared MMD of samples x (m, dim) and y (n, dim)
+  with the polynomial kernel, excluding the diagonal terms k(x_i, x_i)."""
+  m, n = len(x), len(y)
+  diag_x = (x.pow(2).sum(1) / x.shape[1] + 1).pow(3).sum().item()
+  diag_y = (y.pow(2).sum(1) / y.shape[1] + 1).pow(3).sum().item()
+  kxx = _kernel_sum(x, x, block_size, symmetric=True) - diag_x
+  kyy = _kernel_sum(y, y, block_size, symmetric=True) - diag_y
+  kxy = _kernel_sum(x, y, block_size)
+  return kxx / (m * (m - 1)) + kyy / (n * (n - 1)) - 2 * kxy / (m * n)
+
+
+def kernel_inception_distance(x, y, num_subsets=100, subset_size=1000,
+                              block_size=1024, random_state=None, device=None):
+  """KID of two sets of features, averaged over random subsets.
+  Args:
+    x: Features of the first set (m, dim), numpy array or torch tensor.
+    y: Features of the second set (n, dim).
+    num_subsets: Number of pairs of subsets. If 0, the MMD is estimated once
+      from all points (still in blocks).
+    subset_size: Number of points of each subset (at most min(m, n)).
+    block_size: Maximum number of rows and columns of each kernel block.
+    random_state: Numpy random state used to draw the subsets.
+    device: Device of the kernel computations (by default that of x).
+  Returns:
+    Mean and standard deviation of the estimates over the subsets.
+  """
+  x = torch.as_tensor(x, device=device).double()
+  y = torch.as_tensor(y, device=x.device).double()
+  if not num_subsets:
+    return mmd2_unbiased(x, y, block_size), 0.
+  if random_state is None:
+    random_state = np.random.RandomState()
+  subset_size = min(subset_size, len(x), len(y))
+  estimates = []
+  for _ in range(num_subsets):
+    idx_x = random_state.choice(len(x), subset_size, replace=False)
+    idx_y = random_state.choice(len(y), subset_size, replace=False)
+    estimates.append(mmd2_unbiased(x[torch.from_numpy(idx_x).to(x.device)],
+                                   y[torch.from_numpy(idx_y).to(y.device)],
+                                   block_size))
+  return float(np.mean(estimates)), float(np.std(estimates))
@@ -25,6 +25,7 @@ from __future__ import print_function
 import numpy as np
 from six.moves import range
 from sklearn import linear_model
+from . import metric_utils as utils
 
 def compute_beta_vae_sklearn(ground_truth_data,
                              representation_function,
@@ -52,7 +53,8 @@ def compute_beta_vae_sklearn(ground_truth_data,
       random_state)
 
   model = linear_model.LogisticRegression(random_state=random_state)
-  model.fit(train_points, train_labels)
+  with utils.timed_phase("fit"):
+    model.fit(train_points, train_labels)
 
   train_accuracy = model.score(train_points, train_labels)
   train_accuracy = np.mean(model.predict(train_points) == train_labels)
@@ -69,8 +71,13 @@ def compute_beta_vae_sklearn(ground_truth_data,
 
 
 def _generate_training_batch(ground_truth_data, representation_function,
-                             batch_size, num_points, random_state):
+                             batch_size, num_points, random_state,
+                             eval_batch_size=1024):
   """Sample a set of training samples based on a batch of ground-truth data.
+  The pairs of mini-batches of several points are drawn in the same order as
+  by `_generate_training_sample`, but gathered and encoded together (about
+  `eval_batch_size` observations at a time), so the samples are identical as
+  long as sampling the observations does not consume the random state.
   Args:
     ground_truth_data: GroundTruthData to be sampled from.
     representation_function: Function that takes observations as input and
@@ -78,6 +85,7 @@ def _generate_training_batch(ground_truth_data, representation_function,
     batch_size: Number of points to be used to compute the training_sample.
     num_points: Number of points to be sampled for training set.
     random_state: Numpy random state used for randomness.
+    eval_batch_size: Number of observations encoded at once.
   Returns:
     points: (num_points, dim_representation)-sized numpy array with training set
       features.
@@ -85,15 +93,40 @@ def _generate_training_batch(ground_truth_data, representation_function,
   """
   points = None  # Dimensionality depends on the representation function.
   labels = np.zeros(num_points, dtype=np.int64)
-  for i in range(num_points):
-    labels[i], feature_vector = _generate_training_sample(
-        ground_truth_data, representation_function, batch_size, random_state)
+  points_per_batch = max(1, eval_batch_size // (2 * batch_size))
+  for start in range(0, num_points, points_per_batch):
+    num = min(points_per_batch, num_points - start)
+    indices, factors = _sample_factor_pairs(ground_truth_data, batch_size, num,
+                                            random_state)
+    observations = ground_truth_data.sample_observations_from_factors(
+        factors.reshape(num * 2 * batch_size, -1), random_state)
+    representations = utils.obtain_representation(
+        observations, representation_function, num * 2 * batch_size).T
+    representations = representations.reshape(num, 2, batch_size, -1)
     if points is None:
-      points = np.zeros((num_points, feature_vector.shape[0]))
-    points[i, :] = feature_vector
+      points = np.zeros((num_points, representations.shape[-1]))
+    labels[start:start + num] = indices
+    points[start:start + num] = np.mean(
+        np.abs(representations[:, 0] - representations[:, 1]), axis=1)
   return points, labels
 
 
+def _sample_factor_pairs(ground_truth_data, batch_size, num_points,
+                         random_state):
+  """Draws the (num_points, 2, batch_size, num_factors) factors of num_points
+  pairs of mini-batches, each pair sharing one randomly selected factor."""
+  indices = np.zeros(num_points, dtype=np.int64)
+  factors = np.zeros((num_points, 2, batch_size, ground_truth_data.num_factors),
+                     dtype=np.int64)
+  for i in range(num_points):
+    indices[i] = random_state.randint(ground_truth_data.num_factors)
+    factors[i, 0] = ground_truth_data.sample_factors(batch_size, random_state)
+    factors[i, 1] = ground_truth_data.sample_factors(batch_size, random_state)
+  index = np.arange(num_points)
+  factors[index, 1, :, indices] = factors[index, 0, :, indices]
+  return indices, factors
+
+
 def _generate_training_sample(ground_truth_data, representation_function,
                               batch_size, random_state):
   """Sample a single training sample based on a mini-batch of ground-truth data.
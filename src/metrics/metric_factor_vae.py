@@ -67,7 +67,8 @@ def compute_factor_vae(ground_truth_data,
                                             representation_function, batch_size,
                                             num_train, random_state,
                                             global_variances, active_dims)
-  classifier = np.argmax(training_votes, axis=0)
+  with utils.timed_phase("fit"):
+    classifier = np.argmax(training_votes, axis=0)
   other_index = np.arange(training_votes.shape[1])
 
   logging.info("Evaluate training set accuracy.")
@@ -157,8 +158,13 @@ def _generate_training_sample(ground_truth_data, representation_function,
 
 def _generate_training_batch(ground_truth_data, representation_function,
                              batch_size, num_points, random_state,
-                             global_variances, active_dims):
+                             global_variances, active_dims,
+                             eval_batch_size=1024):
   """Sample a set of training samples based on a batch of ground-truth data.
+  The mini-batches of several points are drawn in the same order as by
+  `_generate_training_sample`, but gathered and encoded together (about
+  `eval_batch_size` observations at a time), so the votes are identical as
+  long as sampling the observations does not consume the random state.
   Args:
     ground_truth_data: GroundTruthData to be sampled from.
     representation_function: Function that takes observations as input and
@@ -169,16 +175,39 @@ def _generate_training_batch(ground_truth_data, representation_function,
     global_variances: Numpy vector with variances for all dimensions of
       representation.
     active_dims: Indexes of active dimensions.
+    eval_batch_size: Number of observations encoded at once.
   Returns:
     (num_factors, dim_representation)-sized numpy array with votes.
   """
   votes = np.zeros((ground_truth_data.num_factors, global_variances.shape[0]),
                    dtype=np.int64)
-  for _ in range(num_points):
-    factor_index, argmin = _generate_training_sample(ground_truth_data,
-                                                     representation_function,
-                                                     batch_size, random_state,
-                                                     global_variances,
-                                                     active_dims)
-    votes[factor_index, argmin] += 1
-  return votes
\ No newline at end of file
+  points_per_batch = max(1, eval_batch_size // batch_size)
+  for start in range(0, num_points, points_per_batch):
+    num = min(points_per_batch, num_points - start)
+    factor_indices, factors = _sample_fixed_factor_batches(
+        ground_truth_data, batch_size, num, random_state)
+    observations = ground_truth_data.sample_observations_from_factors(
+        factors.reshape(num * batch_size, -1), random_state)
+    representations = utils.obtain_representation(
+        observations, representation_function, num * batch_size).T
+    local_variances = np.var(representations.reshape(num, batch_size, -1),
+                             axis=1, ddof=1)
+    argmins = np.argmin(local_variances[:, active_dims] /
+                        global_variances[active_dims], axis=1)
+    np.add.at(votes, (factor_indices, argmins), 1)
+  return votes
+
+
+def _sample_fixed_factor_batches(ground_truth_data, batch_size, num_points,
+                                 random_state):
+  """Draws the (num_points, batch_size, num_factors) factors of num_points
+  mini-batches, each with one randomly selected factor fixed."""
+  factor_indices = np.zeros(num_points, dtype=np.int64)
+  factors = np.zeros((num_points, batch_size, ground_truth_data.num_factors),
+                     dtype=np.int64)
+  for i in range(num_points):
+    factor_indices[i] = random_state.randint(ground_truth_data.num_factors)
+    factors[i] = ground_truth_data.sample_factors(batch_size, random_state)
+  index = np.arange(num_points)
+  factors[index, :, factor_indices] = factors[index, 0, factor_indices][:, None]
+  return factor_indices, factors
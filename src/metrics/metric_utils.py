@@ -1,6 +1,10 @@
 from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
+import collections
+import contextlib
+import time
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from six.moves import range
 import sklearn
@@ -13,6 +17,13 @@ import torch.nn as nn
 import torch.nn.functional as F
 from torchvision import models
 
+from . import torch_kernels
+
+try:
+  import resource
+except ImportError:  # windows
+  resource = None
+
 try:
     from torchvision.models.utils import load_state_dict_from_url
 except ImportError:
@@ -24,7 +35,8 @@ FID_WEIGHTS_URL = 'https://github.com/mseitzer/pytorch-fid/releases/download/fid
 
 
 def generate_batch_factor_code(ground_truth_data, representation_function,
-                               num_points, random_state, batch_size):
+                               num_points, random_state, batch_size,
+                               to_numpy=True):
   """Sample a single training sample based on a mini-batch of ground-truth data.
   Args:
     ground_truth_data: GroundTruthData to be sampled from.
@@ -33,36 +45,82 @@ def generate_batch_factor_code(ground_truth_data, representation_function,
     num_points: Number of points to sample.
     random_state: Numpy random state used for randomness.
     batch_size: Batchsize to sample points.
+    to_numpy: If False, codes (and factors) returned as torch tensors by the
+      representation function (or the data) are kept as tensors on their
+      device instead of being copied to numpy.
   Returns:
     representations: Codes (num_codes, num_points)-np array.
     factors: Factors generating the codes (num_factors, num_points)-np array.
   """
+  return next(iterate_batch_factor_code(ground_truth_data,
+                                        representation_function, num_points,
+                                        random_state, batch_size,
+                                        chunk_size=num_points,
+                                        to_numpy=to_numpy))
+
+
+def iterate_batch_factor_code(ground_truth_data, representation_function,
+                              num_points, random_state, batch_size,
+                              chunk_size=None, to_numpy=True):
+  """Sample codes and factors in chunks, so they never have to fit in memory.
+  Args:
+    ground_truth_data: GroundTruthData to be sampled from.
+    representation_function: Function that takes observation as input and
+      outputs a representation.
+    num_points: Total number of points to sample.
+    random_state: Numpy random state used for randomness.
+    batch_size: Batchsize to sample points.
+    chunk_size: Number of points in each yielded chunk (defaults to
+      batch_size).
+    to_numpy: If False, torch tensors are kept on their device.
+  Yields:
+    representations: Codes (num_codes, chunk_size)-array.
+    factors: Factors generating the codes (num_factors, chunk_size)-array.
+  """
+  if chunk_size is None:
+    chunk_size = batch_size
   representations = None
   factors = None
   i = 0
+  j = 0
   while i < num_points:
+    # Batches are sampled independently of the chunking, so the codes are the
+    # same for any chunk_size.
     num_points_iter = min(num_points - i, batch_size)
     current_factors, current_observations = \
         ground_truth_data.sample(num_points_iter, random_state)
-    if i == 0:
-      factors = current_factors
-      representations = representation_function(current_observations)
-    else:
-      factors = np.vstack((factors, current_factors))
-      representations = np.vstack((representations,
-                                   representation_function(
-                                       current_observations)))
+    current_representations = representation_function(current_observations)
+    k = 0
+    while k < num_points_iter:
+      if representations is None:
+        num_chunk = min(num_points - i - k, chunk_size)
+        representations = _allocate_like(current_representations, num_chunk)
+        factors = _allocate_like(current_factors, num_chunk)
+        j = 0
+      num_copy = min(num_points_iter - k, len(representations) - j)
+      representations[j:j + num_copy] = current_representations[k:k + num_copy]
+      factors[j:j + num_copy] = _as_type_of(current_factors[k:k + num_copy],
+                                            factors)
+      j += num_copy
+      k += num_copy
+      if j == len(representations):
+        if to_numpy:
+          representations = _to_numpy(representations)
+          factors = _to_numpy(factors)
+        yield representations.T, factors.T
+        representations = None
     i += num_points_iter
-  return np.transpose(representations), np.transpose(factors)
 
 
-def obtain_representation(observations, representation_function, batch_size):
+def obtain_representation(observations, representation_function, batch_size,
+                          to_numpy=True):
   """"Obtain representations from observations.
   Args:
     observations: Observations for which we compute the representation.
     representation_function: Function that takes observation as input and
       outputs a representation.
     batch_size: Batch size to compute the representation.
+    to_numpy: If False, torch tensors are kept on their device.
   Returns:
     representations: Codes (num_codes, num_points)-Numpy array.
   """
@@ -72,46 +130,488 @@ def obtain_representation(observations, representation_function, batch_size):
   while i < num_points:
     num_points_iter = min(num_points - i, batch_size)
     current_observations = observations[i:i + num_points_iter]
-    if i == 0:
-      representations = representation_function(current_observations)
-    else:
-      representations = np.vstack((representations,
-                                   representation_function(
-                                       current_observations)))
+    current_representations = representation_function(current_observations)
+    if representations is None:
+      representations = _allocate_like(current_representations, num_points)
+    representations[i:i + num_points_iter] = current_representations
     i += num_points_iter
-  return np.transpose(representations)
+  if to_numpy:
+    representations = _to_numpy(representations)
+  return representations.T
+
+
+def _allocate_like(batch, num_points):
+  """Empty (num_points, ...) buffer with the type, dtype and device of batch."""
+  if isinstance(batch, torch.Tensor):
+    return batch.new_empty((num_points,) + tuple(batch.shape[1:]))
+  batch = np.asarray(batch)
+  return np.empty((num_points,) + batch.shape[1:], dtype=batch.dtype)
+
+
+def _as_type_of(batch, buffer):
+  """Converts batch so that it can be written into buffer."""
+  if isinstance(buffer, torch.Tensor):
+    return torch.as_tensor(batch).to(buffer.device)
+  return _to_numpy(batch)
+
+
+def _to_numpy(x):
+  if isinstance(x, torch.Tensor):
+    return x.detach().cpu().numpy()
+  return x
+
+
+class StreamingCovariance(object):
+  """Running mean and covariance of a stream of (num_points, dim) batches.
+  Each batch is merged with the pairwise update of Chan et al. (for single
+  points this is Welford's update), in float64, so the result does not depend
+  on the batching up to rounding. Partial accumulators, e.g. of parallel
+  workers, are combined with `merge`.
+  """
+
+  def __init__(self):
+    self.count = 0
+    self.mean = None
+    self._comoment = None  # Sum of the outer products of the centered points.
+
+  def update(self, batch):
+    """Adds the rows of batch (numpy array or torch tensor) to the estimate."""
+    batch = np.asarray(_to_numpy(batch), dtype=np.float64)
+    if not len(batch):
+      return self
+    mean = batch.mean(0)
+    centered = batch - mean
+    return self._combine(len(batch), mean, centered.T @ centered)
+
+  def merge(self, other):
+    """Adds the points accumulated by other to the estimate."""
+    if other.count:
+      self._combine(other.count, other.mean, other._comoment)
+    return self
+
+  def _combine(self, count, mean, comoment):
+    if not self.count:
+      self.count, self.mean, self._comoment = count, mean.copy(), \
+          comoment.copy()
+      return self
+    total = self.count + count
+    delta = mean - self.mean
+    self.mean = self.mean + delta * (count / total)
+    self._comoment = self._comoment + comoment + \
+        np.outer(delta, delta) * (self.count * count / total)
+    self.count = total
+    return self
+
+  def covariance(self, ddof=1):
+    """(dim, dim) covariance matrix, by default unbiased like np.cov."""
+    return self._comoment / (self.count - ddof)
+
+
+def streaming_covariance(ground_truth_data, representation_function,
+                         num_points, random_state, batch_size):
+  """Accumulates the covariance of the codes of num_points samples in constant
+  memory.
+  Args:
+    ground_truth_data: GroundTruthData to be sampled from.
+    representation_function: Function that takes observation as input and
+      outputs a representation.
+    num_points: Number of points to sample.
+    random_state: Numpy random state used for randomness.
+    batch_size: Batchsize to sample points.
+  Returns:
+    StreamingCovariance of the codes.
+  """
+  accumulator = StreamingCovariance()
+  for representations, _ in iterate_batch_factor_code(
+      ground_truth_data, representation_function, num_points, random_state,
+      batch_size, to_numpy=False):
+    accumulator.update(representations.T)
+  return accumulator
+
+
+class PrefetchGroundTruthData(object):
+  """Wraps a GroundTruthData to prepare upcoming batches in background threads.
+
+  Calls to `sample` are served from a bounded queue. The factors of each queued
+  batch are drawn ahead from a copy of the caller's random state, while worker
+  threads gather the observations, pin them and copy them to the device as the
+  current batch is being encoded. Datasets may also draw the factors from
+  torch's global generator (like omnilearn's `JointFactorSampler`), so its
+  state is saved and restored around every draw ahead. The caller's random
+  state and torch's generator are only advanced when a batch is actually used,
+  to the states they would have after sampling the batch directly, and queued
+  batches are discarded if either state changed in the meantime (e.g. by other
+  draws), so the samples are the same as without prefetching. This assumes
+  that the observations are not drawn from torch's global generator (they are
+  gathered in the worker threads). All other attributes are forwarded to the
+  wrapped data.
+  """
+
+  def __init__(self, ground_truth_data, queue_size=2, num_workers=1,
+               device=None, pin_memory=None):
+    if pin_memory is None:
+      pin_memory = torch.cuda.is_available()
+    self.ground_truth_data = ground_truth_data
+    self.queue_size = max(queue_size, 1)
+    self.device = device
+    self.pin_memory = pin_memory
+    self._pool = ThreadPoolExecutor(max_workers=num_workers)
+    self._queue = collections.deque()
+    self._queue_key = None
+    # predicted (numpy, torch) states of the caller after the queue
+    self._next_state = None
+
+  def __getattr__(self, item):
+    if item == 'ground_truth_data':
+      raise AttributeError(item)
+    return getattr(self.ground_truth_data, item)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def close(self):
+    self.reset()
+    self._pool.shutdown(wait=True)
+
+  def reset(self):
+    """Drops all prefetched batches."""
+    for batch in self._queue:
+      batch[-1].cancel()
+    self._queue.clear()
+    self._queue_key = None
+    self._next_state = None
+
+  def _prepare(self, factors, random_state):
+    observations = self.ground_truth_data.sample_observations_from_factors(
+        factors, random_state)
+    if isinstance(observations, torch.Tensor):
+      if self.pin_memory and observations.device.type == 'cpu':
+        observations = observations.pin_memory()
+      if self.device is not None:
+        observations = observations.to(self.device, non_blocking=True)
+    return observations
+
+  def _enqueue(self, num, state, torch_state):
+    """Queues a batch drawn with a copy of the random state `state` and torch's
+    generator in state `torch_state`, returning the states after its factors
+    (the predicted start of the next batch)."""
+    random_state = np.random.RandomState()
+    random_state.set_state(state)
+    current = torch.get_rng_state()
+    torch.set_rng_state(torch_state)
+    try:
+      factors = self.ground_truth_data.sample_factors(num, random_state)
+      torch_after = torch.get_rng_state()
+    finally:
+      torch.set_rng_state(current)
+    after = random_state.get_state()
+    # Each batch has its own random state, so that workers never share one.
+    self._queue.append((state, torch_state, factors, random_state, torch_after,
+                        self._pool.submit(self._prepare, factors,
+                                          random_state)))
+    return after, torch_after
+
+  def sample(self, num, random_state):
+    """Sample a batch of factors Y and observations X."""
+    if self._queue_key is None or self._queue_key[1] != id(random_state):
+      self.reset()
+      self._queue_key = num, id(random_state)
+    if num != self._queue_key[0]:
+      # Other sizes (such as the last batch) are sampled directly.
+      factors = self.ground_truth_data.sample_factors(num, random_state)
+      return factors, self._prepare(factors, random_state)
+
+    state, torch_state = random_state.get_state(), torch.get_rng_state()
+    if self._queue and not (_same_random_state(self._queue[0][0], state)
+                            and torch.equal(self._queue[0][1], torch_state)):
+      self.reset()
+      self._queue_key = num, id(random_state)
+    if not self._queue:
+      self._next_state = self._enqueue(num, state, torch_state)
+    _, _, factors, batch_state, torch_after, future = self._queue.popleft()
+    while len(self._queue) < self.queue_size:
+      self._next_state = self._enqueue(num, *self._next_state)
+    observations = future.result()
+    random_state.set_state(batch_state.get_state())
+    torch.set_rng_state(torch_after)
+    return factors, observations
+
+  def sample_observations(self, num, random_state):
+    """Sample a batch of observations X."""
+    return self.sample(num, random_state)[1]
+
 
+def _same_random_state(a, b):
+  """Whether two states of `np.random.RandomState.get_state` are equal."""
+  return a[0] == b[0] and a[2:] == b[2:] and np.array_equal(a[1], b[1])
 
-def discrete_mutual_info(mus, ys):
-  """Compute discrete mutual information."""
-  num_codes = mus.shape[0]
+
+class PhaseTimer(object):
+  """Accumulates the wall time, CPU time and peak memory of the phases of a metric.
+
+  Phases can be nested, in which case the time is only attributed to the
+  innermost phase (e.g. "encode" within "score"). The peak RSS is the high-water
+  mark of the process at the end of each phase, the device memory is the peak
+  allocated by torch while the phase was active.
+  """
+
+  def __init__(self):
+    self.stats = collections.OrderedDict()
+    self._stack = []
+
+  def _stat(self, name):
+    if name not in self.stats:
+      self.stats[name] = {"wall": 0., "cpu": 0., "calls": 0,
+                          "peak_rss": None, "peak_device": None}
+    return self.stats[name]
+
+  def _pause(self):
+    if not self._stack:
+      return
+    name, wall, cpu = self._stack[-1]
+    stat = self._stat(name)
+    stat["wall"] += time.perf_counter() - wall
+    stat["cpu"] += time.process_time() - cpu
+    if resource is not None:
+      rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+      stat["peak_rss"] = max(rss, stat["peak_rss"] or 0)
+    if torch.cuda.is_available() and torch.cuda.is_initialized():
+      mem = torch.cuda.max_memory_allocated()
+      stat["peak_device"] = max(mem, stat["peak_device"] or 0)
+      torch.cuda.reset_peak_memory_stats()
+
+  def _resume(self):
+    if self._stack:
+      self._stack[-1][1:] = time.perf_counter(), time.process_time()
+
+  @contextlib.contextmanager
+  def phase(self, name):
+    self._pause()
+    self._stat(name)["calls"] += 1
+    self._stack.append([name, time.perf_counter(), time.process_time()])
+    try:
+      yield self
+    finally:
+      self._pause()
+      self._stack.pop()
+      self._resume()
+
+  def summary(self):
+    return {name: dict(stat) for name, stat in self.stats.items()}
+
+
+_active_timer = None
+
+
+@contextlib.contextmanager
+def timed_phase(name, timer=None):
+  """Attributes the time spent in the context to phase `name` of the timer.
+
+  Args:
+    name: Name of the phase (sample, encode, fit or score).
+    timer: PhaseTimer to activate for the context, otherwise the currently
+      active timer is used (if there is none, nothing is recorded).
+  """
+  global _active_timer
+  prev = _active_timer
+  if timer is not None:
+    _active_timer = timer
+  try:
+    if _active_timer is None:
+      yield None
+    else:
+      with _active_timer.phase(name):
+        yield _active_timer
+  finally:
+    _active_timer = prev
+
+
+class TimedGroundTruthData(object):
+  """Wraps a GroundTruthData to attribute all sampling to the "sample" phase."""
+
+  def __init__(self, ground_truth_data):
+    self.ground_truth_data = ground_truth_data
+
+  def __getattr__(self, item):
+    if item == 'ground_truth_data':
+      raise AttributeError(item)
+    return getattr(self.ground_truth_data, item)
+
+  def sample_factors(self, num, random_state):
+    with timed_phase("sample"):
+      return self.ground_truth_data.sample_factors(num, random_state)
+
+  def sample_observations_from_factors(self, factors, random_state):
+    with timed_phase("sample"):
+      return self.ground_truth_data.sample_observations_from_factors(
+          factors, random_state)
+
+  def sample(self, num, random_state):
+    with timed_phase("sample"):
+      return self.ground_truth_data.sample(num, random_state)
+
+  def sample_observations(self, num, random_state):
+    with timed_phase("sample"):
+      return self.ground_truth_data.sample_observations(num, random_state)
+
+
+def discrete_mutual_info(mus, ys, chunk_size=2**24):
+  """Compute discrete mutual information.
+
+  Equivalent to `sklearn.metrics.mutual_info_score` for every pair of code and
+  factor, but the joint histograms of a whole block of codes with a factor are
+  counted with a single bincount of the combined indices.
+
+  Args:
+    mus: Discrete codes (num_codes, num_points).
+    ys: Discrete factors (num_factors, num_points).
+    chunk_size: Maximum number of entries (codes x points) per block.
+
+  Returns:
+    Mutual information matrix (num_codes, num_factors).
+  """
+  if isinstance(mus, torch.Tensor) or isinstance(ys, torch.Tensor):
+    like = mus if isinstance(mus, torch.Tensor) else ys
+    return _to_numpy(torch_kernels.discrete_mutual_info(
+        torch_kernels.as_tensor(mus, like=like), ys, chunk_size))
+  num_codes, num_points = mus.shape
   num_factors = ys.shape[0]
+  ys, num_ys = _label_encode(ys)
   m = np.zeros([num_codes, num_factors])
-  for i in range(num_codes):
+  block = max(1, chunk_size // max(num_points, 1))
+  for start in range(0, num_codes, block):
+    codes, num_mus = _label_encode(mus[start:start + block])
+    size = num_mus * num_ys
+    offsets = (np.arange(len(codes)) * size)[:, np.newaxis]
+    codes = codes * num_ys + offsets
     for j in range(num_factors):
-      m[i, j] = sklearn.metrics.mutual_info_score(ys[j, :], mus[i, :])
+      counts = np.bincount((codes + ys[j]).ravel(), minlength=len(codes) * size)
+      m[start:start + block, j] = _mutual_info_from_counts(
+          counts.reshape(len(codes), num_mus, num_ys))
   return m
 
 
 def discrete_entropy(ys):
-  """Compute discrete mutual information."""
-  num_factors = ys.shape[0]
-  h = np.zeros(num_factors)
-  for j in range(num_factors):
-    h[j] = sklearn.metrics.mutual_info_score(ys[j, :], ys[j, :])
-  return h
+  """Compute discrete entropy (the mutual information of each factor with itself)."""
+  if isinstance(ys, torch.Tensor):
+    return _to_numpy(torch_kernels.discrete_entropy(ys))
+  num_factors, num_points = ys.shape
+  ys, num_ys = _label_encode(ys)
+  offsets = (np.arange(num_factors) * num_ys)[:, np.newaxis]
+  counts = np.bincount((ys + offsets).ravel(), minlength=num_factors * num_ys)
+  counts = counts.reshape(num_factors, num_ys).astype(np.float64)
+  with np.errstate(divide="ignore", invalid="ignore"):
+    terms = np.where(counts > 0, counts * np.log(counts), 0.)
+  h = np.log(num_points) - terms.sum(-1) / num_points
+  return np.clip(h, 0., None)
+
+
+def _label_encode(x):
+  """Maps the values of each row to integers in [0, num_values).
+
+  Rows that already hold small non-negative integers (e.g. discretized codes or
+  factors) are used as they are, otherwise each row is mapped to the index of
+  its unique values.
+
+  Returns:
+    Integer labels with the same shape as x and the number of labels.
+  """
+  x = np.asarray(x)
+  if x.size and np.issubdtype(x.dtype, np.number):
+    low, high = x.min(), x.max()
+    if low >= 0 and high < max(x.shape[-1], 256):
+      labels = x.astype(np.int64)
+      if np.issubdtype(x.dtype, np.integer) or np.array_equal(labels, x):
+        return labels, int(high) + 1
+  labels = np.empty(x.shape, dtype=np.int64)
+  num_labels = 1
+  for i in range(x.shape[0]):
+    values, labels[i] = np.unique(x[i], return_inverse=True)
+    num_labels = max(num_labels, len(values))
+  return labels, num_labels
+
+
+def _mutual_info_from_counts(counts):
+  """Mutual information of the joint histograms `counts` (..., num_a, num_b)."""
+  counts = counts.astype(np.float64)
+  total = counts.sum((-2, -1), keepdims=True)
+  marginal_a = counts.sum(-1, keepdims=True)
+  marginal_b = counts.sum(-2, keepdims=True)
+  with np.errstate(divide="ignore", invalid="ignore"):
+    terms = counts * (np.log(counts) + np.log(total)
+                      - np.log(marginal_a) - np.log(marginal_b))
+  terms = np.where(counts > 0, terms, 0.)
+  mi = terms.sum((-2, -1)) / total[..., 0, 0]
+  return np.clip(mi, 0., None)
 
 def _histogram_discretize(target, num_bins):
-  """Discretization based on histograms."""
-  discretized = np.zeros_like(target)
-  for i in range(target.shape[0]):
-    discretized[i, :] = np.digitize(target[i, :], np.histogram(
-        target[i, :], num_bins)[1][:-1])
-  return discretized
+  """Discretization based on histograms.
+
+  Same bins as `np.digitize` with the edges of `np.histogram` for each row, but
+  the edges of all rows are computed at once and the bins are assigned directly.
+  Only values within rounding distance of an edge are compared to the edges.
+  """
+  target = np.asarray(target)
+  x = target if np.issubdtype(target.dtype, np.floating) \
+    else target.astype(np.float64)
+  low, high = x.min(axis=1), x.max(axis=1)
+  same = low == high
+  low, high = np.where(same, low - 0.5, low), np.where(same, high + 0.5, high)
+  edges = np.linspace(low, high, num_bins + 1, axis=1).astype(x.dtype)
+
+  scale = (num_bins / (high - low)).astype(x.dtype)[:, np.newaxis]
+  bins = x - low[:, np.newaxis]
+  bins *= scale
+  # Rounding of the edges and of the scaled values (relative to the bin width)
+  tol = 16 * np.finfo(x.dtype).eps \
+    * (np.maximum(np.abs(low), np.abs(high))[:, np.newaxis] * scale + num_bins)
+  rows, cols = np.nonzero(np.abs(bins - np.rint(bins)) <= tol)
+  np.floor(bins, out=bins)
+  np.clip(bins, 0, num_bins - 1, out=bins)
+
+  exact = tol[:, 0] >= 0.25  # degenerate rows, which are digitized directly
+  for i in np.flatnonzero(exact):
+    bins[i] = np.digitize(x[i], edges[i, :-1]) - 1
+  keep = ~exact[rows]
+  rows, cols = rows[keep], cols[keep]
+  bins[rows, cols] = (x[rows, cols, np.newaxis] >= edges[rows, :-1]).sum(-1) - 1
+
+  bins += 1
+  return bins.astype(target.dtype, copy=False)
+
+
+def _quantile_discretize(target, num_bins):
+  """Discretization into (roughly) equally populated bins of each row.
+
+  The bin edges are the quantiles of each row, and values equal to an edge fall
+  into the upper bin (as with `np.digitize`), so repeated values are never split.
+  """
+  target = np.asarray(target)
+  edges = np.quantile(target, np.linspace(0, 1, num_bins + 1)[1:-1], axis=1)
+  discretized = np.ones(target.shape, dtype=np.int64)
+  for edge in edges:
+    discretized += target >= edge[:, np.newaxis]
+  return discretized.astype(target.dtype)
+
+
+DISCRETIZERS = {
+  "histogram": _histogram_discretize,
+  "quantile": _quantile_discretize,
+}
+
 
 def make_discretizer(target, num_bins = 20,
                      discretizer_fn = _histogram_discretize):
-  """Wrapper that creates discretizers."""
+  """Wrapper that creates discretizers (`discretizer_fn` can also be a key of `DISCRETIZERS`)."""
+  if isinstance(target, torch.Tensor):
+    names = {fn: name for name, fn in DISCRETIZERS.items()}
+    discretizer_fn = names.get(discretizer_fn, discretizer_fn)
+    return torch_kernels.DISCRETIZERS[discretizer_fn](target, num_bins)
+  if isinstance(discretizer_fn, str):
+    discretizer_fn = DISCRETIZERS[discretizer_fn]
   return discretizer_fn(target, num_bins)
 
 
@@ -43,10 +43,11 @@ def compute_mig(ground_truth_data,
   return _compute_mig(mus_train, ys_train)
 
 
-def _compute_mig(mus_train, ys_train):
+def _compute_mig(mus_train, ys_train, discretizer="histogram"):
   """Computes score based on both training and testing codes and factors."""
   score_dict = {}
-  discretized_mus = utils.make_discretizer(mus_train)
+  discretized_mus = utils.make_discretizer(mus_train,
+                                           discretizer_fn=discretizer)
   m = utils.discrete_mutual_info(discretized_mus, ys_train)
   assert m.shape[0] == mus_train.shape[0]
   assert m.shape[1] == ys_train.shape[0]
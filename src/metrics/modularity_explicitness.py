@@ -23,11 +23,11 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 from . import metric_utils as utils
+from joblib import Parallel, delayed
 import numpy as np
+import scipy.stats
 from six.moves import range
 from sklearn.linear_model import LogisticRegression
-from sklearn.metrics import roc_auc_score
-from sklearn.preprocessing import MultiLabelBinarizer
 
 
 def compute_modularity_explicitness(ground_truth_data,
@@ -35,7 +35,8 @@ def compute_modularity_explicitness(ground_truth_data,
                                     random_state,
                                     num_train,
                                     num_test,
-                                    batch_size=16):
+                                    batch_size=16,
+                                    n_jobs=1):
   """Computes the modularity metric according to Sec 3.
   Args:
     ground_truth_data: GroundTruthData to be sampled from.
@@ -46,31 +47,48 @@ def compute_modularity_explicitness(ground_truth_data,
     num_train: Number of points used for training.
     num_test: Number of points used for testing.
     batch_size: Batch size for sampling.
+    n_jobs: Number of factors whose classifiers are fitted in parallel.
   Returns:
     Dictionary with average modularity score and average explicitness
       (train and test).
   """
-  scores = {}
   mus_train, ys_train = utils.generate_batch_factor_code(
       ground_truth_data, representation_function, num_train,
       random_state, batch_size)
   mus_test, ys_test = utils.generate_batch_factor_code(
       ground_truth_data, representation_function, num_test,
       random_state, batch_size)
-  discretized_mus = utils.make_discretizer(mus_train)
+  return _compute_modularity_explicitness(mus_train, ys_train, mus_test,
+                                          ys_test, n_jobs=n_jobs)
+
+
+def _compute_modularity_explicitness(mus_train, ys_train, mus_test, ys_test,
+                                     discretizer="histogram", n_jobs=1):
+  """Computes score based on both training and testing codes and factors."""
+  scores = {}
+  discretized_mus = utils.make_discretizer(mus_train,
+                                           discretizer_fn=discretizer)
   mutual_information = utils.discrete_mutual_info(discretized_mus, ys_train)
   # Mutual information should have shape [num_codes, num_factors].
   assert mutual_information.shape[0] == mus_train.shape[0]
   assert mutual_information.shape[1] == ys_train.shape[0]
   scores["modularity_score"] = modularity(mutual_information)
-  explicitness_score_train = np.zeros([ys_train.shape[0], 1])
-  explicitness_score_test = np.zeros([ys_test.shape[0], 1])
+  # The explicitness classifiers are fitted with sklearn on the host.
+  mus_train, ys_train, mus_test, ys_test = [
+      utils._to_numpy(x) for x in (mus_train, ys_train, mus_test, ys_test)]
   mus_train_norm, mean_mus, stddev_mus = utils.normalize_data(mus_train)
   mus_test_norm, _, _ = utils.normalize_data(mus_test, mean_mus, stddev_mus)
-  for i in range(ys_train.shape[0]):
-    explicitness_score_train[i], explicitness_score_test[i] = \
-        explicitness_per_factor(mus_train_norm, ys_train[i, :],
-                                mus_test_norm, ys_test[i, :])
+  with utils.timed_phase("fit"):
+    if n_jobs == 1:
+      out = [explicitness_per_factor(mus_train_norm, ys_train[i, :],
+                                     mus_test_norm, ys_test[i, :])
+             for i in range(ys_train.shape[0])]
+    else:
+      out = Parallel(n_jobs=n_jobs)(
+          delayed(explicitness_per_factor)(mus_train_norm, ys_train[i, :],
+                                           mus_test_norm, ys_test[i, :])
+          for i in range(ys_train.shape[0]))
+  explicitness_score_train, explicitness_score_test = np.array(out).T
   scores["explicitness_score_train"] = np.mean(explicitness_score_train)
   scores["explicitness_score_test"] = np.mean(explicitness_score_test)
   return scores
@@ -94,23 +112,45 @@ def explicitness_per_factor(mus_train, y_train, mus_test, y_test):
   clf = LogisticRegression().fit(x_train, y_train)
   y_pred_train = clf.predict_proba(x_train)
   y_pred_test = clf.predict_proba(x_test)
-  mlb = MultiLabelBinarizer()
-  roc_train = roc_auc_score(mlb.fit_transform(np.expand_dims(y_train, 1)),
-                            y_pred_train)
-  roc_test = roc_auc_score(mlb.fit_transform(np.expand_dims(y_test, 1)),
-                           y_pred_test)
+  roc_train = multiclass_roc_auc(y_train, y_pred_train, clf.classes_)
+  roc_test = multiclass_roc_auc(y_test, y_pred_test, clf.classes_)
   return roc_train, roc_test
 
 
+def multiclass_roc_auc(labels, scores, classes):
+  """Macro-averaged one-vs-rest ROC-AUC of all classes present in labels.
+  Computed for all classes at once from the (tie-averaged) ranks of the scores
+  with the Mann-Whitney statistic, equal to sklearn's roc_auc_score of the
+  binarized labels.
+  Args:
+    labels: (num_points,)-np array of labels.
+    scores: (num_points, num_classes)-np array of scores for each class.
+    classes: (num_classes,)-np array of the class of each column of scores.
+  Returns:
+    Mean ROC-AUC over the classes present in labels.
+  """
+  present = np.isin(classes, labels)
+  scores, classes = scores[:, present], classes[present]
+  positives = labels[:, None] == classes[None, :]
+  num_pos = positives.sum(0)
+  num_neg = positives.shape[0] - num_pos
+  if (num_neg == 0).any():
+    raise ValueError("ROC-AUC is not defined when only one class is present.")
+  ranks = scipy.stats.rankdata(scores, axis=0)
+  rank_sum = np.sum(ranks * positives, axis=0)
+  auc = (rank_sum - num_pos * (num_pos + 1) / 2.) / (num_pos * num_neg)
+  return np.mean(auc)
+
+
 def modularity(mutual_information):
   """Computes the modularity from mutual information."""
-  # Mutual information has shape [num_codes, num_factors].
+  # Mutual information has shape [..., num_codes, num_factors].
   squared_mi = np.square(mutual_information)
-  max_squared_mi = np.max(squared_mi, axis=1)
-  numerator = np.sum(squared_mi, axis=1) - max_squared_mi
-  denominator = max_squared_mi * (squared_mi.shape[1] -1.)
+  max_squared_mi = np.max(squared_mi, axis=-1)
+  numerator = np.sum(squared_mi, axis=-1) - max_squared_mi
+  denominator = max_squared_mi * (squared_mi.shape[-1] -1.)
   delta = numerator / denominator
   modularity_score = 1. - delta
   index = (max_squared_mi == 0.)
   modularity_score[index] = 0.
-  return np.mean(modularity_score)
+  return np.mean(modularity_score, axis=-1)
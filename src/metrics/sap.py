@@ -60,10 +60,12 @@ def compute_sap(ground_truth_data,
   return _compute_sap(mus, ys, mus_test, ys_test, continuous_factors)
 
 
-def _compute_sap(mus, ys, mus_test, ys_test, continuous_factors):
+def _compute_sap(mus, ys, mus_test, ys_test, continuous_factors,
+                 classifier="threshold"):
   """Computes score based on both training and testing codes and factors."""
   score_matrix = compute_score_matrix(mus, ys, mus_test,
-                                      ys_test, continuous_factors)
+                                      ys_test, continuous_factors,
+                                      classifier=classifier)
   # Score matrix should have shape [num_latents, num_factors].
   assert score_matrix.shape[0] == mus.shape[0]
   assert score_matrix.shape[1] == ys.shape[0]
@@ -76,8 +78,30 @@ def _compute_sap(mus, ys, mus_test, ys_test, continuous_factors):
 
 
 
-def compute_score_matrix(mus, ys, mus_test, ys_test, continuous_factors):
-  """Compute score matrix as described in Section 3."""
+def compute_score_matrix(mus, ys, mus_test, ys_test, continuous_factors,
+                         classifier="threshold"):
+  """Compute score matrix as described in Section 3.
+
+  Args:
+    mus: Training codes (num_latents, num_train).
+    ys: Training factors (num_factors, num_train).
+    mus_test: Test codes (num_latents, num_test).
+    ys_test: Test factors (num_factors, num_test).
+    continuous_factors: Whether the factors are treated as continuous, then the
+      score is the squared correlation of each latent and factor.
+    classifier: For discrete factors, either "threshold" (the exact 1-D
+      threshold classifier of `threshold_score_matrix`) or "svm" (a linear SVM
+      for each latent and factor, as in the original implementation).
+
+  Returns:
+    Score matrix (num_latents, num_factors).
+  """
+  if continuous_factors:
+    # Attribute is considered continuous.
+    return squared_correlation_matrix(mus, ys)
+  if classifier == "threshold":
+    return threshold_score_matrix(mus, ys, mus_test, ys_test)
+
   num_latents = mus.shape[0]
   num_factors = ys.shape[0]
   score_matrix = np.zeros([num_latents, num_factors])
@@ -85,27 +109,141 @@ def compute_score_matrix(mus, ys, mus_test, ys_test, continuous_factors):
     for j in range(num_factors):
       mu_i = mus[i, :]
       y_j = ys[j, :]
-      if continuous_factors:
-        # Attribute is considered continuous.
-        cov_mu_i_y_j = np.cov(mu_i, y_j, ddof=1)
-        cov_mu_y = cov_mu_i_y_j[0, 1]**2
-        var_mu = cov_mu_i_y_j[0, 0]
-        var_y = cov_mu_i_y_j[1, 1]
-        if var_mu > 1e-12:
-          score_matrix[i, j] = cov_mu_y * 1. / (var_mu * var_y)
-        else:
-          score_matrix[i, j] = 0.
-      else:
-        # Attribute is considered discrete.
-        mu_i_test = mus_test[i, :]
-        y_j_test = ys_test[j, :]
-        classifier = svm.LinearSVC(C=0.01, class_weight="balanced")
+      # Attribute is considered discrete.
+      mu_i_test = mus_test[i, :]
+      y_j_test = ys_test[j, :]
+      classifier = svm.LinearSVC(C=0.01, class_weight="balanced")
+      with utils.timed_phase("fit"):
         classifier.fit(mu_i[:, np.newaxis], y_j)
-        pred = classifier.predict(mu_i_test[:, np.newaxis])
-        score_matrix[i, j] = np.mean(pred == y_j_test)
+      pred = classifier.predict(mu_i_test[:, np.newaxis])
+      score_matrix[i, j] = np.mean(pred == y_j_test)
+  return score_matrix
+
+
+def squared_correlation_matrix(mus, ys):
+  """Squared correlation of each latent with each factor (0 for constant latents)."""
+  mus = mus - mus.mean(axis=1, keepdims=True)
+  ys = ys - ys.mean(axis=1, keepdims=True)
+  ddof = mus.shape[1] - 1
+  cov_mu_y = (mus @ ys.T / ddof)**2
+  var_mu = np.sum(mus**2, axis=1) / ddof
+  var_y = np.sum(ys**2, axis=1) / ddof
+  with np.errstate(divide="ignore", invalid="ignore"):
+    score_matrix = cov_mu_y / (var_mu[:, np.newaxis] * var_y[np.newaxis, :])
+  score_matrix[var_mu <= 1e-12, :] = 0.
+  return score_matrix
+
+
+def threshold_score_matrix(mus, ys, mus_test, ys_test):
+  """Test accuracy of the best 1-D threshold classifier of each latent and factor.
+
+  Like the linear SVM on a single latent, the classifier splits the latent into
+  intervals which each predict one class. Here the classes are ordered by their
+  value (increasing or decreasing along the latent, some may get empty
+  intervals), and the thresholds are fitted exactly, maximizing the class
+  balanced training accuracy (like `class_weight="balanced"`), see
+  `fit_threshold_classifier`. The scores are not identical to those of the
+  SVM, which is strongly regularized (C=0.01) and often can't separate the
+  classes in the middle of the latent, so they are usually higher.
+  """
+  num_train = ys.shape[1]
+  labels, _ = utils._label_encode(  # pylint: disable=protected-access
+      np.concatenate([ys, ys_test], axis=1))
+  ys, ys_test = labels[:, :num_train], labels[:, num_train:]
+
+  order = np.argsort(mus, axis=1, kind="stable")
+  sorted_mus = np.take_along_axis(mus, order, axis=1)
+  score_matrix = np.zeros([mus.shape[0], ys.shape[0]])
+  for j in range(ys.shape[0]):
+    with utils.timed_phase("fit"):
+      thresholds, classes = fit_threshold_classifier(
+          sorted_mus, ys[j][order], labels[j].max() + 1)
+    pred = predict_threshold_classifier(thresholds, classes, mus_test)
+    score_matrix[:, j] = np.mean(pred == ys_test[j], axis=1)
   return score_matrix
 
 
+def fit_threshold_classifier(sorted_mus, sorted_ys, num_classes):
+  """Fits the thresholds of a 1-D classifier for each latent.
+
+  The classifier predicts the classes in the order of their value (or the
+  reverse), with class `classes[k]` predicted between `thresholds[k-1]` and
+  `thresholds[k]`. The thresholds maximize the training accuracy with balanced
+  class weights (each class has a total weight of 1).
+
+  The accuracy is the sum of the cumulative class weights up to each cut point
+  (between the classes of neighbouring intervals), so the best cut points are
+  found with a dynamic program over the intervals, for all latents and cut
+  points at once: O(num_latents * num_classes * num_train).
+
+  Args:
+    sorted_mus: Sorted codes (num_latents, num_train).
+    sorted_ys: Labels in [0, num_classes) of the samples of each sorted latent
+      (num_latents, num_train).
+    num_classes: Number of classes.
+
+  Returns:
+    Thresholds (num_latents, num_classes - 1) and predicted class of each
+    interval (num_latents, num_classes).
+  """
+  num_latents, num_train = sorted_mus.shape
+  counts = np.bincount(sorted_ys[0], minlength=num_classes)
+  weights = np.where(counts > 0, 1. / np.maximum(counts, 1), 0.)
+  # cumulative weight of each class (num_latents, num_classes, num_train + 1)
+  onehot = sorted_ys[:, np.newaxis, :] == np.arange(num_classes)[:, np.newaxis]
+  cumulative = np.zeros([num_latents, num_classes, num_train + 1])
+  np.cumsum(onehot * weights[:, np.newaxis], axis=-1, out=cumulative[..., 1:])
+  # cut points between equal values are not possible
+  valid = np.ones([num_latents, num_train + 1], dtype=bool)
+  valid[:, 1:-1] = sorted_mus[:, 1:] > sorted_mus[:, :-1]
+
+  positions = np.arange(num_train + 1)
+  best, best_cuts, best_classes = None, None, None
+  for classes in [np.arange(num_classes), np.arange(num_classes)[::-1]]:
+    # total[:, p] is the best accuracy with the current cut point at p
+    total = np.zeros([num_latents, num_train + 1])
+    argmax = []
+    for k in range(1, num_classes):
+      running = np.maximum.accumulate(total, axis=1)
+      argmax.append(np.maximum.accumulate(
+          np.where(total >= running, positions, 0), axis=1))
+      gain = cumulative[:, classes[k - 1]] - cumulative[:, classes[k]]
+      total = np.where(valid, running + gain, -np.inf)
+    cut = np.argmax(total, axis=1)
+    score = total[np.arange(num_latents), cut] + \
+      cumulative[:, classes[-1], -1]
+    cuts = [cut]
+    for idx in reversed(argmax[1:]):
+      cut = idx[np.arange(num_latents), cut]
+      cuts.append(cut)
+    cuts = np.stack(cuts[::-1], axis=1) if num_classes > 1 else \
+      np.zeros([num_latents, 0], dtype=np.int64)  # (num_latents, num_classes - 1)
+    if best is None:
+      best, best_cuts = score, cuts
+      best_classes = np.broadcast_to(classes, (num_latents, num_classes))
+    else:
+      better = score > best + 1e-12
+      best = np.where(better, score, best)
+      best_cuts = np.where(better[:, np.newaxis], cuts, best_cuts)
+      best_classes = np.where(better[:, np.newaxis], classes, best_classes)
+
+  # thresholds halfway between the samples at each cut point
+  padded = np.concatenate([np.full([num_latents, 1], -np.inf), sorted_mus,
+                           np.full([num_latents, 1], np.inf)], axis=1)
+  low = np.take_along_axis(padded, best_cuts, axis=1)
+  high = np.take_along_axis(padded, best_cuts + 1, axis=1)
+  thresholds = np.where(np.isinf(low) | np.isinf(high),
+                        np.where(np.isinf(low), low, high), (low + high) / 2)
+  return thresholds, best_classes
+
+
+def predict_threshold_classifier(thresholds, classes, mus):
+  """Predicted classes (num_latents, num) of the codes `mus` (see `fit_threshold_classifier`)."""
+  intervals = np.stack([np.searchsorted(t, mu, side="right")
+                        for t, mu in zip(thresholds, mus)])
+  return np.take_along_axis(classes, intervals, axis=1)
+
+
 def compute_avg_diff_top_two(matrix):
   sorted_matrix = np.sort(matrix, axis=0)
   return np.mean(sorted_matrix[-1, :] - sorted_matrix[-2, :])
\ No newline at end of file
@@ -0,0 +1,223 @@
+"""Torch implementations of the metric kernels.
+
+Each function mirrors the numpy version in `metric_utils` (or the metric module
+noted in its docstring) but runs on the device of its (torch tensor) inputs,
+so codes encoded on an accelerator never have to be copied to the host. The
+functions in `metric_utils` dispatch here when they are given torch tensors.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import math
+import torch
+
+
+def as_tensor(x, like=None):
+  """Converts x to a tensor (on the device of like, if provided)."""
+  device = None if like is None else like.device
+  return torch.as_tensor(x, device=device)
+
+
+def histogram_discretize(target, num_bins=20):
+  """Same bins as `metric_utils._histogram_discretize` (np.digitize with the
+  edges of np.histogram), using a batched binary search over the edges of
+  every row."""
+  x = target if target.is_floating_point() else target.double()
+  low, high = x.min(1).values, x.max(1).values
+  same = low == high
+  low, high = torch.where(same, low - 0.5, low), torch.where(same, high + 0.5,
+                                                             high)
+  # Edges as computed by np.linspace.
+  steps = torch.arange(num_bins + 1, dtype=x.dtype, device=x.device)
+  edges = steps * ((high - low) / num_bins).unsqueeze(1) + low.unsqueeze(1)
+  edges[:, -1] = high
+  bins = torch.searchsorted(edges[:, :-1].contiguous(), x.contiguous(),
+                            right=True)
+  return bins.to(target.dtype)
+
+
+def quantile_discretize(target, num_bins=20):
+  """Same bins as `metric_utils._quantile_discretize` (quantiles of each row
+  as edges, values equal to an edge fall into the upper bin)."""
+  x = target if target.is_floating_point() else target.double()
+  # Quantiles as computed by np.linspace, edges in float64 (as np.quantile).
+  steps = torch.arange(num_bins + 1, dtype=torch.float64, device=x.device)
+  q = (steps * (1. / num_bins))[1:-1]
+  edges = _quantile(x, q).T  # (num_rows, num_bins - 1)
+  bins = torch.searchsorted(edges.contiguous(), x.double().contiguous(),
+                            right=True)
+  return (bins + 1).to(target.dtype)
+
+
+DISCRETIZERS = {
+  "histogram": histogram_discretize,
+  "quantile": quantile_discretize,
+}
+
+
+def _quantile(x, q, dtype=torch.float64):
+  """Quantiles q of the last axis of x with linear interpolation (as
+  np.quantile), for inputs of any size (unlike torch.quantile).
+
+  The positions and interpolation weights are computed in float64 and the
+  values are interpolated in dtype like numpy does: float64 for an array of
+  quantiles, or the dtype of x for a single (Python float) quantile.
+
+  Returns:
+    Tensor of shape (len(q), *x.shape[:-1]).
+  """
+  values = x.sort(-1).values
+  q = torch.as_tensor(q, dtype=torch.float64, device=x.device)
+  pos = q * (x.shape[-1] - 1)
+  lower = pos.floor()
+  gamma = (pos - lower).view(-1, *([1] * (x.dim() - 1)))
+  lower = lower.long()
+  upper = torch.clamp(lower + 1, max=x.shape[-1] - 1)
+  lo = values[..., lower].movedim(-1, 0)
+  hi = values[..., upper].movedim(-1, 0)
+  diff = (hi - lo).to(dtype)
+  lo, hi = lo.to(dtype), hi.to(dtype)
+  # same as numpy's lerp, which is exact at both ends
+  return torch.where(gamma >= 0.5, hi - diff * (1 - gamma).to(dtype),
+                     lo + diff * gamma.to(dtype))
+
+
+def label_encode(x):
+  """Maps the values of each row to integers in [0, num_values), see
+  `metric_utils._label_encode`.
+
+  Returns:
+    Integer labels with the same shape as x and the number of labels.
+  """
+  if x.numel():
+    low, high = x.min().item(), x.max().item()
+    if low >= 0 and high < max(x.shape[-1], 256):
+      labels = x.long()
+      if not x.is_floating_point() or torch.equal(labels.to(x.dtype), x):
+        return labels, int(high) + 1
+  labels = torch.empty(x.shape, dtype=torch.long, device=x.device)
+  num_labels = 1
+  for i in range(x.shape[0]):
+    values, labels[i] = torch.unique(x[i], return_inverse=True)
+    num_labels = max(num_labels, len(values))
+  return labels, num_labels
+
+
+def _mutual_info_from_counts(counts):
+  """Mutual information of the joint histograms `counts` (..., num_a, num_b)."""
+  counts = counts.double()
+  total = counts.sum((-2, -1), keepdim=True)
+  marginal_a = counts.sum(-1, keepdim=True)
+  marginal_b = counts.sum(-2, keepdim=True)
+  terms = counts * (counts.log() + total.log() - marginal_a.log()
+                    - marginal_b.log())
+  terms = torch.where(counts > 0, terms, torch.zeros_like(terms))
+  mi = terms.sum((-2, -1)) / total[..., 0, 0]
+  return mi.clamp(min=0.)
+
+
+def discrete_mutual_info(mus, ys, chunk_size=2**24):
+  """Mutual information matrix (num_codes, num_factors) of discrete codes and
+  factors, see `metric_utils.discrete_mutual_info`."""
+  num_codes, num_points = mus.shape
+  num_factors = ys.shape[0]
+  ys, num_ys = label_encode(as_tensor(ys, like=mus))
+  m = torch.zeros(num_codes, num_factors, dtype=torch.float64,
+                  device=mus.device)
+  block = max(1, chunk_size // max(num_points, 1))
+  for start in range(0, num_codes, block):
+    codes, num_mus = label_encode(mus[start:start + block])
+    size = num_mus * num_ys
+    offsets = (torch.arange(len(codes), device=mus.device) * size).unsqueeze(1)
+    codes = codes * num_ys + offsets
+    for j in range(num_factors):
+      counts = torch.bincount((codes + ys[j]).view(-1),
+                              minlength=len(codes) * size)
+      m[start:start + block, j] = _mutual_info_from_counts(
+          counts.view(len(codes), num_mus, num_ys))
+  return m
+
+
+def discrete_entropy(ys):
+  """Discrete entropy of each factor, see `metric_utils.discrete_entropy`."""
+  num_factors, num_points = ys.shape
+  ys, num_ys = label_encode(ys)
+  offsets = (torch.arange(num_factors, device=ys.device) * num_ys).unsqueeze(1)
+  counts = torch.bincount((ys + offsets).view(-1),
+                          minlength=num_factors * num_ys)
+  counts = counts.view(num_factors, num_ys).double()
+  terms = torch.where(counts > 0, counts * counts.log(),
+                      torch.zeros_like(counts))
+  h = math.log(num_points) - terms.sum(-1) / num_points
+  return h.clamp(min=0.)
+
+
+def covariance(x):
+  """Unbiased covariance (in float64) of the rows of x, like np.cov."""
+  x = x.double()
+  centered = x - x.mean(1, keepdim=True)
+  return centered @ centered.T / (x.shape[1] - 1)
+
+
+def gaussian_total_correlation(cov):
+  """See `unsupervised_metrics.gaussian_total_correlation`."""
+  return 0.5 * (cov.diagonal().log().sum() - torch.linalg.slogdet(cov)[1])
+
+
+def gaussian_wasserstein_correlation(cov):
+  """See `unsupervised_metrics.gaussian_wasserstein_correlation`.
+
+  The trace of the square root of cov * diag(cov) is computed from the
+  eigenvalues of the similar symmetric matrix D^1/2 cov D^1/2 (D = diag(cov)).
+  """
+  scale = cov.diagonal().sqrt()
+  eigenvalues = torch.linalg.eigvalsh(cov * scale.unsqueeze(0)
+                                      * scale.unsqueeze(1))
+  return 2 * cov.trace() - 2 * eigenvalues.clamp(min=0.).sqrt().sum()
+
+
+def drop_constant_dims(ys):
+  """Rows of ys which are not constant, see `irs._drop_constant_dims`."""
+  return ys[ys.var(1, unbiased=False) > 0.]
+
+
+def group_max_diffs(factor, latents, diff_quantile=0.99):
+  """Quantile of the deviations from E[Z | g_i] within each group of constant
+  g_i, see `irs._group_max_diffs`.
+
+  Returns:
+    Tensor of shape (num distinct values, num latents), ordered by value.
+  """
+  order = torch.argsort(factor, stable=True)
+  _, counts = torch.unique_consecutive(factor[order], return_counts=True)
+  starts = torch.cumsum(counts, 0) - counts
+  latents = latents[order]
+  # as np.percentile(diffs, q=diff_quantile*100)
+  q = [diff_quantile * 100 / 100]
+  max_diffs = torch.zeros(len(starts), latents.shape[1], dtype=torch.float64,
+                          device=latents.device)
+  for size in torch.unique(counts).tolist():
+    selected = torch.nonzero(counts == size).view(-1)
+    # groups of shape (num groups, size, num latents)
+    index = starts[selected].unsqueeze(1) + torch.arange(size,
+                                                         device=latents.device)
+    groups = latents[index]
+    diffs = (groups - groups.mean(1, keepdim=True)).abs().transpose(1, 2)
+    max_diffs[selected] = _quantile(diffs, q, dtype=latents.dtype)[0].double()
+  return max_diffs
+
+
+def response_distance(responses, dist_type="rms", dim=1):
+  """Reduces the response differences along dim, see
+  `responses.response_mat`."""
+  if dist_type == "rms":
+    return responses.pow(2).mean(dim).sqrt()
+  if dist_type == "sqr":
+    return responses.pow(2).mean(dim)
+  if dist_type == "abs":
+    return responses.abs().mean(dim)
+  if dist_type == "l1":
+    return responses.abs().sum(dim)
+  if dist_type == "l2":
+    return responses.pow(2).sum(dim).sqrt()
+  return responses
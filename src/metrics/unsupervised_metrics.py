@@ -18,14 +18,17 @@
 """Unsupervised scores based on code covariance and mutual information."""
 from absl import logging
 from . import metric_utils as utils
+from . import torch_kernels
 import numpy as np
 import scipy
+import torch
 
 def unsupervised_metrics(ground_truth_data,
                          representation_function,
                          random_state,
                          num_train,
-                         batch_size=16):
+                         batch_size=16,
+                         num_covariance=None):
   """Computes unsupervised scores based on covariance and mutual information.
   Args:
     ground_truth_data: GroundTruthData to be sampled from.
@@ -35,16 +38,33 @@ def unsupervised_metrics(ground_truth_data,
     artifact_dir: Optional path to directory where artifacts can be saved.
     num_train: Number of points used for training.
     batch_size: Batch size for sampling.
+    num_covariance: If provided, the Gaussian scores use the covariance of
+      this many codes, accumulated batch by batch in constant memory, instead
+      of the num_train codes.
   Returns:
     Dictionary with scores.
   """
-  scores = {}
   logging.info("Generating training set.")
   mus_train, _ = utils.generate_batch_factor_code(
       ground_truth_data, representation_function, num_train, random_state,
       batch_size)
+  cov_mus = None
+  if num_covariance is not None:
+    cov_mus = utils.streaming_covariance(
+        ground_truth_data, representation_function, num_covariance,
+        random_state, batch_size).covariance()
+  return _compute_unsupervised_metrics(mus_train, cov_mus=cov_mus)
+
+
+def _compute_unsupervised_metrics(mus_train, discretizer="histogram",
+                                  cov_mus=None):
+  """Computes scores based on the codes alone (using the covariance cov_mus
+  instead of the covariance of mus_train if provided)."""
+  scores = {}
   num_codes = mus_train.shape[0]
-  cov_mus = np.cov(mus_train)
+  if cov_mus is None:
+    cov_mus = torch_kernels.covariance(mus_train) \
+      if isinstance(mus_train, torch.Tensor) else np.cov(mus_train)
   assert num_codes == cov_mus.shape[0]
 
   # Gaussian total correlation.
@@ -53,13 +73,14 @@ def unsupervised_metrics(ground_truth_data,
   # Gaussian Wasserstein correlation.
   scores["gaussian_wasserstein_correlation"] = gaussian_wasserstein_correlation(
       cov_mus)
+  cov_mus = utils._to_numpy(cov_mus)
   scores["gaussian_wasserstein_correlation_norm"] = (
       scores["gaussian_wasserstein_correlation"] / np.sum(np.diag(cov_mus)))
 
   scores['covariance_matrix'] = cov_mus
 
   # Compute average mutual information between different factors.
-  mus_discrete = utils.make_discretizer(mus_train)
+  mus_discrete = utils.make_discretizer(mus_train, discretizer_fn=discretizer)
   mutual_info_matrix = utils.discrete_mutual_info(mus_discrete, mus_discrete)
   np.fill_diagonal(mutual_info_matrix, 0)
   mutual_info_score = np.sum(mutual_info_matrix) / (num_codes**2 - num_codes)
@@ -89,6 +110,8 @@ def gaussian_total_correlation(cov):
   Returns:
     Scalar with total correlation.
   """
+  if isinstance(cov, torch.Tensor):
+    return torch_kernels.gaussian_total_correlation(cov).item()
   return 0.5 * (np.sum(np.log(np.diag(cov))) - np.linalg.slogdet(cov)[1])
 
 
@@ -99,5 +122,7 @@ def gaussian_wasserstein_correlation(cov):
   Returns:
     Scalar with score.
   """
+  if isinstance(cov, torch.Tensor):
+    return torch_kernels.gaussian_wasserstein_correlation(cov).item()
   sqrtm = scipy.linalg.sqrtm(cov * np.expand_dims(np.diag(cov), axis=1))
   return 2 * np.trace(cov) - 2 * np.trace(sqrtm)
\ No newline at end of file
@@ -7,6 +7,8 @@ from torch import distributions as distrib
 
 from omnilearn import util
 
+from .metrics.torch_kernels import response_distance
+
 
 
 def compute_response(Q, encode, decode, include_q2=False,
@@ -77,18 +79,7 @@ def response_mat(Q, encode, decode, scales=None, dist_type='rms', **resp_kwargs)
 	if scales is not None:
 		R /= scales.view(1, 1, -1)
 	
-	if dist_type == 'rms':
-		R = R.pow(2).mean(1).sqrt()
-	elif dist_type == 'sqr':
-		R = R.pow(2).mean(1)
-	elif dist_type == 'abs':
-		R = R.abs().mean(1)
-	elif dist_type == 'l1':
-		R = R.abs().sum(1)
-	elif dist_type == 'l2':
-		R = R.pow(2).sum(1).sqrt()
-	
-	return R
+	return response_distance(R, dist_type, dim=1)
 
 
 # from full interventions
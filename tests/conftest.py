@@ -0,0 +1,79 @@
+"""Toy models and ground truth data shared by the tests."""
+import numpy as np
+import pytest
+import torch
+
+import omnifig as fig
+
+
+class FactorData(object):
+  """Ground truth data which behaves like omnilearn's `JointFactorSampler`: the
+  factors are sampled as tensors from torch's global random number generator
+  (ignoring `random_state`), `factors_num_values` is a tensor, and each
+  combination of factors has a fixed observation."""
+
+  def __init__(self, sizes=(3, 4, 5), dim=8):
+    self.sizes = list(sizes)
+    generator = torch.Generator().manual_seed(0)
+    self.weights = torch.randn(len(sizes), dim, generator=generator)
+    self.texture = torch.randn(len(sizes), dim, generator=generator)
+
+  @property
+  def factors_num_values(self):
+    return torch.tensor(self.sizes)
+
+  @property
+  def num_factors(self):
+    return len(self.sizes)
+
+  def sample_factors(self, num, random_state):
+    return torch.rand(num, len(self.sizes)).mul(self.factors_num_values).long()
+
+  def sample_observations_from_factors(self, factors, random_state):
+    factors = torch.as_tensor(np.asarray(factors)).float()
+    return factors @ self.weights + 0.3 * torch.sin(3 * factors @ self.texture)
+
+  def sample(self, num, random_state):
+    factors = self.sample_factors(num, random_state)
+    return factors, self.sample_observations_from_factors(factors, random_state)
+
+  def sample_observations(self, num, random_state):
+    return self.sample(num, random_state)[1]
+
+
+class LinearModel(object):
+  """Encoder with a fixed linear map, counting the encoded observations."""
+
+  def __init__(self, dim=8, latent_dim=4, seed=1):
+    generator = torch.Generator().manual_seed(seed)
+    self.weights = torch.randn(dim, latent_dim, generator=generator)
+    self.latent_dim = latent_dim
+    self.num_encoded = 0
+
+  def switch_to(self, mode):
+    pass
+
+  def encode(self, observations):
+    self.num_encoded += len(observations)
+    return observations @ self.weights
+
+
+def make_metric(cls, model=None, dataset=None, **settings):
+  """Creates the evaluator `cls` with the given settings (on the cpu)."""
+  A = fig.get_config()
+  settings.setdefault("seed", 0)
+  settings.setdefault("device", "cpu")
+  with A.silenced():
+    for key, value in settings.items():
+      A.push(key, value, silent=True)
+    return cls(A, model=model, dataset=dataset)
+
+
+@pytest.fixture
+def data():
+  return FactorData()
+
+
+@pytest.fixture
+def model():
+  return LinearModel()
@@ -0,0 +1,45 @@
+"""Importance backends of `src.metrics.dci`."""
+import warnings
+
+import numpy as np
+import pytest
+
+from src.metrics import dci
+
+
+def _codes(num, random_state):
+  ys = random_state.randint(4, size=(2, num))
+  mus = np.concatenate([ys + 0.3 * random_state.randn(2, num),
+                        random_state.randn(2, num)])
+  return mus, ys
+
+
+@pytest.mark.parametrize("backend", sorted(dci.IMPORTANCE_BACKENDS))
+def test_importance_backends(backend):
+  random_state = np.random.RandomState(0)
+  mus_train, ys_train = _codes(300, random_state)
+  mus_test, ys_test = _codes(100, random_state)
+  np.random.seed(0)
+  with warnings.catch_warnings():
+    # no deprecated sklearn options (or convergence problems)
+    warnings.simplefilter("error")
+    importance, train_acc, test_acc = dci.compute_importance(
+        mus_train, ys_train, mus_test, ys_test, backend=backend)
+  assert importance.shape == (4, 2)
+  assert np.all(importance >= 0)
+  # each factor is read from its own code
+  np.testing.assert_array_equal(importance.argmax(0), [0, 1])
+  assert train_acc > 0.5 and test_acc > 0.5
+
+
+def test_importance_does_not_depend_on_n_jobs():
+  random_state = np.random.RandomState(1)
+  mus_train, ys_train = _codes(200, random_state)
+  mus_test, ys_test = _codes(100, random_state)
+  outs = []
+  for n_jobs in [1, 2]:
+    np.random.seed(1)
+    outs.append(dci._compute_dci(mus_train, ys_train, mus_test, ys_test,
+                                 backend="hist-gbt", n_jobs=n_jobs))
+  for key, value in outs[0].items():
+    np.testing.assert_allclose(outs[1][key], value)
@@ -0,0 +1,201 @@
+"""Sharing, storing and batching of the encoded samples of the evaluators."""
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import torch
+
+import omnifig as fig
+
+from src import evaluate
+
+from conftest import LinearModel, make_metric
+
+
+def _assert_same_scores(out, expected):
+  scores, results = out
+  ref_scores, ref_results = expected
+  assert scores.keys() == ref_scores.keys()
+  for key, value in ref_scores.items():
+    np.testing.assert_allclose(scores[key], value)
+  for key, value in ref_results.items():
+    if key != "timing":
+      np.testing.assert_allclose(results[key], value)
+
+
+def test_metrics_share_cached_codes(model, data):
+  settings = dict(num_train=300, num_test=100, batch_size=64)
+  mig = make_metric(evaluate.MIG, model, data, **settings)
+  sap = make_metric(evaluate.SAP, model, data, **settings)
+  expected = [mig.compute(), sap.compute()]
+
+  cache = evaluate.Representation_Cache()
+  for metric in [mig, sap]:
+    metric.set_cache(cache)
+  model.num_encoded = 0
+  _assert_same_scores(mig.compute(), expected[0])
+  assert model.num_encoded == 300
+  # only the test split of SAP is new
+  _assert_same_scores(sap.compute(), expected[1])
+  assert model.num_encoded == 400
+  assert len(cache) == 2
+
+  mig.compute()
+  assert model.num_encoded == 400
+
+
+def test_cache_is_keyed_by_seed(model, data):
+  cache = evaluate.Representation_Cache()
+  metrics = [make_metric(evaluate.MIG, model, data, num_train=200, seed=seed)
+             for seed in [0, 1]]
+  codes = []
+  for metric in metrics:
+    metric.set_cache(cache)
+    codes.append(metric.sample_codes(200)[0])
+  assert len(cache) == 2
+  assert not np.array_equal(codes[0], codes[1])
+
+
+def test_stored_codes_are_reused(model, data, tmp_path):
+  metric = make_metric(evaluate.MIG, model, data, num_train=200)
+  expected = metric.compute()
+  metric.set_cache(evaluate.Representation_Cache(tmp_path, {"checkpoint": "a"}))
+  metric.compute()
+
+  model.num_encoded = 0
+  metric.set_cache(evaluate.Representation_Cache(tmp_path, {"checkpoint": "a"}))
+  _assert_same_scores(metric.compute(), expected)
+  assert model.num_encoded == 0
+  assert isinstance(metric.sample_codes(200)[0], np.memmap)
+
+  # codes of another checkpoint are encoded again
+  metric.set_cache(evaluate.Representation_Cache(tmp_path, {"checkpoint": "b"}))
+  metric.compute()
+  assert model.num_encoded == 200
+
+
+def test_stored_codes_are_keyed_by_dataset(model, data, tmp_path):
+  other = type(data)()
+  data.root, other.root = "dsprites", "3dshapes"
+  metric = make_metric(evaluate.MIG, model, data, num_train=200)
+  metric.set_cache(evaluate.Representation_Cache(tmp_path))
+  metric.compute()
+
+  model.num_encoded = 0
+  metric = make_metric(evaluate.MIG, model, other, num_train=200)
+  cache = evaluate.Representation_Cache(tmp_path)
+  metric.set_cache(cache)
+  metric.compute()
+  assert model.num_encoded == 200
+  assert len(cache.get_manifest()) == 2
+
+
+def test_model_batch_matches_single_models(data):
+  models = [LinearModel(seed=1), LinearModel(latent_dim=3, seed=2)]
+  metrics = [make_metric(evaluate.SAP, model, data, num_train=200, num_test=100)
+             for model in models]
+  expected = [metric.compute() for metric in metrics]
+
+  batch = evaluate.Model_Batch()
+  for model, metric in zip(models, metrics):
+    model.num_encoded = 0
+    cache = evaluate.Representation_Cache()
+    batch.add(model, cache)
+    metric.set_cache(cache)
+  _assert_same_scores(metrics[0].compute(), expected[0])
+  # the observations were encoded by both models at once
+  assert [model.num_encoded for model in models] == [300, 300]
+  _assert_same_scores(metrics[1].compute(), expected[1])
+  assert [model.num_encoded for model in models] == [300, 300]
+
+
+_forked_metrics = {} # inherited by the forked workers
+
+
+def _compute_forked(name):
+  return _forked_metrics[name].compute()
+
+
+def test_forked_workers_match_serial(model, data):
+  settings = dict(num_train=200, num_test=100)
+  _forked_metrics["mig"] = make_metric(evaluate.MIG, model, data, **settings)
+  _forked_metrics["sap"] = make_metric(evaluate.SAP, model, data, **settings)
+  expected = {name: metric.compute()
+              for name, metric in _forked_metrics.items()}
+
+  ctx = mp.get_context("fork")
+  pool = ProcessPoolExecutor(2, mp_context=ctx,
+                             initializer=evaluate._init_eval_worker,
+                             initargs=(ctx.Value("i", 0), None, 1))
+  try:
+    evaluate._start_pool(pool, 2)
+    assert pool.submit(torch.get_num_threads).result() == 1
+    for name, out in zip(expected, pool.map(_compute_forked, expected)):
+      _assert_same_scores(out, expected[name])
+  finally:
+    pool.shutdown()
+    _forked_metrics.clear()
+
+
+def test_fit_pool_matches_serial(model, data):
+  settings = dict(num_train=200, num_test=100)
+  metrics = [make_metric(cls, model, data, **settings) for cls in
+             [evaluate.MIG, evaluate.SAP, evaluate.ModularityExplicitness]]
+  expected = [metric.compute() for metric in metrics]
+
+  A = fig.get_config()
+  A.push("fit-workers", 2, silent=True)
+  pool = evaluate._create_fit_pool(A)
+  try:
+    # fitting does not depend on which other metrics were prepared before
+    jobs = [pool.submit(metric.prepare()) for metric in reversed(metrics)][::-1]
+    for metric, job, reference in zip(metrics, jobs, expected):
+      _assert_same_scores(metric.collect(job.result()), reference)
+  finally:
+    pool.shutdown()
+
+
+def test_streamed_covariance_scores_have_no_interval(model, data):
+  settings = {"num_train": 200, "num_covariance": 300}
+  metric = make_metric(evaluate.UnsupervisedMetrics, model, data,
+                       bootstrap=20, **settings)
+  scores, results = metric.compute()
+  # the gaussian scores do not depend on the resampled codes
+  assert "mutual_info_score_bootstrap" in results
+  assert not any(key.startswith("gaussian") and key.endswith("_bootstrap")
+                 for key in results)
+
+  metric = make_metric(evaluate.UnsupervisedMetrics, model, data, adaptive=True,
+                       **{"adaptive-start": 0.25, "adaptive-tol": 0.},
+                       **settings)
+  assert metric.adaptive_score == "mutual_info_score"
+  scores, results = metric.compute()
+  low, high = results["mutual_info_score_interval"]
+  assert high > low
+
+
+def test_adaptive_sample_of_full_size_matches_compute(model, data):
+  expected = make_metric(evaluate.MIG, model, data, num_train=200).compute()
+  metric = make_metric(evaluate.MIG, model, data, num_train=200, adaptive=True,
+                       **{"adaptive-start": 1.})
+  out = metric.compute()
+  _assert_same_scores(out, expected)
+  scores, results = out
+  assert results["adaptive_fraction"] == 1.
+  low, high = results["discrete_mig_interval"]
+  assert low <= scores["discrete_mig"] <= high
+
+
+def test_adaptive_sample_encodes_each_observation_once(model, data):
+  metric = make_metric(evaluate.SAP, model, data, num_train=200, num_test=100,
+                       adaptive=True,
+                       **{"adaptive-start": 0.25, "adaptive-tol": 0.})
+  model.num_encoded = 0
+  results = metric.compute()[1]
+  assert results["adaptive_fraction"] == 1.
+  assert model.num_encoded == 300
+
+
+def test_adaptive_requires_resampling(model, data):
+  metric = make_metric(evaluate.BetaVAE, model, data, adaptive=True)
+  assert not metric.adaptive
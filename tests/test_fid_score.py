@@ -0,0 +1,73 @@
+"""Regression tests of the Frechet distance and the cached reference statistics
+in `metrics.fid_score`."""
+import numpy as np
+from scipy import linalg
+
+from metrics import fid_score
+
+
+def _reference_frechet_distance(mu1, sigma1, mu2, sigma2):
+  diff = mu1 - mu2
+  covmean = linalg.sqrtm(sigma1.dot(sigma2))
+  return (diff.dot(diff) + np.trace(sigma1) + np.trace(sigma2)
+          - 2 * np.trace(covmean.real))
+
+
+def _statistics(random_state, num, dim, scale=1.):
+  x = random_state.randn(num, dim) @ random_state.randn(dim, dim) * scale
+  return x.mean(0), np.cov(x.T)
+
+
+def test_frechet_distance():
+  random_state = np.random.RandomState(0)
+  mu1, sigma1 = _statistics(random_state, 200, 8)
+  mu2, sigma2 = _statistics(random_state, 150, 8, scale=2.)
+  np.testing.assert_allclose(
+      fid_score.calculate_frechet_distance(mu1, sigma1, mu2, sigma2),
+      _reference_frechet_distance(mu1, sigma1, mu2, sigma2), rtol=1e-8)
+
+
+def test_frechet_distance_of_singular_covariances():
+  random_state = np.random.RandomState(1)
+  # fewer points than dimensions
+  mu1, sigma1 = _statistics(random_state, 5, 10)
+  mu2, sigma2 = _statistics(random_state, 7, 10)
+  np.testing.assert_allclose(
+      fid_score.calculate_frechet_distance(mu1, sigma1, mu2, sigma2),
+      _reference_frechet_distance(mu1, sigma1, mu2, sigma2), rtol=1e-5)
+  # the square roots of the vanishing eigenvalues are only exact up to
+  # sqrt(rounding)
+  np.testing.assert_allclose(
+      fid_score.calculate_frechet_distance(mu1, sigma1, mu1, sigma1), 0.,
+      atol=1e-5 * np.trace(sigma1))
+
+
+def test_accumulate_statistics():
+  activations = np.random.RandomState(2).randn(90, 6)
+  stats = None
+  for start in range(0, 90, 25):
+    stats = fid_score.accumulate_statistics(
+        [activations[start:start + 25]], stats)
+  np.testing.assert_allclose(stats.mean, activations.mean(0))
+  np.testing.assert_allclose(stats.covariance(), np.cov(activations.T))
+
+
+def test_reference_statistics_cache(tmp_path):
+  random_state = np.random.RandomState(3)
+  mu, sigma = _statistics(random_state, 20, 4)
+  calls = []
+
+  def compute():
+    calls.append(1)
+    return mu, sigma
+
+  cache = fid_score.ReferenceStatistics(str(tmp_path))
+  for _ in range(2):
+    cached_mu, cached_sigma = cache.get("data", "train", 4, compute,
+                                        fingerprint="a")
+    np.testing.assert_allclose(cached_mu, mu)
+    np.testing.assert_allclose(cached_sigma, sigma)
+  assert len(calls) == 1
+  cache.get("data", "test", 4, compute, fingerprint="a")
+  cache.get("data", "train", 4, compute, fingerprint="b")
+  assert len(calls) == 3
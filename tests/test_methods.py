@@ -0,0 +1,94 @@
+"""Inception statistics of several sources computed in a single pass, and the
+stored reference features of the KID."""
+import numpy as np
+import torch
+
+from src import methods
+
+
+class FakeFID(object):
+  """Stands in for the inception model with a fixed linear map."""
+
+  def __init__(self, n_samples=50, batch_size=16, dim=4):
+    self.n_samples, self.batch_size, self.dim = n_samples, batch_size, dim
+    self.weights = torch.randn(6, dim,
+                               generator=torch.Generator().manual_seed(0))
+    self.calls = []
+
+  def _load_inception(self):
+    pass
+
+  def inception(self, samples):
+    self.calls.append(len(samples))
+    return samples @ self.weights
+
+
+def _sources():
+  def source(seed):
+    generator = torch.Generator().manual_seed(seed)
+    return lambda num: torch.randn(num, 6, generator=generator) * seed
+  return {"rec": source(1), "hybrid": source(2), "prior": source(3)}
+
+
+def test_single_pass_matches_separate_sources(monkeypatch):
+  monkeypatch.setattr(methods, "apply_inception",
+                      lambda samples, inception: inception(samples))
+  fid = FakeFID()
+  sources = _sources()
+  references = {"reference": _sources()["prior"]}
+  features = {"hybrid": [], "reference": []}
+  out = methods.Autoencoder._compute_fid_stats(
+      None, fid, sources, {}, features=features, num_features=20,
+      references=references)
+  # one inception call per batch for all sources (and the reference until its
+  # 20 features are kept)
+  assert fid.calls == [64, 64, 48, 6]
+  assert "reference_fid_stats" not in out
+
+  for name, generate_fn in _sources().items():
+    separate = FakeFID()
+    expected = methods.Autoencoder._compute_fid_stats(
+        None, separate, {name: generate_fn}, {})
+    assert separate.calls == [16, 16, 16, 2]
+    for x, y in zip(out[f"{name}_fid_stats"], expected[f"{name}_fid_stats"]):
+      np.testing.assert_allclose(np.asarray(x), np.asarray(y), rtol=1e-6)
+
+  kept = {}
+  for name, generate_fn in [("hybrid", _sources()["hybrid"]),
+                            ("reference", _sources()["prior"])]:
+    kept[name] = torch.cat([generate_fn(16), generate_fn(16)])[:20]
+  for name, feats in features.items():
+    assert feats.shape == (20, 4)
+    np.testing.assert_allclose(feats.numpy(),
+                               (kept[name] @ fid.weights).numpy(), rtol=1e-5)
+
+
+class ReferenceData(object):
+  """Dataset with the location of its FID stats."""
+
+  def __init__(self, root, fid_ident=None):
+    self.root, self.fid_ident = root, fid_ident
+
+
+def test_kid_reference_is_stored_separately(tmp_path):
+  dataset = ReferenceData(tmp_path, fid_ident="celeba")
+  stats = tmp_path / "celeba_fid_stats.h5"
+  stats.write_bytes(b"stats")
+  features = torch.randn(30, 4)
+
+  assert methods._load_kid_reference(dataset, "train", 4, 10) is None
+  methods._store_kid_reference(dataset, "train", 4, features)
+  np.testing.assert_array_equal(
+      methods._load_kid_reference(dataset, "train", 4, 20).numpy(),
+      features[:20].numpy())
+  # not enough features, or another split or dimension
+  assert methods._load_kid_reference(dataset, "train", 4, 40) is None
+  assert methods._load_kid_reference(dataset, "test", 4, 10) is None
+  assert methods._load_kid_reference(dataset, "train", 8, 10) is None
+
+  # replaced as a whole, without touching the FID stats
+  methods._store_kid_reference(dataset, "train", 4, features[:15])
+  assert methods._load_kid_reference(dataset, "train", 4, 20) is None
+  assert stats.read_bytes() == b"stats"
+  assert sorted(path.name for path in tmp_path.iterdir()) == [
+      "celeba_fid_stats.h5", "celeba_kid_features_train_4.npy"]
@@ -0,0 +1,164 @@
+"""Regression tests of the metric kernels against the sklearn / numpy reference
+implementations they replace."""
+import numpy as np
+import pytest
+import torch
+from sklearn.metrics import roc_auc_score
+from sklearn.metrics.pairwise import polynomial_kernel
+from sklearn.preprocessing import MultiLabelBinarizer
+
+from src.metrics import bootstrap
+from src.metrics import irs
+from src.metrics import kid
+from src.metrics import metric_utils as utils
+from src.metrics import modularity_explicitness
+
+
+def _reference_group_max_diffs(factor, latents, diff_quantile):
+  max_diffs = []
+  for value in np.unique(factor):
+    match = factor == value
+    diffs = np.abs(latents[match, :] - np.mean(latents[match, :], axis=0))
+    max_diffs.append(np.percentile(diffs, q=diff_quantile * 100, axis=0))
+  return np.array(max_diffs)
+
+
+@pytest.mark.parametrize("diff_quantile", [0.99, 1.])
+def test_group_max_diffs(diff_quantile):
+  random_state = np.random.RandomState(2)
+  factor = random_state.randint(6, size=250) * 1.5
+  latents = random_state.randn(250, 4)
+  np.testing.assert_allclose(
+      irs._group_max_diffs(factor, latents, diff_quantile),
+      _reference_group_max_diffs(factor, latents, diff_quantile))
+
+
+def test_scalable_disentanglement_score():
+  random_state = np.random.RandomState(3)
+  factors = random_state.randint(5, size=(300, 3))
+  latents = np.concatenate([factors[:, [0, 2]] * 1.,
+                            random_state.randn(300, 2)], axis=1)
+  latents += 0.1 * random_state.randn(*latents.shape)
+  scores = irs.scalable_disentanglement_score(factors, latents)
+
+  max_deviations = np.max(np.abs(latents - latents.mean(axis=0)), axis=0)
+  cum_deviations = np.stack([
+      _reference_group_max_diffs(factors[:, i], latents, 0.99).mean(0)
+      for i in range(factors.shape[1])], axis=1)
+  irs_matrix = 1. - cum_deviations / max_deviations[:, np.newaxis]
+  np.testing.assert_allclose(scores["IRS_matrix"], irs_matrix)
+  np.testing.assert_allclose(
+      scores["avg_score"],
+      np.average(irs_matrix.max(axis=1), weights=max_deviations))
+
+
+def _reference_roc_auc(labels, scores):
+  mlb = MultiLabelBinarizer()
+  return roc_auc_score(mlb.fit_transform(np.expand_dims(labels, 1)), scores)
+
+
+def test_multiclass_roc_auc():
+  random_state = np.random.RandomState(0)
+  labels = random_state.randint(4, size=300)
+  scores = random_state.rand(300, 4) + 0.5 * np.eye(4)[labels]
+  # ties between the scores
+  scores = scores.round(1)
+  np.testing.assert_allclose(
+      modularity_explicitness.multiclass_roc_auc(labels, scores,
+                                                 np.arange(4)),
+      _reference_roc_auc(labels, scores))
+
+
+def test_multiclass_roc_auc_of_present_classes():
+  random_state = np.random.RandomState(1)
+  labels = random_state.choice([1, 3, 4], size=200)
+  classes = np.arange(5)
+  scores = random_state.rand(200, 5)
+  present = np.isin(classes, labels)
+  np.testing.assert_allclose(
+      modularity_explicitness.multiclass_roc_auc(labels, scores, classes),
+      _reference_roc_auc(labels, scores[:, present]))
+
+
+def test_explicitness_does_not_depend_on_n_jobs():
+  random_state = np.random.RandomState(9)
+  ys = random_state.randint(4, size=(3, 300))
+  mus = ys[[0, 1, 2, 0]] + random_state.randn(4, 300)
+  outs = []
+  for n_jobs in [1, 3]:
+    np.random.seed(9)
+    outs.append(modularity_explicitness._compute_modularity_explicitness(
+        mus[:, :200], ys[:, :200], mus[:, 200:], ys[:, 200:], n_jobs=n_jobs))
+  for key, value in outs[0].items():
+    np.testing.assert_allclose(outs[1][key], value)
+
+
+def test_bootstrap_weights():
+  indices = bootstrap.bootstrap_indices(30, 5, np.random.RandomState(7))
+  weights = bootstrap.bootstrap_weights(indices, 30)
+  for resample, counts in zip(indices, weights):
+    np.testing.assert_array_equal(counts, np.bincount(resample, minlength=30))
+
+
+def test_weighted_kernels_match_resampled_data():
+  random_state = np.random.RandomState(8)
+  ys = random_state.randint(4, size=(2, 80))
+  mus = ys[[0, 1, 0]] + random_state.randint(3, size=(3, 80))
+  codes = random_state.randn(3, 80)
+  indices = bootstrap.bootstrap_indices(80, 6, random_state)
+  weights = bootstrap.bootstrap_weights(indices, 80)
+
+  mutual_info = bootstrap.weighted_discrete_mutual_info(mus, ys, weights)
+  small_chunks = bootstrap.weighted_discrete_mutual_info(mus, ys, weights,
+                                                         chunk_size=500)
+  entropy = bootstrap.weighted_discrete_entropy(ys, weights)
+  covariance = bootstrap.weighted_covariance(codes, weights)
+  for b, resample in enumerate(indices):
+    reference = utils.discrete_mutual_info(mus[:, resample], ys[:, resample])
+    np.testing.assert_allclose(mutual_info[b], reference, atol=1e-12)
+    np.testing.assert_allclose(small_chunks[b], reference, atol=1e-12)
+    np.testing.assert_allclose(entropy[b],
+                               utils.discrete_entropy(ys[:, resample]),
+                               atol=1e-12)
+    np.testing.assert_allclose(covariance[b], np.cov(codes[:, resample]))
+
+
+def _reference_mmd2_unbiased(x, y):
+  m, n = len(x), len(y)
+  kxx = polynomial_kernel(x, x)
+  kyy = polynomial_kernel(y, y)
+  kxy = polynomial_kernel(x, y)
+  return ((kxx.sum() - np.trace(kxx)) / (m * (m - 1))
+          + (kyy.sum() - np.trace(kyy)) / (n * (n - 1))
+          - 2 * kxy.mean())
+
+
+@pytest.mark.parametrize("block_size", [1024, 16, 7])
+def test_mmd2_unbiased(block_size):
+  random_state = np.random.RandomState(4)
+  x = random_state.randn(50, 6)
+  y = random_state.randn(40, 6) + 0.3
+  np.testing.assert_allclose(
+      kid.mmd2_unbiased(torch.from_numpy(x), torch.from_numpy(y), block_size),
+      _reference_mmd2_unbiased(x, y))
+
+
+def test_kernel_inception_distance():
+  random_state = np.random.RandomState(5)
+  x = random_state.randn(60, 6)
+  y = random_state.randn(50, 6) * 1.2
+  mean, std = kid.kernel_inception_distance(x, y, num_subsets=0)
+  np.testing.assert_allclose(mean, _reference_mmd2_unbiased(x, y))
+  assert std == 0.
+
+  mean, std = kid.kernel_inception_distance(
+      x, y, num_subsets=4, subset_size=20, block_size=8,
+      random_state=np.random.RandomState(6))
+  subsets = np.random.RandomState(6)
+  estimates = []
+  for _ in range(4):
+    idx_x = subsets.choice(len(x), 20, replace=False)
+    idx_y = subsets.choice(len(y), 20, replace=False)
+    estimates.append(_reference_mmd2_unbiased(x[idx_x], y[idx_y]))
+  np.testing.assert_allclose([mean, std],
+                             [np.mean(estimates), np.std(estimates)])
@@ -0,0 +1,154 @@
+"""Regression tests of the kernels in `src.metrics.metric_utils` against the
+sklearn / numpy reference implementations they replace."""
+import numpy as np
+import pytest
+import torch
+from sklearn.metrics import mutual_info_score
+
+from src.metrics import metric_utils as utils
+
+from conftest import FactorData
+
+
+class NoisyFactorData(FactorData):
+  """Observations with noise drawn from the numpy random state."""
+
+  def sample_observations_from_factors(self, factors, random_state):
+    observations = super(NoisyFactorData,
+                         self).sample_observations_from_factors(factors,
+                                                                random_state)
+    noise = random_state.randn(*observations.shape).astype(np.float32)
+    return observations + 0.1 * torch.from_numpy(noise)
+
+
+def _draw(ground_truth_data, random_state):
+  batches = [ground_truth_data.sample(16, random_state) for _ in range(5)]
+  # other draws from the random state and torch's generator in between
+  batches.append((random_state.randint(100, size=3), torch.rand(3)))
+  batches.extend(ground_truth_data.sample(16, random_state) for _ in range(3))
+  batches.append((torch.rand(2), None))
+  batches.extend(ground_truth_data.sample(16, random_state) for _ in range(2))
+  # final partial batch
+  batches.append(ground_truth_data.sample(5, random_state))
+  return batches
+
+
+@pytest.mark.parametrize("data_cls", [FactorData, NoisyFactorData])
+def test_prefetch_matches_direct_sampling(data_cls):
+  data = data_cls()
+  torch.manual_seed(7)
+  expected = _draw(data, np.random.RandomState(7)) + [(torch.rand(4), None)]
+
+  torch.manual_seed(7)
+  random_state = np.random.RandomState(7)
+  with utils.PrefetchGroundTruthData(data, queue_size=3,
+                                     pin_memory=False) as prefetched:
+    batches = _draw(prefetched, random_state)
+  # later draws continue from the same states
+  batches.append((torch.rand(4), None))
+  assert len(batches) == len(expected)
+  for batch, reference in zip(batches, expected):
+    for x, y in zip(batch, reference):
+      if y is not None:
+        np.testing.assert_array_equal(np.asarray(x), np.asarray(y))
+  reference_state = np.random.RandomState(7)
+  torch.manual_seed(7)
+  _draw(data, reference_state)
+  assert utils._same_random_state(random_state.get_state(),
+                                  reference_state.get_state())
+
+
+def _reference_mutual_info(mus, ys):
+  m = np.zeros([mus.shape[0], ys.shape[0]])
+  for i in range(mus.shape[0]):
+    for j in range(ys.shape[0]):
+      m[i, j] = mutual_info_score(ys[j, :], mus[i, :])
+  return m
+
+
+@pytest.mark.parametrize("chunk_size", [2**24, 150])
+def test_discrete_mutual_info(chunk_size):
+  random_state = np.random.RandomState(0)
+  ys = random_state.randint(5, size=(3, 200))
+  mus = (ys[[0, 1, 2, 0]] + random_state.randint(3, size=(4, 200))) * 2 + 7
+  np.testing.assert_allclose(utils.discrete_mutual_info(mus, ys, chunk_size),
+                             _reference_mutual_info(mus, ys), atol=1e-12)
+
+
+def test_discrete_mutual_info_of_arbitrary_values():
+  random_state = np.random.RandomState(1)
+  ys = random_state.choice([-2, 1, 300], size=(2, 100))
+  mus = (10 * random_state.randn(3, 100)).astype(np.int64)
+  np.testing.assert_allclose(utils.discrete_mutual_info(mus, ys),
+                             _reference_mutual_info(mus, ys), atol=1e-12)
+
+
+def test_discrete_entropy():
+  random_state = np.random.RandomState(2)
+  ys = np.concatenate([random_state.randint(6, size=(3, 150)),
+                       np.full((1, 150), 4)])
+  reference = np.array([mutual_info_score(y, y) for y in ys])
+  np.testing.assert_allclose(utils.discrete_entropy(ys), reference, atol=1e-12)
+
+
+def _reference_histogram_discretize(target, num_bins):
+  discretized = np.zeros_like(target)
+  for i in range(target.shape[0]):
+    discretized[i, :] = np.digitize(
+        target[i, :], np.histogram(target[i, :], num_bins)[1][:-1])
+  return discretized
+
+
+def _reference_quantile_discretize(target, num_bins):
+  discretized = np.zeros_like(target)
+  for i in range(target.shape[0]):
+    edges = np.quantile(target[i, :], np.linspace(0, 1, num_bins + 1)[1:-1])
+    discretized[i, :] = np.digitize(target[i, :], edges) + 1
+  return discretized
+
+
+def test_histogram_discretize():
+  random_state = np.random.RandomState(3)
+  target = np.concatenate([
+      random_state.randn(3, 500),
+      random_state.randint(7, size=(1, 500)).astype(np.float64),
+      np.full((1, 500), 2.5),
+      1e6 + random_state.rand(1, 500),
+  ])
+  for num_bins in [1, 7, 20]:
+    np.testing.assert_array_equal(
+        utils._histogram_discretize(target, num_bins),
+        _reference_histogram_discretize(target, num_bins))
+
+
+def test_histogram_discretize_float32():
+  target = np.random.RandomState(4).randn(4, 300).astype(np.float32)
+  np.testing.assert_array_equal(utils._histogram_discretize(target, 20),
+                                _reference_histogram_discretize(target, 20))
+
+
+def test_quantile_discretize():
+  random_state = np.random.RandomState(5)
+  target = np.concatenate([random_state.randn(3, 400),
+                           random_state.randint(4, size=(2, 400)) * 1.])
+  for num_bins in [2, 10]:
+    np.testing.assert_array_equal(
+        utils._quantile_discretize(target, num_bins),
+        _reference_quantile_discretize(target, num_bins))
+  np.testing.assert_array_equal(
+      utils.make_discretizer(target, 10, discretizer_fn="quantile"),
+      utils._quantile_discretize(target, 10))
+
+
+def test_streaming_covariance():
+  x = np.random.RandomState(6).randn(101, 5) * [1., 2., 3., 4., 5.] + 10.
+  accumulator = utils.StreamingCovariance()
+  for start in range(0, 60, 7):
+    accumulator.update(x[start:min(start + 7, 60)])
+  other = utils.StreamingCovariance().update(x[60:])
+  accumulator.merge(other).merge(utils.StreamingCovariance())
+  assert accumulator.count == len(x)
+  np.testing.assert_allclose(accumulator.mean, x.mean(0))
+  np.testing.assert_allclose(accumulator.covariance(), np.cov(x.T))
+  np.testing.assert_allclose(accumulator.covariance(ddof=0),
+                             np.cov(x.T, ddof=0))
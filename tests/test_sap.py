@@ -0,0 +1,75 @@
+"""The exact 1-D threshold classifier of `src.metrics.sap`."""
+import itertools
+
+import numpy as np
+import pytest
+
+from src.metrics import sap
+
+
+def _balanced_accuracy(pred, y, num_classes):
+  counts = np.bincount(y, minlength=num_classes)
+  weights = np.where(counts > 0, 1. / np.maximum(counts, 1), 0.)
+  return np.sum(weights[y] * (pred == y))
+
+
+def _brute_force_accuracy(mu, y, num_classes):
+  """Best balanced accuracy of all thresholds and both class orders."""
+  values = np.unique(mu)
+  candidates = np.concatenate([[-np.inf], (values[1:] + values[:-1]) / 2,
+                               [np.inf]])
+  best = 0.
+  for classes in [np.arange(num_classes), np.arange(num_classes)[::-1]]:
+    for thresholds in itertools.combinations_with_replacement(
+        candidates, num_classes - 1):
+      pred = classes[np.searchsorted(np.array(thresholds), mu, side="right")]
+      best = max(best, _balanced_accuracy(pred, y, num_classes))
+  return best
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_threshold_classifier_is_optimal(seed):
+  random_state = np.random.RandomState(seed)
+  num_classes = 2 + seed % 3
+  ys = random_state.randint(num_classes, size=(1, 12))
+  # noisy codes (some reversed) and ties
+  mus = np.concatenate([ys + random_state.randn(3, 12),
+                        -ys + random_state.randn(1, 12),
+                        random_state.randint(3, size=(1, 12)) * 1.])
+  order = np.argsort(mus, axis=1, kind="stable")
+  sorted_mus = np.take_along_axis(mus, order, axis=1)
+  thresholds, classes = sap.fit_threshold_classifier(sorted_mus, ys[0][order],
+                                                     num_classes)
+  assert thresholds.shape == (5, num_classes - 1)
+  assert np.all(thresholds[:, 1:] >= thresholds[:, :-1])
+  pred = sap.predict_threshold_classifier(thresholds, classes, mus)
+  for mu, p in zip(mus, pred):
+    np.testing.assert_allclose(_balanced_accuracy(p, ys[0], num_classes),
+                               _brute_force_accuracy(mu, ys[0], num_classes))
+
+
+def test_threshold_score_matrix():
+  random_state = np.random.RandomState(0)
+  ys = random_state.randint(4, size=(2, 400))
+  mus = np.concatenate([ys + 0.2 * random_state.randn(2, 400),
+                        random_state.randn(1, 400), np.zeros((1, 400))])
+  train, test = slice(0, 300), slice(300, None)
+  scores = sap.compute_score_matrix(mus[:, train], ys[:, train], mus[:, test],
+                                    ys[:, test], False)
+  svm_scores = sap.compute_score_matrix(mus[:, train], ys[:, train],
+                                        mus[:, test], ys[:, test], False,
+                                        classifier="svm")
+  assert scores.shape == (4, 2)
+  assert np.all(np.diag(scores) > 0.95)
+  # same informative codes as with the SVM (which underfits the middle classes)
+  np.testing.assert_array_equal(scores.argmax(0), svm_scores.argmax(0))
+  assert np.all(np.diag(scores) >= np.diag(svm_scores))
+  assert sap._compute_sap(mus[:, train], ys[:, train], mus[:, test],
+                          ys[:, test], False)["SAP_score"] > 0.5
+
+
+def test_threshold_classifier_single_class():
+  mus = np.random.RandomState(1).randn(2, 10)
+  ys = np.full((1, 10), 3)
+  scores = sap.threshold_score_matrix(mus, ys, mus, ys)
+  np.testing.assert_array_equal(scores, 1.)
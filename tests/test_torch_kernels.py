@@ -0,0 +1,86 @@
+"""The torch kernels must give the same results as the numpy versions."""
+import numpy as np
+import pytest
+import torch
+
+from src.metrics import irs
+from src.metrics import metric_utils as utils
+from src.metrics import torch_kernels
+from src.metrics import unsupervised_metrics
+
+
+@pytest.fixture
+def codes():
+  random_state = np.random.RandomState(0)
+  return np.concatenate([random_state.randn(4, 300),
+                         random_state.randint(5, size=(1, 300)) * 1.,
+                         np.full((1, 300), 3.)])
+
+
+@pytest.mark.parametrize("name", ["histogram", "quantile"])
+def test_discretizers(codes, name):
+  for num_bins in [3, 20]:
+    np.testing.assert_array_equal(
+        torch_kernels.DISCRETIZERS[name](torch.from_numpy(codes),
+                                         num_bins).numpy(),
+        utils.DISCRETIZERS[name](codes, num_bins))
+
+
+def test_discrete_mutual_info_and_entropy():
+  random_state = np.random.RandomState(1)
+  ys = random_state.randint(5, size=(3, 200))
+  mus = ys[[0, 1, 2, 1]] + random_state.randint(3, size=(4, 200))
+  np.testing.assert_allclose(
+      torch_kernels.discrete_mutual_info(torch.from_numpy(mus), ys,
+                                         chunk_size=300).numpy(),
+      utils.discrete_mutual_info(mus, ys), atol=1e-12)
+  np.testing.assert_allclose(
+      torch_kernels.discrete_entropy(torch.from_numpy(ys)).numpy(),
+      utils.discrete_entropy(ys), atol=1e-12)
+
+
+def test_covariance_scores(codes):
+  x = codes[:4]
+  cov = torch_kernels.covariance(torch.from_numpy(x))
+  np.testing.assert_allclose(cov.numpy(), np.cov(x))
+  np.testing.assert_allclose(
+      unsupervised_metrics.gaussian_total_correlation(cov),
+      unsupervised_metrics.gaussian_total_correlation(np.cov(x)))
+  np.testing.assert_allclose(
+      unsupervised_metrics.gaussian_wasserstein_correlation(cov),
+      unsupervised_metrics.gaussian_wasserstein_correlation(np.cov(x)))
+
+
+def test_irs_kernels(codes):
+  np.testing.assert_array_equal(
+      torch_kernels.drop_constant_dims(torch.from_numpy(codes)).numpy(),
+      irs._drop_constant_dims(codes))
+  factor = np.random.RandomState(2).randint(4, size=300)
+  latents = codes.T
+  np.testing.assert_allclose(
+      torch_kernels.group_max_diffs(torch.from_numpy(factor),
+                                    torch.from_numpy(latents)).numpy(),
+      irs._group_max_diffs(factor, latents))
+
+
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+def test_quantiles_of_small_samples(dtype):
+  random_state = np.random.RandomState(3)
+  for num in [2, 3, 5, 7, 11, 13]:
+    x = random_state.randn(6, num).astype(dtype)
+    x[0] = np.round(x[0])  # ties
+    for num_bins in [2, 3, 7, 10]:
+      np.testing.assert_array_equal(
+          torch_kernels.quantile_discretize(torch.from_numpy(x),
+                                            num_bins).numpy(),
+          utils._quantile_discretize(x, num_bins))
+    factor = random_state.randint(3, size=4 * num)
+    latents = random_state.randn(4 * num, 3).astype(dtype)
+    for diff_quantile in [0.99, 0.7, 1.]:
+      max_diffs = irs._group_max_diffs(factor, latents, diff_quantile)
+      torch_diffs = torch_kernels.group_max_diffs(
+          torch.from_numpy(factor), torch.from_numpy(latents),
+          diff_quantile).numpy()
+      assert torch_diffs.dtype == max_diffs.dtype
+      np.testing.assert_allclose(torch_diffs, max_diffs,
+                                 rtol=1e-6 if dtype == np.float32 else 1e-12)
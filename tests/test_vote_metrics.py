@@ -0,0 +1,116 @@
+"""The batched sampling of the FactorVAE, BetaVAE and fairness metrics against
+the per-sample loops they replace."""
+import numpy as np
+import torch
+
+from src import evaluate
+from src.metrics import fairness
+from src.metrics import metric_beta_vae
+from src.metrics import metric_factor_vae
+from src.metrics import metric_utils as utils
+
+from conftest import FactorData, LinearModel, make_metric
+
+
+def _representation_function(model):
+  def represent(observations):
+    return model.encode(torch.as_tensor(observations)).numpy()
+  return represent
+
+
+def test_factor_vae_votes_match_loop():
+  data, model = FactorData(), LinearModel()
+  represent = _representation_function(model)
+  global_variances = np.array([1., 2., 0.5, 1.5])
+  active_dims = np.array([True, True, False, True])
+
+  torch.manual_seed(0)
+  votes = metric_factor_vae._generate_training_batch(
+      data, represent, 8, 50, np.random.RandomState(0), global_variances,
+      active_dims, eval_batch_size=100)
+
+  torch.manual_seed(0)
+  random_state = np.random.RandomState(0)
+  expected = np.zeros_like(votes)
+  for _ in range(50):
+    factor_index, argmin = metric_factor_vae._generate_training_sample(
+        data, represent, 8, random_state, global_variances, active_dims)
+    expected[factor_index, argmin] += 1
+  np.testing.assert_array_equal(votes, expected)
+
+
+def test_beta_vae_points_match_loop():
+  data, model = FactorData(), LinearModel()
+  represent = _representation_function(model)
+
+  torch.manual_seed(1)
+  points, labels = metric_beta_vae._generate_training_batch(
+      data, represent, 8, 30, np.random.RandomState(1), eval_batch_size=100)
+
+  torch.manual_seed(1)
+  random_state = np.random.RandomState(1)
+  expected = [metric_beta_vae._generate_training_sample(data, represent, 8,
+                                                        random_state)
+              for _ in range(30)]
+  np.testing.assert_array_equal(labels, [index for index, _ in expected])
+  np.testing.assert_allclose(points, np.stack([point for _, point in expected]),
+                             rtol=1e-6)
+
+
+def _reference_fairness(data, represent, mus_train, ys_train, num_points):
+  factor_counts = data.sizes
+  num_factors = len(factor_counts)
+  models = []
+  for i in range(num_factors):
+    model = utils.gradient_boosting_classifier()
+    model.fit(mus_train.T, ys_train[i, :])
+    models.append(model)
+  mean_fairness = np.zeros((num_factors, num_factors))
+  for j in range(num_factors):
+    original_factors = data.sample_factors(num_points, None).numpy()
+    for i in range(num_factors):
+      if i == j:
+        continue
+      counts = np.zeros((factor_counts[i], factor_counts[j]), dtype=np.int64)
+      for c in range(factor_counts[j]):
+        intervened_factors = original_factors.copy()
+        intervened_factors[:, j] = c
+        observations = data.sample_observations_from_factors(
+            intervened_factors, None)
+        predictions = models[i].predict(represent(observations))
+        counts[:, c] = np.bincount(predictions, minlength=factor_counts[i])
+      mean_fairness[i, j] = fairness.inter_group_fairness(counts)[0]
+  return fairness.compute_scores_dict(mean_fairness, "mean_fairness")
+
+
+def test_fairness_matches_loop():
+  # the factors (and their number of values) of the dataset are tensors
+  data, model = FactorData(), LinearModel()
+  represent = _representation_function(model)
+  torch.manual_seed(2)
+  ys_train = data.sample_factors(200, None)
+  mus_train = represent(data.sample_observations_from_factors(ys_train, None)).T
+  ys_train = ys_train.numpy().T
+
+  np.random.seed(2)
+  torch.manual_seed(3)
+  scores = fairness._compute_fairness(data, represent, np.random, mus_train,
+                                      ys_train, 20)
+  np.random.seed(2)
+  torch.manual_seed(3)
+  expected = _reference_fairness(data, represent, mus_train, ys_train, 20)
+  assert scores.keys() == expected.keys()
+  for key, value in expected.items():
+    np.testing.assert_allclose(scores[key], value)
+
+
+def test_fairness_does_not_depend_on_the_cache(model, data):
+  metric = make_metric(evaluate.Fairness, model, data, num_train=200,
+                       num_test_points_per_class=20)
+  expected = metric.compute()[1]
+  metric.set_cache(evaluate.Representation_Cache())
+  metric.sample_codes(300, split="test")  # other codes drawn before
+  results = metric.compute()[1]
+  for key, value in expected.items():
+    if key != "timing":
+      np.testing.assert_allclose(results[key], value)